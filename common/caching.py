@@ -0,0 +1,176 @@
+"""
+Small caches shared by the models and controllers: in-process (`LRUCache`), or
+shared by every process on the machine (`DiskCache`). Both have the same interface,
+so `make_cache` can pick one from the configuration.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """
+    A thread-safe, bounded mapping that evicts the least recently used entry
+    once `max_size` is exceeded.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Retrieve the value for `key`, marking it as recently used.
+        :param key: The key to look up
+        :param default: What to return if the key is missing
+        :return: The cached value, or the `default`
+        """
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key: Hashable, value: Any):
+        """
+        Store the `value` under `key`, evicting old entries as needed.
+        :param key: The key to store under
+        :param value: The value to store
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> Optional[Any]:
+        """ Remove the given key (if present), returning its old value. """
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def clear(self):
+        """ Remove every entry. """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+
+class DiskCache:
+    """
+    A bounded cache shared by every process on the machine, stored as one JSON file
+    per entry in `directory` (which can be on a memory-backed filesystem, like
+    /dev/shm). Values must be JSON-serializable; keys can be anything with a stable
+    `repr`. Once there are more than `max_size` entries, the least recently written
+    ones are removed.
+    """
+
+    def __init__(self, directory: str, max_size: int = 1024, prune_interval: int = 64):
+        self.directory = directory
+        self.max_size = max_size
+        self.prune_interval = prune_interval
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: Hashable) -> str:
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Retrieve the value for `key`.
+        :param key: The key to look up
+        :param default: What to return if the key is missing (or its file is unreadable)
+        :return: The cached value, or the `default`
+        """
+        try:
+            with open(self._path(key), encoding='utf-8') as entry:
+                return json.load(entry)
+        except (OSError, ValueError):
+            return default
+
+    def set(self, key: Hashable, value: Any):
+        """
+        Store the `value` under `key`. The entry is written to a temporary file and
+        then renamed, so that other processes never read a partial entry.
+        :param key: The key to store under
+        :param value: The value to store
+        """
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w', encoding='utf-8') as entry:
+                json.dump(value, entry, separators=(',', ':'))
+            os.replace(temporary, self._path(key))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        self._writes += 1
+        if self._writes % self.prune_interval == 0:
+            self.prune()
+
+    def prune(self):
+        """ Remove the oldest entries, until there are at most `max_size`. """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                try:
+                    entries.append((os.path.getmtime(os.path.join(self.directory, name)), name))
+                except OSError:
+                    pass
+        entries.sort()
+        for _, name in entries[:max(0, len(entries) - self.max_size)]:
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def delete(self, key: Hashable) -> Optional[Any]:
+        """ Remove the given key (if present), returning its old value. """
+        value = self.get(key)
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+        return value
+
+    def clear(self):
+        """ Remove every entry. """
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def __len__(self) -> int:
+        return sum(1 for name in os.listdir(self.directory) if name.endswith('.json'))
+
+    def __contains__(self, key: Hashable) -> bool:
+        return os.path.exists(self._path(key))
+
+
+def make_cache(backend: str = 'memory', max_size: int = 1024, directory: Optional[str] = None):
+    """
+    Create a cache with the given backend.
+    :param backend: 'memory' for an `LRUCache`, or 'disk' for a `DiskCache`
+    :param max_size: The most entries to keep
+    :param directory: Where a 'disk' cache keeps its entries
+    :return: The cache
+    """
+    if backend == 'memory':
+        return LRUCache(max_size)
+    if backend == 'disk':
+        if not directory:
+            raise ValueError("A disk cache needs a directory")
+        return DiskCache(directory, max_size)
+    raise ValueError("Unknown cache backend: {!r}".format(backend))
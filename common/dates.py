@@ -2,7 +2,10 @@
 Common utility functions for managing dates and times.
 """
 
-from datetime import datetime
+import re
+from datetime import datetime, timezone
+
+_ISO_DATETIME = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?Z?$")
 
 
 def datetime_to_string(a_datetime: datetime) -> str:
@@ -16,18 +19,30 @@ def datetime_to_string(a_datetime: datetime) -> str:
 
 def string_to_datetime(a_string: str) -> datetime:
     """
-    Convert the given string to a datetime. Initially tries the string with a decimal
-    place, then tries it without. Strings should be roughly of the format:
+    Convert the given string to a datetime. Strings should be roughly of the format:
 
     > '%Y-%m-%dT%H:%M:%S.%fZ'
 
+    with the fractional seconds being optional. Uses the builtin ISO parser where
+    it can, and otherwise parses the fields by hand (older Pythons only accept
+    exactly 3 or 6 fractional digits).
+
     :param a_string: A string representation of a datetime.
     :return: The datetime version of that string
     """
+    trimmed = a_string[:-1] if a_string.endswith('Z') else a_string
     try:
-        return datetime.strptime(a_string, '%Y-%m-%dT%H:%M:%S.%fZ')
+        parsed = datetime.fromisoformat(trimmed)
     except ValueError:
-        return datetime.strptime(a_string, '%Y-%m-%dT%H:%M:%SZ')
+        match = _ISO_DATETIME.match(a_string)
+        if match is None:
+            raise ValueError("Invalid datetime string: {!r}".format(a_string))
+        year, month, day, hour, minute, second, fraction = match.groups()
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                        int(fraction.ljust(6, '0')) if fraction else 0)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
 
 
 def datetime_to_pretty_string(a_datetime: datetime) -> str:
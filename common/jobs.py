@@ -0,0 +1,45 @@
+"""
+A lightweight, in-process runner for background jobs that need the application context.
+"""
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from flask import Flask
+
+log = logging.getLogger('blockpy.jobs')
+
+#: How many worker threads to use if `BACKGROUND_JOB_WORKERS` is not configured
+DEFAULT_WORKERS = 2
+
+
+def get_executor(app: Flask) -> ThreadPoolExecutor:
+    """
+    Retrieve (or lazily create) the thread pool that runs background jobs for this app.
+    :param app: The main Flask application
+    :return: The executor
+    """
+    executor = app.extensions.get('background_jobs')
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=app.config.get('BACKGROUND_JOB_WORKERS', DEFAULT_WORKERS),
+                                      thread_name_prefix='blockpy-job')
+        app.extensions['background_jobs'] = executor
+    return executor
+
+
+def run_in_background(app: Flask, function: Callable, *args, **kwargs) -> Future:
+    """
+    Run the `function` in a worker thread, inside its own application context.
+    Any exceptions are logged, and are also available from the returned Future.
+    :param app: The main Flask application (e.g., `current_app._get_current_object()`)
+    :param function: The job to run
+    :return: A Future holding the result of the job
+    """
+    def run_job():
+        with app.app_context():
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                log.exception("Background job %s failed", getattr(function, '__name__', function))
+                raise
+    return get_executor(app).submit(run_job)
@@ -0,0 +1,149 @@
+"""
+MinHash signatures and locality-sensitive hashing, for finding similar code.
+
+Code is tokenized with Python's own tokenizer, with identifiers, strings, and
+numbers replaced by placeholders (so renaming variables does not hide copying),
+and cut into overlapping shingles of `SHINGLE_SIZE` tokens. The Jaccard similarity
+of two submissions' shingle sets is estimated by the fraction of equal values in
+their MinHash signatures, and LSH splits each signature into `BANDS` bands: two
+submissions land in the same bucket of some band with high probability when they
+are similar, and rarely otherwise, so similar pairs can be found by bucketing
+instead of comparing every pair.
+"""
+import builtins
+import hashlib
+import io
+import keyword
+import random
+import re
+import struct
+import tokenize
+from array import array
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+
+#: Tokens per shingle
+SHINGLE_SIZE = 5
+#: Hash functions per signature
+NUM_PERMUTATIONS = 128
+#: LSH bands (each of NUM_PERMUTATIONS // BANDS rows); pairs above about
+#: (1 / BANDS) ** (BANDS / NUM_PERMUTATIONS) similarity are likely to collide
+BANDS = 16
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 64) - 1
+_RANDOM = random.Random(108)
+_PERMUTATIONS = [(_RANDOM.randrange(1, _MERSENNE_PRIME), _RANDOM.randrange(0, _MERSENNE_PRIME))
+                 for _ in range(NUM_PERMUTATIONS)]
+
+#: Names kept as they are, since they say what the code does rather than what it calls things
+_KEPT_NAMES = frozenset(keyword.kwlist) | frozenset(dir(builtins))
+_IGNORED_TOKENS = {tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT,
+                   tokenize.ENCODING, tokenize.ENDMARKER}
+_FALLBACK_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+
+def _normalize_word(word: str) -> str:
+    if word in _KEPT_NAMES or not (word[0].isalnum() or word[0] == '_'):
+        return word
+    return 'D' if word[0].isdigit() else 'N'
+
+
+def tokenize_code(code: str) -> List[str]:
+    """
+    The normalized tokens of the Python code. Code that does not tokenize (e.g.,
+    unfinished work) is split into words and symbols instead.
+    """
+    tokens = []
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(code).readline):
+            if token.type in _IGNORED_TOKENS:
+                continue
+            if token.type == tokenize.NAME:
+                tokens.append(token.string if token.string in _KEPT_NAMES else 'N')
+            elif token.type == tokenize.STRING:
+                tokens.append('S')
+            elif token.type == tokenize.NUMBER:
+                tokens.append('D')
+            else:
+                tokens.append(token.string)
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        tokens = [_normalize_word(word) for word in _FALLBACK_TOKEN.findall(code)]
+    return tokens
+
+
+def shingles(tokens: Sequence[str], size: int = SHINGLE_SIZE) -> Set[str]:
+    if len(tokens) <= size:
+        return {' '.join(tokens)} if tokens else set()
+    return {' '.join(tokens[index:index + size]) for index in range(len(tokens) - size + 1)}
+
+
+def _hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def signature(items: Iterable[str]) -> array:
+    """
+    The MinHash signature of a set of shingles: for each hash function, the smallest
+    hash of any of them. An empty set gets the maximum hash everywhere.
+    """
+    hashes = [_hash(item) for item in items]
+    values = array('Q', [_MAX_HASH]) * NUM_PERMUTATIONS
+    if hashes:
+        for index, (a, b) in enumerate(_PERMUTATIONS):
+            values[index] = min((a * value + b) % _MERSENNE_PRIME for value in hashes)
+    return values
+
+
+def code_signature(code: str) -> array:
+    return signature(shingles(tokenize_code(code)))
+
+
+def similarity(first: Sequence[int], second: Sequence[int]) -> float:
+    """ The estimated Jaccard similarity of two signatures. """
+    return sum(1 for a, b in zip(first, second) if a == b) / len(first)
+
+
+def band_buckets(values: Sequence[int], bands: int = BANDS) -> List[int]:
+    """ The LSH bucket of each band of the signature, as signed 63-bit integers (to fit a BIGINT). """
+    rows = len(values) // bands
+    return [int.from_bytes(hashlib.blake2b(struct.pack('<{}Q'.format(rows), *values[band * rows:(band + 1) * rows]),
+                                           digest_size=8).digest(), 'little') >> 1
+            for band in range(bands)]
+
+
+def candidate_pairs(buckets: Dict[object, Sequence[int]]) -> Set[Tuple[object, object]]:
+    """
+    The pairs of items that share a bucket in some band (each as (smaller, larger)).
+    :param buckets: The `band_buckets` of each item, by its key
+    """
+    by_bucket: Dict[Tuple[int, int], List[object]] = {}
+    for key, item_buckets in buckets.items():
+        for band, bucket in enumerate(item_buckets):
+            by_bucket.setdefault((band, bucket), []).append(key)
+    pairs = set()
+    for keys in by_bucket.values():
+        keys.sort()
+        for index, first in enumerate(keys):
+            for second in keys[index + 1:]:
+                pairs.add((first, second))
+    return pairs
+
+
+def clusters(pairs: Iterable[Tuple[object, object]]) -> List[List[object]]:
+    """ Group the items linked by the pairs (transitively), largest groups first. """
+    parents = {}
+
+    def find(item):
+        parents.setdefault(item, item)
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+    for first, second in pairs:
+        root_first, root_second = find(first), find(second)
+        if root_first != root_second:
+            parents[root_second] = root_first
+    groups: Dict[object, List[object]] = {}
+    for item in parents:
+        groups.setdefault(find(item), []).append(item)
+    return sorted((sorted(group) for group in groups.values()), key=lambda group: (-len(group), group[0]))
@@ -44,10 +44,121 @@ class DefaultConfig:
     # Debug toolbar settings
     DEBUG_TB_INTERCEPT_REDIRECTS = False
 
+    # Per-endpoint SQL query statistics (see /v1/instrumentation/queries, which is only
+    # served to metrics clients). Fingerprints every statement, so it is off by default;
+    # /metrics times the database on its own.
+    SQL_INSTRUMENTATION = False
+    # Flag a statement repeated this many times in one request as an N+1 pattern
+    SQL_N_PLUS_ONE_THRESHOLD = 10
+    # Fraction of requests whose query counts are logged
+    SQL_INSTRUMENTATION_LOG_SAMPLE_RATE = 0.01
+    # Rows fetched at once when streaming whole-course scans (exports and reports)
+    STREAM_CHUNK_SIZE = 1000
+    # Per-assignment analytics leave events this many seconds old for the next update
+    # (see models.log_summary), since their transactions may not have committed yet
+    LOG_SUMMARY_SETTLE_SECONDS = 5
+    # Seconds of inactivity that end a student's work session (see models.work_session)
+    WORK_SESSION_IDLE_GAP = 15 * 60
+    # Edits between checkpoints of a student's code, for point-in-time reconstruction
+    # (see models.code_checkpoint); lookups replay at most this many edits
+    CODE_CHECKPOINT_INTERVAL = 50
+    # Keep an index of similar code across each assignment's submissions, updated as
+    # code is saved (see models.code_similarity), and report pairs at least this similar
+    CODE_SIMILARITY_INDEX = True
+    CODE_SIMILARITY_THRESHOLD = 0.7
+
+    # Keep a trigram index of code, feedback, and review comments, updated as they are
+    # written, for searching across a course (see models.search_index)
+    SEARCH_INDEX = True
+
+    # Connection pools, per engine: 'primary' serves interactive requests, and
+    # 'reporting' (exports, histories, gradebooks, and the replica) has its own so that
+    # heavy reports can never use up the primary's connections. Ignored for SQLite.
+    DATABASE_POOLS = {
+        'primary': {'pool_size': 10, 'max_overflow': 10, 'pool_timeout': 10,
+                    'pool_recycle': 1800, 'pool_pre_ping': True},
+        'reporting': {'pool_size': 2, 'max_overflow': 2, 'pool_timeout': 60,
+                      'pool_recycle': 1800, 'pool_pre_ping': True}
+    }
+    # Milliseconds before a statement is cancelled, per engine (PostgreSQL and MySQL)
+    DATABASE_STATEMENT_TIMEOUTS = {'primary': 10000, 'reporting': 300000}
+    # Send reporting queries to this read replica, if set
+    DATABASE_REPLICA_URI = None
+    # Use the primary instead while the replica is more than this many seconds behind
+    DATABASE_REPLICA_MAX_LAG = 30
+    DATABASE_REPLICA_LAG_CHECK_INTERVAL = 15
+    # Query giving the replica's lag in seconds (by default, known for PostgreSQL only)
+    DATABASE_REPLICA_LAG_QUERY = None
+
+    # Read-through cache of encoded assignments for the editor: 'memory' (per
+    # process) or 'disk' (shared by the processes on a machine, in EDITOR_CACHE_DIR,
+    # which defaults to instance/editor_cache and can be put on /dev/shm)
+    EDITOR_CACHE_BACKEND = 'memory'
+    EDITOR_CACHE_SIZE = 512
+    EDITOR_CACHE_DIR = None
+
+    # Tune SQLite for production use: WAL journaling, these pragmas on every
+    # connection, a shared pool, and one writer at a time per process
+    SQLITE_TUNING = False
+    SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 5000,
+                      'cache_size': -64000, 'temp_store': 'MEMORY'}
+    SQLITE_POOL_SIZE = 5
+    SQLITE_POOL_OVERFLOW = 10
+    # Seconds to wait for the write lock before leaving it to SQLite's busy timeout
+    SQLITE_WRITE_LOCK_TIMEOUT = 30
+
+    # Per-endpoint latency histograms, in the Prometheus format (see /metrics)
+    METRICS = True
+    # Who may read /metrics and the other operational reports: callers that send this
+    # token (in X-Metrics-Token), if it is set, and otherwise callers from these addresses
+    METRICS_TOKEN = os.environ.get('BLOCKPY_METRICS_TOKEN')
+    METRICS_ALLOWED_ADDRS = ('127.0.0.1', '::1')
+    # How many reverse proxies in front of the app to trust for the client's address
+    # (X-Forwarded-For) and scheme; without this, every client seems to be the proxy
+    PROXY_FIX_X_FOR = 0
+    # With multiple worker processes, a directory they all share; each writes its
+    # metrics there every METRICS_FLUSH_INTERVAL seconds
+    METRICS_MULTIPROC_DIR = os.environ.get('BLOCKPY_METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = 5.0
+
+    # Record anonymized request traces into this JSON-lines file, for replaying
+    # with `manage.py loadtest` (off if None)
+    TRACE_RECORD_PATH = None
+    TRACE_SAMPLE_RATE = 1.0
+
     # Flask JWT Extended
     JWT_TOKEN_LOCATION = ["headers", "cookies", "json", "query_string"]
     JWT_COOKIE_SAMESITE = 'None'
     JWT_COOKIE_SECURE = True
+    # Only look in (possibly large) JSON request bodies for tokens if this is set
+    JWT_CHECK_JSON_BODY = False
+    # Seconds to remember a verified token (never past its own expiry)
+    JWT_IDENTITY_CACHE_TTL = 300
+
+    # Keep-alive connection pools for posting LTI outcomes, per consumer
+    PYLTI_POOL_MAX_CONNECTIONS = 8
+    # Seconds, for each request and for waiting on a free connection
+    PYLTI_POOL_TIMEOUT = 30
+    PYLTI_POOL_ACQUIRE_TIMEOUT = 30
+
+    # Replay protection for LTI launches: where to remember OAuth nonces
+    # ('memory' for this process only, or 'database' to share across processes)
+    PYLTI_NONCE_STORE = 'memory'
+    PYLTI_NONCE_CACHE_SIZE = 100000
+    # Seconds that a launch's OAuth timestamp may differ from the server's clock
+    PYLTI_TIMESTAMP_THRESHOLD = 300
+
+    # LTI grade passback queue: post grades from background workers instead of
+    # during the student's request
+    PYLTI_GRADE_QUEUE = False
+    PYLTI_GRADE_QUEUE_WORKERS = 2
+    PYLTI_GRADE_QUEUE_BATCH_SIZE = 50
+    PYLTI_GRADE_QUEUE_POLL_INTERVAL = 1.0
+    PYLTI_GRADE_QUEUE_MAX_ATTEMPTS = 8
+    # Seconds; doubles after every failed attempt, up to the maximum
+    PYLTI_GRADE_QUEUE_BACKOFF = 2.0
+    PYLTI_GRADE_QUEUE_MAX_BACKOFF = 600.0
+    PYLTI_GRADE_QUEUE_STALL_TIMEOUT = 300
 
     # User registration stuff
     SECURITY_CONFIRMABLE = True
@@ -76,6 +187,8 @@ class DevelopmentConfig(DefaultConfig):
     HOST = 'localhost'
     SITE_ROOT_URL = 'localhost:5001'
     SQLALCHEMY_DATABASE_URI = 'sqlite:///instance/main.db'
+    SQLITE_TUNING = True
+    SQL_INSTRUMENTATION = True
 
 
 class TestConfig(DefaultConfig):
@@ -7,6 +7,9 @@ from controllers.setup import registry, rebar, generator
 import controllers.lti
 from controllers.pylti.flask import lti
 import controllers.auth
+import controllers.assignments
+import controllers.submissions
+import controllers.search
 
 
 def create_blueprints(app):
@@ -0,0 +1,171 @@
+from flask import g, jsonify, request
+from flask_rebar import RequestSchema, errors
+from marshmallow import fields
+from marshmallow.validate import Range
+
+from common.minhash import clusters
+from controllers.conditional import conditional, versioned
+from controllers.setup import registry, rebar
+from controllers.submissions import MomentSchema, get_moment
+from models.assignment import Assignment, AssignmentSchema
+from models.assignment_group import AssignmentGroup, GroupSchema
+from models.code_checkpoint import reconstruct_assignment
+from models.code_similarity import CodeSignature
+from models.log_summary import LogSummary
+from models.submission import Submission
+from models.user import User
+from models.work_session import WorkSession
+
+
+def load_visible_assignment(assignment_id: int):
+    """ The whole assignment, grading code and all, if it exists; only its course's graders may see it. """
+    assignment = Assignment.by_id(assignment_id)
+    if assignment is None:
+        return None
+    viewer = User.find_student(g.user['email'])
+    if viewer is None or not viewer.is_grader(assignment.course_id):
+        raise errors.Forbidden("Only the course's graders can see this")
+    return assignment
+
+
+def load_visible_group(group_id: int):
+    """ The group, if it exists; only the members of its course may see it. """
+    group = AssignmentGroup.by_id(group_id)
+    if group is None:
+        return None
+    viewer = User.find_student(g.user['email'])
+    if viewer is None or not viewer.in_course(group.course_id):
+        raise errors.Forbidden("You are not in this course")
+    return group
+
+
+@registry.handles(rule='/assignments/<int:assignment_id>', method='GET',
+                  response_body_schema=versioned(AssignmentSchema()))
+@conditional(load_visible_assignment)
+def get_assignment(assignment: Assignment):
+    return assignment
+
+
+@registry.handles(rule='/groups/<int:group_id>', method='GET', response_body_schema=versioned(GroupSchema()))
+@conditional(load_visible_group)
+def get_group(group: AssignmentGroup):
+    return group
+
+
+def get_assignment_course(assignment: Assignment) -> int:
+    """ The course (`course_id`, defaulting to the assignment's) that the assignment is used in. """
+    course_id = request.args.get('course_id', default=assignment.course_id, type=int)
+    if not assignment.is_used_by(course_id):
+        raise errors.Forbidden("This assignment is not used in that course")
+    return course_id
+
+
+def load_for_editor(assignment_id: int):
+    """
+    The assignment and the current user's submission in the course (`course_id`,
+    defaulting to the assignment's), which must use the assignment and which they
+    must have a role in. Students must also be at an allowed address and give the
+    assignment's `passcode`, if it has one.
+    """
+    assignment = Assignment.by_id(assignment_id)
+    if assignment is None:
+        return None
+    course_id = get_assignment_course(assignment)
+    user = User.find_student(g.user['email'])
+    if user is None or not user.in_course(course_id):
+        raise errors.Forbidden("You are not in this course")
+    if not user.is_grader(course_id):
+        if not assignment.is_allowed(request.remote_addr):
+            raise errors.Forbidden("This assignment cannot be accessed from your address")
+        if assignment.passcode_fails(request.values.get('passcode', '')):
+            raise errors.Forbidden("This assignment requires a passcode")
+    submission = assignment.load_or_new_submission(user.id, course_id)
+    return assignment, submission, user
+
+
+def is_assignment_grader(user: User, assignment: Assignment) -> bool:
+    """ Whether the user may see the assignment's grading code (like `get_assignment`, only its course's graders). """
+    return user.is_grader(assignment.course_id)
+
+
+@registry.handles(rule='/assignments/<int:assignment_id>/editor', method='GET')
+@conditional(load_for_editor)
+def assignment_editor(assignment: Assignment, submission, user):
+    """
+    The assignment and the current user's submission, as loaded by the editor. If the
+    client's copy is still current, the response is 304 Not Modified, without
+    encoding anything. Only the graders of the assignment's own course get the
+    grading code and access settings.
+    """
+    for_grader = is_assignment_grader(user, assignment)
+    response = jsonify(assignment.for_editor_with(submission, user, for_grader))
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def load_for_grader(assignment_id: int):
+    """
+    The assignment and the course that uses it (`course_id`, defaulting to the
+    assignment's), for that course's graders.
+    """
+    assignment = Assignment.by_id(assignment_id)
+    if assignment is None:
+        raise errors.NotFound("Unknown assignment")
+    course_id = get_assignment_course(assignment)
+    user = User.find_student(g.user['email'])
+    if user is None or not user.is_grader(course_id):
+        raise errors.Forbidden("Only the course's graders can see this")
+    return assignment, course_id
+
+
+@registry.handles(rule='/assignments/<int:assignment_id>/analytics', method='GET')
+def assignment_analytics(assignment_id: int):
+    """
+    The course's graders' dashboard of how students are doing on the assignment: the
+    totals, and each student's runs, compile errors, feedback, progress, and time on
+    task. Only reads what is already summarized: the summaries and work sessions are
+    caught up with the event log by `manage.py update_log_summaries` and
+    `update_work_sessions` (e.g., run every minute).
+    """
+    assignment, course_id = load_for_grader(assignment_id)
+    time_on_task = WorkSession.time_on_task(course_id, assignment_id)
+    students = []
+    for summary in LogSummary.by_assignment(course_id, assignment_id):
+        student = summary.encode_json()
+        student.update(time_on_task.get(summary.subject_id, {'sessions': 0, 'time_on_task': 0.0}))
+        students.append(student)
+    return jsonify({'overview': LogSummary.overview(course_id, assignment_id), 'students': students})
+
+
+@registry.handles(rule='/assignments/<int:assignment_id>/code', method='GET', query_string_schema=MomentSchema())
+def assignment_code(assignment_id: int):
+    """
+    Every student's files on the assignment as they were at the given moment (e.g., the
+    deadline, for regrading), by their user id.
+    """
+    assignment, course_id = load_for_grader(assignment_id)
+    states = reconstruct_assignment(course_id, assignment.id, get_moment())
+    return jsonify({'students': {subject_id: state.encode_json() for subject_id, state in states.items()}})
+
+
+class SimilaritySchema(RequestSchema):
+    threshold = fields.Float(validate=Range(0, 1))
+
+
+@registry.handles(rule='/assignments/<int:assignment_id>/similarity', method='GET',
+                  query_string_schema=SimilaritySchema())
+def assignment_similarity(assignment_id: int):
+    """
+    The pairs of the assignment's submissions with similar code (at least as similar
+    as `threshold`, defaulting to `CODE_SIMILARITY_THRESHOLD`), most similar first,
+    and the clusters of submissions they link.
+    """
+    assignment, course_id = load_for_grader(assignment_id)
+    pairs = CodeSignature.similar_pairs(course_id, assignment.id, rebar.validated_args.get('threshold'))
+    owners = Submission.get_owners({submission_id for pair in pairs for submission_id in pair[:2]})
+    return jsonify({
+        'pairs': [{'submission_ids': [first, second], 'user_ids': [owners.get(first), owners.get(second)],
+                   'similarity': score}
+                  for first, second, score in pairs],
+        'clusters': clusters((first, second) for first, second, _ in pairs)
+    })
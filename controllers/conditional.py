@@ -0,0 +1,126 @@
+"""
+Conditional requests for the versioned resources of the `/v1` API.
+
+A handler declares which resources its response represents with `@conditional`,
+placed between `registry.handles` and the handler itself:
+
+    @registry.handles(rule='/submissions/<int:submission_id>', method='GET',
+                      response_body_schema=versioned(SubmissionSchema()))
+    @conditional(load_visible_submission)
+    def get_submission(submission):
+        return submission
+
+The resources are loaded first, by a loader that must also check that the user may
+see them (raising 403 Forbidden otherwise), since even a 304 or an ETag tells the
+client something about them. Then their strong ETag (from each one's table, id,
+version, and modification date) and Last-Modified date are compared with the
+request's validators before the handler runs. A GET whose If-None-Match (or, without
+one, If-Modified-Since) still matches gets a bodiless 304 Not Modified, without the
+response ever being serialized. A write whose If-Match (or If-Unmodified-Since) no
+longer matches is refused with 412 Precondition Failed, so that clients cannot
+overwrite changes they have not seen. Every other response carries the current
+ETag and Last-Modified headers.
+"""
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+from typing import Callable, Optional
+
+from flask import current_app, request
+from flask_rebar import errors
+from werkzeug.http import http_date, quote_etag
+
+#: Methods that never change the resource, so can be answered with 304 Not Modified
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+def resource_etag(*resources) -> str:
+    """
+    A strong entity tag for the given resources (skipping any that are None). The
+    modification date is included along with the version, since not every change
+    (e.g., grading a submission) bumps the version.
+    """
+    parts = ['{}:{}:{}:{}'.format(resource.__tablename__, resource.id, getattr(resource, 'version', ''),
+                                  resource.date_modified)
+             for resource in resources if resource is not None]
+    return hashlib.sha1(';'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _utc(moment: datetime) -> datetime:
+    """ Naive UTC, to the second (as precise as HTTP dates get). """
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment.replace(microsecond=0)
+
+
+def last_modified(*resources) -> Optional[datetime]:
+    """ The latest modification date of the given resources (skipping any that are None). """
+    dates = [resource.date_modified for resource in resources
+             if resource is not None and resource.date_modified is not None]
+    return _utc(max(dates)) if dates else None
+
+
+def is_not_modified(etag: str, modified: Optional[datetime]) -> bool:
+    """ Whether the client's copy is still current. If-None-Match takes precedence over If-Modified-Since. """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    return since is not None and modified is not None and modified <= _utc(since)
+
+
+def check_preconditions(etag: str, modified: Optional[datetime]):
+    """ Refuse a write to a resource that has changed since the client last saw it. """
+    if request.if_match and not request.if_match.contains(etag):
+        raise errors.PreconditionFailed("The resource has been changed by someone else")
+    since = request.if_unmodified_since
+    if since is not None and modified is not None and modified > _utc(since):
+        raise errors.PreconditionFailed("The resource has been changed by someone else")
+
+
+def _add_validators(headers, etag: str, modified: Optional[datetime]):
+    headers['ETag'] = quote_etag(etag)
+    if modified is not None:
+        headers['Last-Modified'] = http_date(modified.replace(tzinfo=timezone.utc))
+
+
+def versioned(schema) -> dict:
+    """ The response schemas of a conditional handler: the given schema, and no body for a 304. """
+    return {200: schema, 304: None}
+
+
+def conditional(load: Callable):
+    """
+    Make the handler answer conditional requests for the resources its response represents.
+    :param load: Given the handler's URL arguments, returns the resource (or a tuple of
+                 resources, some of which may be None); if it returns None, the response
+                 is 404 Not Found. The handler is called with the resources instead.
+    :return: The decorator
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def wrapped(**kwargs):
+            resources = load(**kwargs)
+            if resources is None:
+                raise errors.NotFound("Unknown resource")
+            if not isinstance(resources, tuple):
+                resources = (resources,)
+            etag, modified = resource_etag(*resources), last_modified(*resources)
+            if request.method in SAFE_METHODS:
+                if is_not_modified(etag, modified):
+                    response = current_app.response_class(status=304)
+                    _add_validators(response.headers, etag, modified)
+                    return response
+            else:
+                check_preconditions(etag, modified)
+            result = handler(*resources)
+            if request.method not in SAFE_METHODS:
+                # The handler may have changed them
+                etag, modified = resource_etag(*resources), last_modified(*resources)
+            if isinstance(result, current_app.response_class):
+                _add_validators(result.headers, etag, modified)
+                return result
+            headers = {}
+            _add_validators(headers, etag, modified)
+            return result, 200, headers
+        return wrapped
+    return decorator
@@ -0,0 +1,214 @@
+"""
+Instrumentation of the SQL issued while handling each request.
+
+Every statement run through SQLAlchemy is timed and fingerprinted. When a request
+finishes, its query count, total database time, and repeated statements are added
+to per-endpoint aggregates. A statement that is repeated at least
+`SQL_N_PLUS_ONE_THRESHOLD` times within one request (the telltale sign of a query per
+row, as in `User.query.get` inside a loop) is flagged as an N+1 pattern.
+"""
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from flask import Flask, abort, current_app, g, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from common.caching import LRUCache
+from controllers.metrics import is_metrics_client
+
+log = logging.getLogger('blockpy.instrumentation')
+
+#: Fingerprints by statement text, since the same few statements are run over and over
+_FINGERPRINTS = LRUCache(2048)
+_PLACEHOLDER_LISTS = re.compile(r"\((?:\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*\)")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+
+_listening = False
+_listening_lock = threading.Lock()
+
+
+def fingerprint(statement: str) -> str:
+    """
+    Reduce a statement to the shape that identifies it, so that the same query with
+    different parameters (or a different number of IN values) is counted together.
+    :param statement: The SQL statement
+    :return: The normalized statement
+    """
+    found = _FINGERPRINTS.get(statement)
+    if found is None:
+        found = _WHITESPACE.sub(" ", statement).strip()
+        found = _LITERALS.sub("?", found)
+        found = _PLACEHOLDER_LISTS.sub("(?...)", found)
+        _FINGERPRINTS.set(statement, found)
+    return found
+
+
+class RequestQueries:
+    """ The queries issued so far while handling the current request. """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def record(self, statement: str, duration: float):
+        self.count += 1
+        self.duration += duration
+        self.statements[fingerprint(statement)] += 1
+
+    def get_repeated(self, threshold: int) -> dict:
+        """ The fingerprints that were repeated at least `threshold` times. """
+        return {statement: count for statement, count in self.statements.items() if count >= threshold}
+
+
+class EndpointQueries:
+    """ Aggregated query statistics for one endpoint. """
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.duration = 0.0
+        self.max_duration = 0.0
+        self.n_plus_one = Counter()
+
+    def add(self, queries: RequestQueries, repeated: dict):
+        self.requests += 1
+        self.queries += queries.count
+        self.max_queries = max(self.max_queries, queries.count)
+        self.duration += queries.duration
+        self.max_duration = max(self.max_duration, queries.duration)
+        for statement in repeated:
+            self.n_plus_one[statement] += 1
+
+    def encode_json(self) -> dict:
+        return {
+            'requests': self.requests,
+            'queries': self.queries,
+            'mean_queries': self.queries / self.requests if self.requests else 0,
+            'max_queries': self.max_queries,
+            'db_time': self.duration,
+            'mean_db_time': self.duration / self.requests if self.requests else 0,
+            'max_db_time': self.max_duration,
+            'n_plus_one': [{'statement': statement, 'requests': count}
+                           for statement, count in self.n_plus_one.most_common()]
+        }
+
+
+class QueryInstrumentation:
+    """
+    Collects the per-request query statistics into per-endpoint aggregates. There
+    is one of these per app, in `app.extensions['sql_instrumentation']`.
+    """
+
+    def __init__(self, app: Flask):
+        self.threshold = app.config.get('SQL_N_PLUS_ONE_THRESHOLD', 10)
+        self.log_sample_rate = app.config.get('SQL_INSTRUMENTATION_LOG_SAMPLE_RATE', 0.01)
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def finish_request(self, endpoint: str, queries: RequestQueries):
+        """ Add the queries of a finished request to its endpoint's aggregates. """
+        repeated = queries.get_repeated(self.threshold)
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointQueries()
+            stats.add(queries, repeated)
+        for statement, count in repeated.items():
+            log.warning("Possible N+1 in %s: %s queries like %s", endpoint, count, statement)
+        if self.log_sample_rate and random.random() < self.log_sample_rate:
+            log.info("%s ran %s queries in %.1fms", endpoint, queries.count, queries.duration * 1000)
+
+    def encode_json(self) -> dict:
+        with self._lock:
+            return {'n_plus_one_threshold': self.threshold,
+                    'endpoints': {endpoint: stats.encode_json()
+                                  for endpoint, stats in self.endpoints.items()}}
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+
+
+def get_request_queries() -> 'Optional[RequestQueries]':
+    """
+    The queries of the current request, or None if no request is being instrumented.
+    """
+    if not has_request_context():
+        return None
+    return g.get('_sql_queries')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and '_sql_queries' in g:
+        conn.info.setdefault('_sql_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('_sql_query_start')
+    if started and has_request_context() and '_sql_queries' in g:
+        g._sql_queries.record(statement, time.perf_counter() - started.pop())
+
+
+def _handle_error(context):
+    started = context.connection.info.get('_sql_query_start') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def _start_request():
+    g._sql_queries = RequestQueries()
+
+
+def _finish_request(response):
+    queries = g.get('_sql_queries')
+    if queries is not None:
+        instrumentation = _get_instrumentation()
+        if instrumentation is not None:
+            instrumentation.finish_request(request.endpoint or 'unknown', queries)
+    return response
+
+
+def _get_instrumentation() -> QueryInstrumentation:
+    return current_app.extensions.get('sql_instrumentation')
+
+
+def get_query_stats():
+    """
+    Report the query statistics of every endpoint. Only available to metrics clients
+    (see `is_metrics_client`), since the statements can reveal how data is stored.
+    :return:
+    """
+    if not is_metrics_client():
+        abort(404)
+    return jsonify(_get_instrumentation().encode_json())
+
+
+def init_instrumentation(app: Flask):
+    """
+    Start instrumenting the SQL of every request, if `SQL_INSTRUMENTATION` is set,
+    and expose the aggregates at `/v1/instrumentation/queries`.
+    :param app: The main Flask application
+    """
+    global _listening
+    if not app.config.get('SQL_INSTRUMENTATION', False):
+        return
+    with _listening_lock:
+        if not _listening:
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+            event.listen(Engine, 'handle_error', _handle_error)
+            _listening = True
+    app.extensions['sql_instrumentation'] = QueryInstrumentation(app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/v1/instrumentation/queries', 'instrumentation_queries', get_query_stats,
+                     methods=['GET'])
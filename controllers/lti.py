@@ -1,7 +1,7 @@
 from controllers.setup import registry, rebar
-from flask_rebar import RequestSchema
+from flask_rebar import RequestSchema, errors
 from marshmallow import fields
-from flask import current_app, g, session, jsonify, make_response, redirect, request
+from flask import abort, current_app, g, session, jsonify, make_response, redirect, request
 from flask_jwt_extended import create_access_token, get_jwt_identity, verify_jwt_in_request, \
     set_access_cookies
 from flask_jwt_extended.jwt_manager import ExpiredSignatureError
@@ -14,6 +14,8 @@ import controllers.lti
 from models.course import CourseSchema
 from models.user import UserSchema
 from controllers.pylti.flask import lti
+from controllers.pylti.grade_queue import grade_queue
+from controllers.metrics import is_metrics_client
 
 
 @current_app.route('/v1/lti', methods=['POST'])
@@ -29,3 +31,42 @@ def lti_launch(lti=None):
     set_access_cookies(response, access_token)
     print(response)
     return response
+
+
+@current_app.route('/v1/lti/submissions/<int:submission_id>/grade', methods=['POST'])
+@lti(request='session')
+def lti_post_grade(submission_id, lti=None):
+    """
+    Send the submission's current score back to the LMS that launched it (through
+    the grade queue, if it is enabled), for its student or the course's graders. The
+    submission must have its own sourcedid, from the launch that created it, so that
+    it can never be posted as the grade of the currently launched assignment.
+    :return:
+    """
+    from models.submission import Submission
+    from models.user import User
+    submission = Submission.by_id(submission_id)
+    if submission is None:
+        raise errors.NotFound("Unknown submission")
+    user = User.find_student(g.user['email'])
+    if user is None or (user.id != submission.user_id and not user.is_grader(submission.course_id)):
+        raise errors.Forbidden("You cannot post this submission's grade")
+    if not submission.endpoint:
+        raise errors.Conflict("This submission was not launched from an LMS, so it has no grade to post")
+    posted = lti.post_grade(submission.full_score(), submission.full_status(),
+                            endpoint=submission.endpoint, submission_id=submission.id)
+    return jsonify({'success': posted})
+
+
+@current_app.route('/v1/lti/grade_queue', methods=['GET'])
+def lti_grade_queue():
+    """
+    Report the grade passback queue's counters and the current queue size. Only
+    available to metrics clients (see `controllers.metrics.is_metrics_client`).
+    :return:
+    """
+    from models.grade_passback import GradePassback
+    if not is_metrics_client():
+        abort(404)
+    return jsonify({'metrics': grade_queue.get_metrics(),
+                    'statuses': GradePassback.count_by_status()})
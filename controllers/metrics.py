@@ -0,0 +1,302 @@
+"""
+Request latency metrics, in the Prometheus text format.
+
+Every request's duration is counted in a fixed-bucket histogram for its endpoint,
+method and status code, and its time is split into database time (the time spent
+executing statements, timed at the cursor whether or not `SQL_INSTRUMENTATION` is
+on) and the rest (app time). The number of requests currently being handled is
+tracked per endpoint.
+
+The reports are only served to callers that present the `METRICS_TOKEN` (in the
+`X-Metrics-Token` header) if one is configured, or else to the `METRICS_ALLOWED_ADDRS`. Behind
+a reverse proxy, every caller seems to come from the proxy's address, so either set
+a token or set `PROXY_FIX_X_FOR` to the number of trusted proxies.
+
+When running several worker processes (e.g., gunicorn), set `METRICS_MULTIPROC_DIR`
+to a directory shared by the workers: each worker periodically writes a snapshot of
+its metrics there, and whichever worker answers the scrape adds them all up.
+"""
+import atexit
+import hmac
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+from flask import Flask, Response, abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#: The upper bounds (in seconds) of the latency histogram's buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#: The header that metrics clients present the `METRICS_TOKEN` in
+TOKEN_HEADER = 'X-Metrics-Token'
+
+
+class Series:
+    """ The histogram and time split for one (endpoint, method, status). """
+    __slots__ = ('counts', 'total', 'count', 'db_time', 'app_time')
+
+    def __init__(self, buckets: int):
+        # One more than the buckets, for the +Inf bucket
+        self.counts = [0] * (buckets + 1)
+        self.total = 0.0
+        self.count = 0
+        self.db_time = 0.0
+        self.app_time = 0.0
+
+    def merge(self, counts: List[int], total: float, count: int, db_time: float, app_time: float):
+        for index, value in enumerate(counts):
+            self.counts[index] += value
+        self.total += total
+        self.count += count
+        self.db_time += db_time
+        self.app_time += app_time
+
+    def dump(self) -> list:
+        return [self.counts, self.total, self.count, self.db_time, self.app_time]
+
+
+class RequestMetrics:
+    """
+    The metrics of this process. There is one of these per app, in
+    `app.extensions['metrics']`.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, multiprocess_dir: str = None, flush_interval: float = 5.0):
+        self.buckets = tuple(sorted(buckets))
+        self.series: Dict[Tuple[str, str, str], Series] = {}
+        self.in_flight: Dict[str, int] = {}
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval = flush_interval
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+
+    def start(self, endpoint: str):
+        with self._lock:
+            self.in_flight[endpoint] = self.in_flight.get(endpoint, 0) + 1
+
+    def finish(self, endpoint: str, method: str, status: int, duration: float, db_time: float):
+        """ Record a finished request. """
+        bucket = bisect_left(self.buckets, duration)
+        key = (endpoint, method, str(status))
+        with self._lock:
+            self.in_flight[endpoint] -= 1
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = Series(len(self.buckets))
+            series.counts[bucket] += 1
+            series.total += duration
+            series.count += 1
+            series.db_time += db_time
+            series.app_time += max(0.0, duration - db_time)
+        if self.multiprocess_dir and time.monotonic() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'pid': os.getpid(),
+                    'buckets': list(self.buckets),
+                    'series': [list(key) + series.dump() for key, series in self.series.items()],
+                    'in_flight': dict(self.in_flight)}
+
+    def flush(self):
+        """ Write this process's snapshot into the shared directory. """
+        self._last_flush = time.monotonic()
+        path = os.path.join(self.multiprocess_dir, 'metrics_{}.json'.format(os.getpid()))
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.replace(temporary, path)
+
+    def collect(self) -> Tuple[Dict[Tuple[str, str, str], Series], Dict[str, int]]:
+        """
+        Add up the metrics of this process and (if configured) every other process.
+        Counters include processes that have since exited; in-flight gauges only
+        include live processes.
+        """
+        snapshots = [self.snapshot()]
+        if self.multiprocess_dir:
+            snapshots.extend(read_snapshots(self.multiprocess_dir, exclude=os.getpid()))
+        series, in_flight = {}, {}
+        for snapshot in snapshots:
+            if snapshot['buckets'] != list(self.buckets):
+                continue
+            for endpoint, method, status, *values in snapshot['series']:
+                key = (endpoint, method, status)
+                if key not in series:
+                    series[key] = Series(len(self.buckets))
+                series[key].merge(*values)
+            if snapshot['pid'] == os.getpid() or is_alive(snapshot['pid']):
+                for endpoint, value in snapshot['in_flight'].items():
+                    in_flight[endpoint] = in_flight.get(endpoint, 0) + value
+        return series, in_flight
+
+    def render(self) -> str:
+        """ Format all the metrics in the Prometheus text exposition format. """
+        series, in_flight = self.collect()
+        lines = ['# HELP blockpy_request_duration_seconds Time spent handling requests',
+                 '# TYPE blockpy_request_duration_seconds histogram']
+        bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+        for key in sorted(series):
+            labels = format_labels(endpoint=key[0], method=key[1], status=key[2])
+            cumulative = 0
+            for bound, count in zip(bounds, series[key].counts):
+                cumulative += count
+                lines.append('blockpy_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                    labels, bound, cumulative))
+            lines.append('blockpy_request_duration_seconds_sum{{{}}} {}'.format(labels, series[key].total))
+            lines.append('blockpy_request_duration_seconds_count{{{}}} {}'.format(labels, series[key].count))
+        for name, attribute, description in (('db', 'db_time', 'in database queries'),
+                                             ('app', 'app_time', 'outside of database queries')):
+            lines.append('# HELP blockpy_request_{}_seconds_total Time spent {}'.format(name, description))
+            lines.append('# TYPE blockpy_request_{}_seconds_total counter'.format(name))
+            for key in sorted(series):
+                labels = format_labels(endpoint=key[0], method=key[1], status=key[2])
+                lines.append('blockpy_request_{}_seconds_total{{{}}} {}'.format(
+                    name, labels, getattr(series[key], attribute)))
+        lines.append('# HELP blockpy_requests_in_flight Requests currently being handled')
+        lines.append('# TYPE blockpy_requests_in_flight gauge')
+        for endpoint in sorted(in_flight):
+            lines.append('blockpy_requests_in_flight{{{}}} {}'.format(format_labels(endpoint=endpoint),
+                                                                       in_flight[endpoint]))
+        return '\n'.join(lines) + '\n'
+
+
+def read_snapshots(directory: str, exclude: int = None) -> List[dict]:
+    """ Load every process's snapshot from the shared directory. """
+    snapshots = []
+    for name in os.listdir(directory):
+        if not (name.startswith('metrics_') and name.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (OSError, ValueError):
+            continue
+        if snapshot.get('pid') != exclude:
+            snapshots.append(snapshot)
+    return snapshots
+
+
+def is_alive(pid: int) -> bool:
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def format_value(value: float) -> str:
+    return repr(float(value))
+
+
+def format_labels(**labels) -> str:
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('\n', '\\n')
+                                     .replace('"', '\\"'))
+                    for name, value in labels.items())
+
+
+_listening = False
+_listening_lock = threading.Lock()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and '_metrics_db_time' in g:
+        conn.info.setdefault('_metrics_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('_metrics_query_start')
+    if started and has_request_context() and '_metrics_db_time' in g:
+        g._metrics_db_time += time.perf_counter() - started.pop()
+
+
+def _handle_error(context):
+    started = context.connection.info.get('_metrics_query_start') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def _start_request():
+    g._metrics_start = time.perf_counter()
+    g._metrics_db_time = 0.0
+    g._metrics_endpoint = request.endpoint or 'unknown'
+    current_app.extensions['metrics'].start(g._metrics_endpoint)
+
+
+def _record_status(response):
+    g._metrics_status = response.status_code
+    return response
+
+
+def _finish_request(exception=None):
+    started = g.pop('_metrics_start', None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    current_app.extensions['metrics'].finish(g._metrics_endpoint, request.method,
+                                             g.get('_metrics_status', 500),
+                                             duration, g.pop('_metrics_db_time', 0.0))
+
+
+def is_metrics_client() -> bool:
+    """
+    Whether the caller may see the operational reports: by presenting the
+    `METRICS_TOKEN` (in `X-Metrics-Token`, since `Authorization` carries the
+    user's JWT), if one is configured, or else by calling from one of the
+    `METRICS_ALLOWED_ADDRS`.
+    """
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        return hmac.compare_digest(request.headers.get(TOKEN_HEADER, ''), token)
+    return request.remote_addr in current_app.config.get('METRICS_ALLOWED_ADDRS', ())
+
+
+def get_metrics():
+    """
+    Report the metrics in the Prometheus text format. Only available to metrics
+    clients (see `is_metrics_client`).
+    :return:
+    """
+    if not is_metrics_client():
+        abort(404)
+    return Response(current_app.extensions['metrics'].render(), content_type=CONTENT_TYPE)
+
+
+def init_metrics(app: Flask):
+    """
+    Start collecting request metrics, if `METRICS` is set, and expose them at `/metrics`.
+    :param app: The main Flask application
+    """
+    global _listening
+    if not app.config.get('METRICS', False):
+        return
+    with _listening_lock:
+        if not _listening:
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+            event.listen(Engine, 'handle_error', _handle_error)
+            _listening = True
+    multiprocess_dir = app.config.get('METRICS_MULTIPROC_DIR')
+    if multiprocess_dir:
+        os.makedirs(multiprocess_dir, exist_ok=True)
+    metrics = RequestMetrics(app.config.get('METRICS_BUCKETS', DEFAULT_BUCKETS), multiprocess_dir,
+                             app.config.get('METRICS_FLUSH_INTERVAL', 5.0))
+    if multiprocess_dir:
+        atexit.register(metrics.flush)
+    app.extensions['metrics'] = metrics
+    # Run before every other hook, so that they are timed too
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+    app.after_request(_record_status)
+    app.teardown_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', get_metrics, methods=['GET'])
@@ -4,6 +4,10 @@ Common classes and methods for PyLTI module
 """
 
 import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import oauth2
 from oauth2 import STRING_TYPES
@@ -70,6 +74,7 @@ class LTIOAuthServer(oauth2.Server):
         """
         super(LTIOAuthServer, self).__init__(signature_methods)
         self.consumers = consumers
+        self._known_consumers = {}
 
     def lookup_consumer(self, key):
         """
@@ -90,7 +95,10 @@ class LTIOAuthServer(oauth2.Server):
             log.critical(('Consumer %s, is missing secret'
                           'in settings file, and needs correction.'), key)
             return None
-        return oauth2.Consumer(key, secret)
+        known = self._known_consumers.get(key)
+        if known is None or known.secret != secret:
+            known = self._known_consumers[key] = oauth2.Consumer(key, secret)
+        return known
 
     def lookup_cert(self, key):
         """
@@ -143,61 +151,244 @@ class LTIPostMessageException(LTIException):
     pass
 
 
-def _post_patched_request(consumers, lti_key, body,
-                          url, method, content_type):
+def consumers_from_config(app_config):
     """
-    Authorization header needs to be capitalized for some LTI clients
-    this function ensures that header is capitalized
+    Gets consumer's map from app config
 
-    :param body: body of the call
-    :param client: OAuth Client
-    :param url: outcome url
-    :return: response
+    :param app_config: the Flask app's config
+    :return: consumers map
     """
-    # pylint: disable=too-many-locals, too-many-arguments
-    oauth_server = LTIOAuthServer(consumers)
-    oauth_server.add_signature_method(SignatureMethod_HMAC_SHA1_Unicode())
-    lti_consumer = oauth_server.lookup_consumer(lti_key)
-    lti_cert, key_cert = oauth_server.lookup_cert(lti_key)
+    return {
+        app_config.get('CONSUMER_KEY'): {
+            'secret': app_config.get('CONSUMER_KEY_SECRET'),
+            'cert': app_config.get('CONSUMER_KEY_PEM_FILE'),
+            'certkey': app_config.get('CONSUMER_KEY_CERT')
+        }
+    }
 
 
-    secret = lti_consumer.secret
+class LTIConsumerRegistry(object):
+    """
+    Process-wide consumer and signature method registry, built once at
+    startup rather than on every launch.
+    """
 
-    consumer = oauth2.Consumer(key=lti_key, secret=secret)
-    client = oauth2.Client(consumer)
+    def __init__(self, consumers, nonce_cache=None):
+        self.consumers = consumers
+        self.oauth_server = LTIOAuthServer(consumers)
+        self.oauth_server.add_signature_method(
+            SignatureMethod_PLAINTEXT_Unicode())
+        self.oauth_server.add_signature_method(
+            SignatureMethod_HMAC_SHA1_Unicode())
+        self.nonce_cache = nonce_cache
 
-    if lti_cert:
-        client.add_certificate(key=key_cert, cert=lti_cert, domain='')
-        log.debug("cert %s", lti_cert)
-    import httplib2
 
-    http = httplib2.Http
-    # pylint: disable=protected-access
-    normalize = http._normalize_headers
+class MemoryNonceStore(object):
+    """
+    Bounded in-memory nonce storage. Entries are kept in insertion
+    order, so expired entries are evicted from the front; if the store
+    is full, the oldest entries are evicted early.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key, expires, now):
+        """
+        Remember the key until it expires.
 
-    def my_normalize(self, headers):
+        :return: False if the key was already present (a replay)
+        """
+        with self._lock:
+            entries = self._entries
+            while entries:
+                oldest, oldest_expires = next(iter(entries.items()))
+                if oldest_expires > now and len(entries) < self.max_size:
+                    break
+                del entries[oldest]
+            known = entries.get(key)
+            if known is not None and known > now:
+                return False
+            entries[key] = expires
+            return True
+
+
+class NonceCache(object):
+    """
+    Rejects OAuth requests whose nonce has already been used by the same
+    consumer, or whose timestamp is too far from the current time. A nonce
+    only has to be remembered for as long as its timestamp would still be
+    accepted, so storage stays bounded.
+    """
+
+    def __init__(self, store=None, timestamp_threshold=300):
+        self.store = MemoryNonceStore() if store is None else store
+        self.timestamp_threshold = timestamp_threshold
+
+    def check(self, consumer_key, nonce, timestamp, now=None):
+        """
+        Record the nonce, or reject the request.
+
+        :exception: oauth2.Error if the request is a replay
+        """
+        if now is None:
+            now = int(time.time())
+        try:
+            timestamp = int(timestamp)
+        except (TypeError, ValueError):
+            raise oauth2.Error('Invalid timestamp.')
+        if not nonce:
+            raise oauth2.Error('Missing nonce.')
+        if abs(now - timestamp) > self.timestamp_threshold:
+            raise oauth2.Error('Timestamp outside of the allowed window.')
+        expires = max(now, timestamp) + self.timestamp_threshold
+        if not self.store.add(u'{}:{}'.format(consumer_key, nonce), expires, now):
+            raise oauth2.Error('Nonce already used.')
+
+
+class LTIOAuthClient(oauth2.Client):
+    """
+    OAuth client that keeps the Authorization header capitalized, since
+    some LTI clients require that. Being an `httplib2.Http`, it also
+    keeps its connections alive between requests.
+    """
+
+    def _normalize_headers(self, headers):
         """ This function patches Authorization header """
-        ret = normalize(self, headers)
+        ret = super(LTIOAuthClient, self)._normalize_headers(headers)
         if 'authorization' in ret:
             ret['Authorization'] = ret.pop('authorization')
-        log.debug("headers")
-        log.debug(headers)
         return ret
 
-    http._normalize_headers = my_normalize
-    monkey_patch_function = normalize
-    response, content = client.request(
-        url,
-        method,
-        body=body.encode('utf-8'),
-        headers={'Content-Type': content_type})
 
-    http = httplib2.Http
-    # pylint: disable=protected-access
-    http._normalize_headers = monkey_patch_function
-    
+class LTIConnectionPool(object):
+    """
+    A bounded pool of keep-alive OAuth clients for a single consumer.
+    Each client is only used by one thread at a time; at most
+    `max_connections` requests to the consumer are in flight at once.
+    """
+
+    def __init__(self, lti_key, secret, cert=None, certkey=None,
+                 max_connections=8, timeout=30, acquire_timeout=30):
+        # pylint: disable=too-many-arguments
+        self.lti_key = lti_key
+        self.secret = secret
+        self.cert = cert
+        self.certkey = certkey
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._idle = []
+        self._idle_lock = threading.Lock()
+
+    def _new_client(self):
+        """ Create a new signed client for this consumer """
+        consumer = oauth2.Consumer(key=self.lti_key, secret=self.secret)
+        client = LTIOAuthClient(consumer, timeout=self.timeout)
+        if self.cert:
+            client.add_certificate(key=self.certkey, cert=self.cert, domain='')
+            log.debug("cert %s", self.cert)
+        return client
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a client from the pool. Clients that fail mid-request are
+        closed instead of being returned to the pool.
+        """
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise LTIPostMessageException("Timed out waiting for an LTI connection")
+        try:
+            with self._idle_lock:
+                client = self._idle.pop() if self._idle else None
+            if client is None:
+                client = self._new_client()
+            try:
+                yield client
+            except Exception:
+                client.close()
+                raise
+            with self._idle_lock:
+                self._idle.append(client)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """ Close all of the idle connections """
+        with self._idle_lock:
+            idle, self._idle = self._idle, []
+        for client in idle:
+            client.close()
+
+
+#: Settings used for newly created connection pools
+POOL_SETTINGS = {'max_connections': 8, 'timeout': 30, 'acquire_timeout': 30}
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def configure_connection_pools(**settings):
+    """
+    Change the settings (`max_connections`, `timeout`, `acquire_timeout`)
+    for connection pools, closing any existing pools.
+    """
+    POOL_SETTINGS.update(settings)
+    with _connection_pools_lock:
+        pools = list(_connection_pools.values())
+        _connection_pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def get_connection_pool(consumers, lti_key):
+    """
+    Get the shared connection pool for the given consumer, creating it
+    on first use.
+
+    :param consumers: consumers from config
+    :param lti_key: key to find appropriate consumer
+    :return: LTIConnectionPool
+    """
+    consumer = consumers.get(lti_key) or {}
+    secret = consumer.get('secret')
+    if not secret:
+        raise LTIPostMessageException("Unknown LTI consumer")
+    cert = consumer.get('cert')
+    certkey = consumer.get('certkey', cert)
+    identity = (lti_key, secret, cert, certkey)
+    with _connection_pools_lock:
+        pool = _connection_pools.get(identity)
+        if pool is None:
+            pool = LTIConnectionPool(lti_key, secret, cert, certkey, **POOL_SETTINGS)
+            _connection_pools[identity] = pool
+    return pool
+
+
+def _post_patched_request(consumers, lti_key, body,
+                          url, method, content_type):
+    """
+    Authorization header needs to be capitalized for some LTI clients
+    this function ensures that header is capitalized. Requests are made
+    through the consumer's shared, keep-alive connection pool.
+
+    :param body: body of the call
+    :param client: OAuth Client
+    :param url: outcome url
+    :return: response
+    """
+    # pylint: disable=too-many-arguments
+    pool = get_connection_pool(consumers, lti_key)
+    with pool.connection() as client:
+        response, content = client.request(
+            url,
+            method,
+            body=body.encode('utf-8'),
+            headers={'Content-Type': content_type})
+
     log.debug("key %s", lti_key)
-    log.debug("secret %s", secret)
     log.debug("url %s", url)
     log.debug("response %s", response)
     log.debug("content %s", format(content))
@@ -258,7 +449,8 @@ def post_message2(consumers, lti_key, url, body,
     return is_success
 
 
-def verify_request_common(consumers, url, method, headers, params):
+def verify_request_common(consumers, url, method, headers, params,
+                          registry=None):
     """
     Verifies that request is valid
 
@@ -267,8 +459,11 @@ def verify_request_common(consumers, url, method, headers, params):
     :param method: request method
     :param headers: request headers
     :param params: request params
+    :param registry: prebuilt LTIConsumerRegistry; if given, its OAuth
+        server is reused and its nonce cache rejects replayed requests
     :return: is request valid
     """
+    # pylint: disable=too-many-arguments
 
     log.debug("consumers %s", consumers)
     log.debug("url %s", url)
@@ -276,12 +471,9 @@ def verify_request_common(consumers, url, method, headers, params):
     log.debug("headers %s", headers)
     log.debug("params %s", params)
 
-    oauth_server = LTIOAuthServer(consumers)
-    
-    oauth_server.add_signature_method(
-        SignatureMethod_PLAINTEXT_Unicode())
-    oauth_server.add_signature_method(
-        SignatureMethod_HMAC_SHA1_Unicode())
+    if registry is None:
+        registry = LTIConsumerRegistry(consumers)
+    oauth_server = registry.oauth_server
 
     # Check header for SSL before selecting the url
     if headers.get('X-Forwarded-Proto', 'http') == 'https':
@@ -305,6 +497,10 @@ def verify_request_common(consumers, url, method, headers, params):
         if not consumer:
             raise oauth2.Error('Invalid consumer.')
         oauth_server.verify_request(oauth_request, consumer, None)
+        if registry.nonce_cache is not None:
+            registry.nonce_cache.check(oauth_consumer_key,
+                                       oauth_request.get_parameter('oauth_nonce'),
+                                       oauth_request.get_parameter('oauth_timestamp'))
     except oauth2.Error as e:
         print("ERR", e.message)
         # Rethrow our own for nice error handling (don't print
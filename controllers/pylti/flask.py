@@ -13,6 +13,11 @@ from .common import (
     LTI_SESSION_KEY,
     LTI_PROPERTY_LIST,
     LTI_ROLES,
+    consumers_from_config,
+    configure_connection_pools,
+    LTIConsumerRegistry,
+    MemoryNonceStore,
+    NonceCache,
     verify_request_common,
     post_message,
     post_message2,
@@ -22,10 +27,56 @@ from .common import (
     LTINotInSessionException,
     LTIPostMessageException
 )
+from .grade_queue import grade_queue
 
 
 log = logging.getLogger('pylti.flask')  # pylint: disable=invalid-name
 
+def init_lti(app):
+    """
+    Set up the process-wide LTI machinery for the app: the consumer
+    registry, the outcome connection pools and the background grade queue.
+
+    :param app: the Flask app
+    """
+    app.extensions['pylti'] = build_consumer_registry(app)
+    configure_connection_pools(
+        max_connections=app.config.get('PYLTI_POOL_MAX_CONNECTIONS', 8),
+        timeout=app.config.get('PYLTI_POOL_TIMEOUT', 30),
+        acquire_timeout=app.config.get('PYLTI_POOL_ACQUIRE_TIMEOUT', 30))
+    grade_queue.init_app(app)
+
+
+def build_consumer_registry(app):
+    """
+    Build the consumer registry for the app, with a nonce cache using the
+    store chosen by `PYLTI_NONCE_STORE`.
+
+    :param app: the Flask app
+    :return: LTIConsumerRegistry
+    """
+    if app.config.get('PYLTI_NONCE_STORE', 'memory') == 'database':
+        from models.lti_nonce import DatabaseNonceStore
+        store = DatabaseNonceStore()
+    else:
+        store = MemoryNonceStore(app.config.get('PYLTI_NONCE_CACHE_SIZE', 100000))
+    nonce_cache = NonceCache(store, app.config.get('PYLTI_TIMESTAMP_THRESHOLD', 300))
+    return LTIConsumerRegistry(consumers_from_config(app.config), nonce_cache)
+
+
+def get_consumer_registry(app):
+    """
+    Get the app's consumer registry, building it if `init_lti` was not called.
+
+    :param app: the Flask app
+    :return: LTIConsumerRegistry
+    """
+    registry = app.extensions.get('pylti')
+    if registry is None:
+        registry = app.extensions['pylti'] = build_consumer_registry(app)
+    return registry
+
+
 def default_error(exception=None):
     """Render simple error page.  This should be overidden in applications."""
     # pylint: disable=unused-argument
@@ -120,17 +171,14 @@ class LTI:
         Gets consumer's map from app config
         :return: consumers map
         """
-        app_config = self.lti_kwargs['app'].config
-        consumers = {
-            app_config.get('CONSUMER_KEY'): {
-                'secret': app_config.get('CONSUMER_KEY_SECRET'),
-                'cert': app_config.get('CONSUMER_KEY_PEM_FILE'),
-                'certkey': app_config.get('CONSUMER_KEY_CERT')
-            }
-        }
-        #config = app_config.get('PYLTI_CONFIG', dict())
-        #consumers = config.get('consumers', dict())
-        return consumers
+        return self._registry().consumers
+
+    def _registry(self):
+        """
+        Gets the consumer registry of the app
+        :return: LTIConsumerRegistry
+        """
+        return get_consumer_registry(self.lti_kwargs['app'])
 
     @property
     def key(self):  # pylint: disable=no-self-use
@@ -240,9 +288,10 @@ class LTI:
 
         log.debug('verify_request?')
         try:
-            verify_request_common(self._consumers(), flask_request.url,
+            registry = self._registry()
+            verify_request_common(registry.consumers, flask_request.url,
                                   flask_request.method, flask_request.headers,
-                                  params)
+                                  params, registry)
             log.debug('verify_request success')
 
             # All good to go, store all of the LTI params into a
@@ -267,12 +316,15 @@ class LTI:
             session[LTI_SESSION_KEY] = False
             raise
 
-    def post_grade(self, grade, message='', endpoint=None, url=False):
+    def post_grade(self, grade, message='', endpoint=None, url=False, submission_id=None):
         """
-        Post grade to LTI consumer using XML
+        Post grade to LTI consumer using XML. If the grade queue is enabled
+        (`PYLTI_GRADE_QUEUE`), the grade is queued and posted in the background.
 
         :param: grade: 0 <= grade <= 1
-        :return: True if post successful and grade valid
+        :param: submission_id: the submission being graded, used to collapse
+            superseded grades in the queue
+        :return: True if post successful (or queued) and grade valid
         :exception: LTIPostMessageException if call failed
         """
         message_identifier_id = self.message_identifier_id()
@@ -284,6 +336,10 @@ class LTI:
         # # edX devbox fix
         score = float(grade)
         if 0 <= score <= 1.0:
+            if self._use_grade_queue():
+                grade_queue.enqueue(submission_id, lis_result_sourcedid, self.key,
+                                    self.response_url, score, message, url)
+                return True
             xml = generate_request_xml(
                 message_identifier_id, operation, lis_result_sourcedid,
                 score, message, url)
@@ -296,14 +352,18 @@ class LTI:
 
         return False
 
-    def post_grade2(self, grade, user=None, comment=''):
+    def post_grade2(self, grade, user=None, comment='', submission_id=None):
         """
         Post grade to LTI consumer using REST/JSON
         URL munging will is related to:
         https://openedx.atlassian.net/browse/PLAT-281
+        If the grade queue is enabled (`PYLTI_GRADE_QUEUE`), the grade is
+        queued and posted in the background.
 
         :param: grade: 0 <= grade <= 1
-        :return: True if post successful and grade valid
+        :param: submission_id: the submission being graded, used to collapse
+            superseded grades in the queue
+        :return: True if post successful (or queued) and grade valid
         :exception: LTIPostMessageException if call failed
         """
         content_type = 'application/vnd.ims.lis.v2.result+json'
@@ -314,6 +374,10 @@ class LTI:
             "/lti_2_0_result_rest_handler/user/{}".format(user))
         score = float(grade)
         if 0 <= score <= 1.0:
+            if self._use_grade_queue():
+                grade_queue.enqueue(submission_id, str(user), self.key, lti2_url,
+                                    score, comment, format='json')
+                return True
             body = json.dumps({
                 "@context": "http://purl.imsglobal.org/ctx/lis/v2/Result",
                 "@type": "Result",
@@ -329,6 +393,13 @@ class LTI:
 
         return False
 
+    def _use_grade_queue(self):
+        """
+        Whether grades should be posted through the background grade queue
+        :return: bool
+        """
+        return self.lti_kwargs['app'].config.get('PYLTI_GRADE_QUEUE', False)
+
     @staticmethod
     def close_session():
         """
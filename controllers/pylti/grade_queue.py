@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    Background workers that drain the outbound LTI grade queue
+    (the `GradePassback` table), posting grades to the LMS with
+    exponential backoff on failure.
+"""
+import json
+import logging
+import random
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+from flask import Flask
+
+from .common import (
+    post_message,
+    post_message2,
+    generate_request_xml,
+)
+
+log = logging.getLogger('pylti.grade_queue')  # pylint: disable=invalid-name
+
+LTI2_CONTENT_TYPE = 'application/vnd.ims.lis.v2.result+json'
+
+
+class GradeQueue:
+    """
+    Manages a pool of worker threads that repeatedly claim due grades from the
+    queue and post them. Keeps simple in-process counters of what happened, for
+    monitoring.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.metrics = Counter()
+        self._metrics_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._wake = threading.Event()
+        self._threads = []
+
+    def init_app(self, app: Flask):
+        """
+        Attach the queue to the app, and start the workers if the queue is enabled
+        (see the `PYLTI_GRADE_QUEUE` settings).
+        """
+        self.app = app
+        app.extensions['pylti_grade_queue'] = self
+        if app.config.get('PYLTI_GRADE_QUEUE', False) and not app.config.get('TESTING', False):
+            self.start()
+
+    def start(self):
+        """ Start the worker threads. """
+        for index in range(self.app.config.get('PYLTI_GRADE_QUEUE_WORKERS', 2)):
+            thread = threading.Thread(target=self._run, name='pylti-grade-queue-{}'.format(index),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """ Ask the worker threads to finish, and wait for them. """
+        self._stopping.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        """ Let the workers know that there is new work, so they don't wait for the next poll. """
+        self._wake.set()
+
+    def count(self, metric, amount=1):
+        with self._metrics_lock:
+            self.metrics[metric] += amount
+
+    def get_metrics(self) -> dict:
+        """ Report the counters of enqueued, superseded, sent, retried, and failed grades. """
+        with self._metrics_lock:
+            return dict(self.metrics)
+
+    def _run(self):
+        interval = self.app.config.get('PYLTI_GRADE_QUEUE_POLL_INTERVAL', 1.0)
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    processed = self.process_due()
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Grade queue worker failed")
+                processed = 0
+            if not processed:
+                self._wake.wait(interval)
+                self._wake.clear()
+
+    def enqueue(self, submission_id, lis_result_sourcedid, consumer_key, url, score,
+                message="", message_is_url=False, format='xml'):
+        """
+        Record the latest score to post (replacing any unsent older score).
+        :return: The queued GradePassback
+        """
+        from models.grade_passback import GradePassback
+        queued, superseded = GradePassback.enqueue(submission_id, lis_result_sourcedid, consumer_key, url,
+                                                   score, message, message_is_url, format)
+        self.count('enqueued')
+        if superseded:
+            self.count('superseded')
+        self.notify()
+        return queued
+
+    def process_due(self, limit=None) -> int:
+        """
+        Claim and post a batch of due grades. Must be called within an app context.
+        :param limit: The most grades to attempt in this batch
+        :return: How many grades were attempted
+        """
+        from models.grade_passback import GradePassback
+        if limit is None:
+            limit = self.app.config.get('PYLTI_GRADE_QUEUE_BATCH_SIZE', 50)
+        self.release_stalled()
+        attempted = 0
+        for queued in GradePassback.get_due(limit):
+            if not queued.claim():
+                continue
+            attempted += 1
+            self.send(queued)
+        return attempted
+
+    def release_stalled(self):
+        """ Put back any grades that a crashed worker claimed but never finished. """
+        from models.grade_passback import GradePassback, GradePassbackStatuses
+        from models.generics.models import db
+        timeout = self.app.config.get('PYLTI_GRADE_QUEUE_STALL_TIMEOUT', 300)
+        released = (GradePassback.query
+                    .filter(GradePassback.status == GradePassbackStatuses.SENDING,
+                            GradePassback.date_modified < datetime.utcnow() - timedelta(seconds=timeout))
+                    .update({'status': GradePassbackStatuses.PENDING}, synchronize_session=False))
+        db.session.commit()
+        if released:
+            self.count('released', released)
+
+    def send(self, queued):
+        """ Post the claimed grade, then record the outcome. """
+        try:
+            success = self.post(queued)
+            error = "" if success else "LMS did not report success"
+        except Exception as e:  # pylint: disable=broad-except
+            success, error = False, "{}: {}".format(type(e).__name__, e)
+        if success:
+            self.count('sent')
+            if not queued.mark_sent():
+                self.count('sent_superseded')
+            return
+        delay = self.get_backoff(queued.attempts)
+        if delay is None:
+            log.error("Giving up on grade passback %s: %s", queued.id, error)
+            self.count('failed')
+        else:
+            log.info("Grade passback %s failed, retrying in %ss: %s", queued.id, round(delay), error)
+            self.count('retried')
+        queued.mark_failed(error, delay)
+
+    def get_backoff(self, attempts):
+        """
+        Exponential backoff (with jitter) for the next attempt, or None if the grade
+        has already been attempted the maximum number of times.
+        """
+        config = self.app.config
+        if attempts + 1 >= config.get('PYLTI_GRADE_QUEUE_MAX_ATTEMPTS', 8):
+            return None
+        base = config.get('PYLTI_GRADE_QUEUE_BACKOFF', 2.0)
+        ceiling = config.get('PYLTI_GRADE_QUEUE_MAX_BACKOFF', 600.0)
+        delay = min(ceiling, base * (2 ** attempts))
+        return delay * random.uniform(0.5, 1.0)
+
+    def post(self, queued) -> bool:
+        """ Actually send the grade to the LMS, in the appropriate format. """
+        from .flask import get_consumer_registry
+        consumers = get_consumer_registry(self.app).consumers
+        if queued.format == 'json':
+            body = json.dumps({
+                "@context": "http://purl.imsglobal.org/ctx/lis/v2/Result",
+                "@type": "Result",
+                "resultScore": queued.score,
+                "comment": queued.message
+            })
+            return post_message2(consumers, queued.consumer_key, queued.url, body,
+                                 method='PUT', content_type=LTI2_CONTENT_TYPE)
+        xml = generate_request_xml(
+            "edX_fix", 'replaceResult', queued.lis_result_sourcedid,
+            queued.score, queued.message, queued.message_is_url)
+        return post_message(consumers, queued.consumer_key, queued.url, xml)
+
+
+grade_queue = GradeQueue()
@@ -0,0 +1,36 @@
+from flask import g, jsonify
+from flask_rebar import RequestSchema, errors
+from marshmallow import fields
+from marshmallow.validate import OneOf, Range
+
+from controllers.setup import registry, rebar
+from models.search_index import DOCUMENT_KINDS, Query, search
+from models.user import User
+
+
+class SearchSchema(RequestSchema):
+    q = fields.String(required=True)
+    kind = fields.String(validate=OneOf(DOCUMENT_KINDS))
+    assignment_id = fields.Integer()
+    after = fields.Integer()
+    limit = fields.Integer(validate=Range(1, 100))
+
+
+@registry.handles(rule='/courses/<int:course_id>/search', method='GET', query_string_schema=SearchSchema())
+def search_course(course_id: int):
+    """
+    The course's code, feedback, and review comments that match the search `q` (see
+    `Query.parse`), most recent first, with the lines that matched. Pass the returned
+    `next` as `after` for the following page.
+    """
+    user = User.find_student(g.user['email'])
+    if user is None or not user.is_grader(course_id):
+        raise errors.Forbidden("Only the course's graders can see this")
+    args = rebar.validated_args
+    try:
+        query = Query.parse(args['q'])
+    except ValueError as error:
+        raise errors.BadRequest(str(error))
+    documents, after = search(course_id, query, args.get('assignment_id'),
+                              [args['kind']] if 'kind' in args else None, args.get('after'), args.get('limit', 20))
+    return jsonify({'results': [document.encode_json(query) for document in documents], 'next': after})
@@ -0,0 +1,86 @@
+from datetime import datetime, timezone
+
+from flask import g, jsonify
+from flask_rebar import RequestSchema, errors
+from marshmallow import fields
+
+from controllers.conditional import conditional, versioned
+from controllers.setup import registry, rebar
+from models.code_checkpoint import reconstruct
+from models.review import Review, ReviewSchema
+from models.submission import Submission, SubmissionSchema
+from models.user import User
+
+
+def load_visible_submission(submission_id: int):
+    """ The submission, if it exists; only its student and the course's graders may see it. """
+    submission = Submission.by_id(submission_id)
+    if submission is None:
+        return None
+    viewer = User.find_student(g.user['email'])
+    if viewer is None or (viewer.id != submission.user_id and not viewer.is_grader(submission.course_id)):
+        raise errors.Forbidden("You cannot access this submission")
+    return submission
+
+
+def load_visible_review(review_id: int):
+    review = Review.by_id(review_id)
+    if review is None:
+        return None
+    load_visible_submission(review.submission_id)
+    return review
+
+
+@registry.handles(rule='/submissions/<int:submission_id>', method='GET',
+                  response_body_schema=versioned(SubmissionSchema()))
+@conditional(load_visible_submission)
+def get_submission(submission: Submission):
+    return submission
+
+
+class SaveCodeSchema(RequestSchema):
+    code = fields.String(required=True)
+    filename = fields.String(load_default="answer.py")
+
+
+@registry.handles(rule='/submissions/<int:submission_id>/code', method='PUT',
+                  request_body_schema=SaveCodeSchema(), response_body_schema=SubmissionSchema())
+@conditional(load_visible_submission)
+def save_submission_code(submission: Submission):
+    """
+    Save the student's code. Send the ETag of the submission that was edited in
+    If-Match, to be refused (412) rather than overwrite a newer save.
+    """
+    submission.save_code(rebar.validated_body['filename'], rebar.validated_body['code'])
+    return submission
+
+
+class MomentSchema(RequestSchema):
+    at = fields.DateTime(required=True)
+
+
+def get_moment() -> datetime:
+    """ The validated `at` query argument, in naive UTC like the log's dates. """
+    moment = rebar.validated_args['at']
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+@registry.handles(rule='/submissions/<int:submission_id>/code', method='GET', query_string_schema=MomentSchema())
+def get_submission_code(submission_id: int):
+    """
+    The student's files as they were at the given moment (e.g., the deadline), rebuilt
+    from their edits, along with the last edit included.
+    """
+    submission = load_visible_submission(submission_id)
+    if submission is None:
+        raise errors.NotFound("Unknown submission")
+    state = reconstruct(submission.course_id, submission.assignment_id, submission.user_id, get_moment())
+    return jsonify(dict(state.encode_json(), submission_id=submission.id))
+
+
+@registry.handles(rule='/reviews/<int:review_id>', method='GET', response_body_schema=versioned(ReviewSchema()))
+@conditional(load_visible_review)
+def get_review(review: Review):
+    return review
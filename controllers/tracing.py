@@ -0,0 +1,86 @@
+"""
+Records anonymized request traces, which `scripts.loadtest` can replay later to
+reproduce the load of a real lab session.
+
+Each sampled request becomes one JSON line in `TRACE_RECORD_PATH`. Only the shape
+of the request is kept: when it arrived, its method and URL rule (not the actual
+path, so no ids or names), the names of its query parameters, the sizes and types
+of its body and response, its status, and how long it took. No payloads, cookies,
+or user identities are recorded.
+"""
+import atexit
+import json
+import random
+import threading
+import time
+
+from flask import Flask, current_app, g, request
+
+
+class TraceRecorder:
+    """
+    Appends trace entries to a JSON-lines file. There is one of these per app,
+    in `app.extensions['trace_recorder']`.
+    """
+
+    def __init__(self, path: str, sample_rate: float = 1.0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', buffering=1)
+
+    def record(self, entry: dict):
+        line = json.dumps(entry, sort_keys=True)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def describe_request(response, started: float, offset: float) -> dict:
+    """ Make the anonymized trace entry for the current request. """
+    rule = request.url_rule.rule if request.url_rule is not None else None
+    return {
+        'offset': round(offset, 6),
+        'method': request.method,
+        'endpoint': request.endpoint,
+        'rule': rule,
+        'query': sorted(request.args.keys()),
+        'content_type': request.mimetype or None,
+        'request_bytes': request.content_length or 0,
+        'status': response.status_code,
+        'response_bytes': response.calculate_content_length() or 0,
+        'duration': round(time.perf_counter() - started, 6)
+    }
+
+
+def _start_request():
+    recorder = current_app.extensions['trace_recorder']
+    if random.random() < recorder.sample_rate:
+        g._trace_started = (time.perf_counter(), time.time() - recorder.started)
+
+
+def _finish_request(response):
+    started = g.pop('_trace_started', None)
+    if started is not None:
+        current_app.extensions['trace_recorder'].record(describe_request(response, *started))
+    return response
+
+
+def init_tracing(app: Flask):
+    """
+    Start recording request traces into `TRACE_RECORD_PATH`, if it is set.
+    :param app: The main Flask application
+    """
+    path = app.config.get('TRACE_RECORD_PATH')
+    if not path:
+        return
+    recorder = app.extensions['trace_recorder'] = TraceRecorder(path, app.config.get('TRACE_SAMPLE_RATE', 1.0))
+    # Flush and close the trace when the process exits
+    atexit.register(recorder.close)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
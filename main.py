@@ -2,6 +2,7 @@ import os
 from flask import Flask
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_jwt_extended import JWTManager
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from api_specs import spec
 
@@ -29,6 +30,11 @@ def create_app(test_config=None) -> Flask:
     # Additional settings being overridden here
     app.config['TEMPLATES_AUTO_RELOAD'] = True
 
+    # Trust the configured number of reverse proxies for the client's address
+    proxies = app.config.get('PROXY_FIX_X_FOR', 0)
+    if proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+
     # Set up the API Spec information
     # TODO: Consider moving this to a static file
     app.config.update({'APISPEC_SPEC': spec})
@@ -67,7 +73,21 @@ def create_app(test_config=None) -> Flask:
 
     # Set up all the endpoints
     with app.app_context():
+        # Per-endpoint SQL query statistics
+        from controllers.instrumentation import init_instrumentation
+        init_instrumentation(app)
+        # Latency histograms, exposed for Prometheus
+        from controllers.metrics import init_metrics
+        init_metrics(app)
+        # Anonymized request traces, for replaying as load tests
+        from controllers.tracing import init_tracing
+        init_tracing(app)
+
         from controllers import create_blueprints
         create_blueprints(app)
 
+        # LTI connection pools and background grade passback
+        from controllers.pylti.flask import init_lti
+        init_lti(app)
+
     return app
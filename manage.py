@@ -57,5 +57,250 @@ def build_api_docs():
         json.dump(docs, f, indent=2)
 
 
+@cli.command('generate_synthetic')
+@click.option('--students', default=30, help="Students to enroll")
+@click.option('--assignments', default=20, help="Assignments to create")
+@click.option('--groups', default=4, help="Assignment groups to spread them across")
+@click.option('--events', default=20000, help="Total log events to create")
+@click.option('--seed', default=0, help="Random seed, for reproducible data")
+def generate_synthetic(students, assignments, groups, events, seed):
+    """
+    Fill the current database with a synthetic course
+    :return:
+    """
+    from scripts.synthetic import generate_course
+    course = generate_course(students, assignments, groups, events, seed=seed)
+    click.echo("Created course {} with {} submissions and {} events".format(
+        course.course_id, len(course.submission_ids), course.events))
+
+
+@cli.command('update_log_summaries')
+@click.option('--chunk-size', default=None, type=int, help="Events to summarize per transaction")
+def update_log_summaries(chunk_size):
+    """
+    Summarize the events logged since the last update, for the analytics dashboards
+    :return:
+    """
+    from models.log_summary import update_summaries
+    click.echo("Summarized {} new events".format(update_summaries(chunk_size)))
+
+
+@cli.command('rebuild_log_summaries')
+@click.option('--chunk-size', default=None, type=int, help="Events to summarize per transaction")
+def rebuild_log_summaries(chunk_size):
+    """
+    Recompute the analytics summaries from the whole event log
+    :return:
+    """
+    from models.log_summary import rebuild_summaries
+    click.echo("Summarized {} events".format(rebuild_summaries(chunk_size)))
+
+
+@cli.command('update_work_sessions')
+@click.option('--assignment', 'assignment_ids', multiple=True, type=int,
+              help="Only update this assignment (may be repeated)")
+@click.option('--workers', default=1, help="Assignments to update at once")
+def update_work_sessions(assignment_ids, workers):
+    """
+    Segment the events logged since the last update into work sessions, for time-on-task
+    :return:
+    """
+    from models.work_session import update_all_sessions
+    consumed = update_all_sessions(list(assignment_ids) or None, workers)
+    click.echo("Segmented {} new events".format(consumed))
+
+
+@cli.command('rebuild_work_sessions')
+@click.option('--assignment', 'assignment_ids', multiple=True, type=int,
+              help="Only rebuild this assignment (may be repeated)")
+@click.option('--workers', default=1, help="Assignments to rebuild at once")
+def rebuild_work_sessions(assignment_ids, workers):
+    """
+    Segment the whole event log into work sessions again
+    :return:
+    """
+    from models.work_session import rebuild_sessions
+    click.echo("Segmented {} events".format(rebuild_sessions(list(assignment_ids) or None, workers)))
+
+
+@cli.command('update_code_checkpoints')
+@click.option('--assignment', 'assignment_ids', multiple=True, type=int,
+              help="Only update this assignment (may be repeated)")
+@click.option('--workers', default=1, help="Assignments to update at once")
+def update_code_checkpoints(assignment_ids, workers):
+    """
+    Checkpoint students' code from the edits logged since the last update
+    :return:
+    """
+    from models.code_checkpoint import update_all_checkpoints
+    consumed = update_all_checkpoints(list(assignment_ids) or None, workers)
+    click.echo("Checkpointed {} new edits".format(consumed))
+
+
+@cli.command('rebuild_code_checkpoints')
+@click.option('--assignment', 'assignment_ids', multiple=True, type=int,
+              help="Only rebuild this assignment (may be repeated)")
+@click.option('--workers', default=1, help="Assignments to rebuild at once")
+def rebuild_code_checkpoints(assignment_ids, workers):
+    """
+    Checkpoint students' code from the whole event log again
+    :return:
+    """
+    from models.code_checkpoint import rebuild_checkpoints
+    click.echo("Checkpointed {} edits".format(rebuild_checkpoints(list(assignment_ids) or None, workers)))
+
+
+@cli.command('index_code_similarity')
+@click.argument('course_id', type=int)
+@click.option('--assignment', 'assignment_ids', multiple=True, type=int,
+              help="Only index this assignment (may be repeated)")
+def index_code_similarity(course_id, assignment_ids):
+    """
+    Sign the course's submissions that are not in the code similarity index yet
+    :return:
+    """
+    from models.code_similarity import index_course
+    click.echo("Indexed {} submissions".format(index_course(course_id, list(assignment_ids) or None)))
+
+
+@cli.command('index_search')
+@click.argument('course_id', type=int)
+@click.option('--assignment', 'assignment_ids', multiple=True, type=int,
+              help="Only index this assignment (may be repeated)")
+def index_search(course_id, assignment_ids):
+    """
+    Add the course's code, feedback, and review comments that are not in the search index yet
+    :return:
+    """
+    from models.search_index import index_course
+    click.echo("Indexed {} documents".format(index_course(course_id, list(assignment_ids) or None)))
+
+
+@cli.command('benchmark')
+@click.option('--database', default=None,
+              help="Database URI to benchmark against (defaults to a fresh temporary SQLite file)")
+@click.option('--students', default=30, help="Students to enroll")
+@click.option('--assignments', default=20, help="Assignments to create")
+@click.option('--groups', default=4, help="Assignment groups to spread them across")
+@click.option('--events', default=20000, help="Total log events to create")
+@click.option('--seed', default=0, help="Random seed, for reproducible data")
+@click.option('--repeat', default=3, help="Runs of each benchmark")
+@click.option('--only', multiple=True, help="Only run the named benchmark (may be repeated)")
+@click.option('--output', default=None, help="File to write the JSON results to (defaults to stdout)")
+def benchmark(database, students, assignments, groups, events, seed, repeat, only, output):
+    """
+    Time the hot paths against a synthetic course, and report the results as JSON
+    :return:
+    """
+    import tempfile
+    from models.generics.models import db
+    from scripts.synthetic import generate_course
+    from scripts.benchmarks import describe_environment, run_benchmarks
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app('testing')
+        app.config['SQLALCHEMY_DATABASE_URI'] = database or 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        with app.app_context():
+            db.create_all()
+            click.echo("Generating synthetic course", err=True)
+            course = generate_course(students, assignments, groups, events, seed=seed)
+            click.echo("Running benchmarks", err=True)
+            results = {'environment': describe_environment(course),
+                       'results': run_benchmarks(course, repeat, list(only), seed)}
+            db.session.remove()
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        click.echo(json.dumps(results, indent=2))
+
+
+@cli.command('benchmark_sqlite')
+@click.option('--writers', default=8, help="Threads autosaving at once")
+@click.option('--operations', default=50, help="Autosaves per writer")
+@click.option('--readers', default=2, help="Threads loading histories meanwhile")
+def benchmark_sqlite(writers, operations, readers):
+    """
+    Compare concurrent autosave throughput on SQLite with and without SQLITE_TUNING
+    :return:
+    """
+    from scripts.benchmarks import compare_sqlite_tuning
+    click.echo(json.dumps(compare_sqlite_tuning(writers, operations, readers), indent=2))
+
+
+@cli.command('seed_trace')
+@click.option('--duration', default=60.0, help="Seconds of traffic to generate")
+@click.option('--rate', default=5.0, help="Average requests per second")
+@click.option('--mix', default=None, help="JSON file describing the kinds of requests (see scripts.loadtest)")
+@click.option('--seed', default=0, help="Random seed, for reproducible traces")
+@click.option('--output', required=True, help="File to write the trace to")
+def seed_trace(duration, rate, mix, seed, output):
+    """
+    Generate a synthetic request trace from a typical mix of lab-session traffic
+    :return:
+    """
+    from scripts.loadtest import save_trace, seed_trace as generate_trace
+    if mix:
+        with open(mix) as f:
+            mix = json.load(f)
+    entries = generate_trace(duration, rate, mix, seed)
+    save_trace(entries, output)
+    click.echo("Wrote {} requests to {}".format(len(entries), output))
+
+
+@cli.command('loadtest', with_appcontext=False)
+@click.argument('trace')
+@click.option('--url', default=None,
+              help="Base URL of a live server (defaults to an in-process app with a synthetic course)")
+@click.option('--speedup', default=1.0, help="How many times faster than recorded to replay")
+@click.option('--concurrency', default=8, help="Most requests in flight at once")
+@click.option('--param', multiple=True, help="Value for a URL rule variable, as name=value (may be repeated)")
+@click.option('--header', multiple=True, help="Header to send with every request, as 'Name: value' (may be repeated)")
+@click.option('--students', default=30, help="Students to enroll in the in-process synthetic course")
+@click.option('--events', default=5000, help="Log events to create in the in-process synthetic course")
+@click.option('--seed', default=0, help="Random seed, for a reproducible synthetic course")
+@click.option('--output', default=None, help="File to write the JSON report to (defaults to stdout)")
+def loadtest(trace, url, speedup, concurrency, param, header, students, events, seed, output):
+    """
+    Replay a request trace, and report latencies and errors as JSON
+    :return:
+    """
+    import tempfile
+    from flask_jwt_extended import create_access_token
+    from models.generics.models import db
+    from models.user import User
+    from scripts.synthetic import generate_course
+    from scripts.loadtest import FlaskTarget, HttpTarget, check_rules, course_params, load_trace, replay
+    params = dict(pair.split('=', 1) for pair in param)
+    headers = dict((part.strip() for part in pair.split(':', 1)) for pair in header)
+    entries = load_trace(trace)
+    # Without the CLI's own app context, this is the first app, so every route is registered with it
+    app = create_app('testing')
+    try:
+        check_rules(entries, app.url_map)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if url:
+        report = replay(entries, HttpTarget(url, headers=headers), speedup, concurrency, params)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'loadtest.db')
+            with app.app_context():
+                db.create_all()
+                click.echo("Generating synthetic course", err=True)
+                course = generate_course(students, 10, 2, events, seed=seed)
+                params = dict(course_params(course), **params)
+                # Requests come from the course's instructor, who may use every endpoint in the mix
+                instructor = User.query.get(course.instructor_id)
+                headers.setdefault('Authorization', 'Bearer ' + create_access_token(
+                    identity={'email': instructor.email, 'first_name': instructor.first_name}))
+                db.session.remove()
+            report = replay(entries, FlaskTarget(app, headers), speedup, concurrency, params)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        click.echo(json.dumps(report, indent=2))
+
+
 if __name__ == '__main__':
     cli()
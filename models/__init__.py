@@ -17,6 +17,14 @@ from models.review import Review, ReviewSchema
 from models.submission import Submission, SubmissionSchema
 from models.sample_submission import SampleSubmission, SampleSubmissionSchema
 from models.grader import Grader, GraderSchema
+from models.gradebook import Gradebook
+from models.grade_passback import GradePassback, GradePassbackSchema
+from models.lti_nonce import LtiNonce, DatabaseNonceStore
+from models.log_summary import LogSummary, LogWatermark
+from models.work_session import WorkSession
+from models.code_checkpoint import CodeCheckpoint
+from models.code_similarity import CodeSignature, CodeBand
+from models.search_index import SearchDocument, SearchTrigram
 
 
 def init_database(app: Flask) -> Flask:
@@ -2,22 +2,44 @@
 Model for Assignment table.
 """
 
-from ipaddress import ip_address, ip_network
 from hmac import compare_digest
 import json
+import os
 from typing import Tuple, List, Optional, Any
 
-from sqlalchemy import Column, String, Text, Integer, ForeignKey, UniqueConstraint, Boolean
+from flask import current_app
+from sqlalchemy import Column, String, Text, Integer, ForeignKey, UniqueConstraint, Boolean, func
 from werkzeug.utils import secure_filename
 from slugify import slugify
 
 import models
+from common.caching import LRUCache, make_cache
 from common.dates import datetime_to_string
 from common.databases import optional_encoded_field
+from common.ip_ranges import IpRangePolicy
 from models.generics.models import db, ma
 from models.generics.base import Base
 
 
+#: Compiled IP access policies, keyed by (assignment id, version)
+_ACCESS_POLICIES = LRUCache(max_size=2048)
+
+
+def get_editor_cache():
+    """
+    The current app's cache of encoded assignments for the editor (see
+    `Assignment.encode_json_for_editor`), created from its configuration when first needed.
+    """
+    cache = current_app.extensions.get('editor_cache')
+    if cache is None:
+        config = current_app.config
+        directory = config.get('EDITOR_CACHE_DIR') or os.path.join(current_app.instance_path, 'editor_cache')
+        cache = make_cache(config.get('EDITOR_CACHE_BACKEND', 'memory'), config.get('EDITOR_CACHE_SIZE', 512),
+                           directory)
+        current_app.extensions['editor_cache'] = cache
+    return cache
+
+
 class Assignment(Base):
     """
     An Assignment is one of the most core tables, representing an individual BlockPy problem.
@@ -62,7 +84,7 @@ class Assignment(Base):
     forked_version = Column(Integer(), nullable=True)
     owner_id = Column(Integer(), ForeignKey('user.id'))
     course_id = Column(Integer(), ForeignKey('course.id'))
-    group_id = Column(Integer(), ForeignKey('group.id'), nullable=True)
+    group_id = Column(Integer(), ForeignKey('assignment_group.id'), nullable=True)
     group_key = Column(String())
     version = Column(Integer(), default=0)
 
@@ -86,6 +108,13 @@ class Assignment(Base):
                             "^starting_code.py", "!assignment_settings.blockpy", "!instructions.md",
                             "#extra_instructor_files.blockpy", "#extra_starting_files.blockpy")
 
+    #: The fields of `encode_json` that only graders may see: the grading code, the
+    #: instructor's files, and the access restrictions
+    INSTRUCTOR_ONLY_FIELDS = ('on_run', 'on_change', 'on_eval', 'extra_instructor_files', 'ip_ranges',
+                              'sample_submissions')
+    #: The keys of `settings` that only graders may see
+    INSTRUCTOR_ONLY_SETTINGS = ('passcode',)
+
     def encode_json(self, use_owner=True) -> dict:
         """
         Create a JSON representation of this object using the most recent schema version.
@@ -159,14 +188,31 @@ class Assignment(Base):
             return secure_filename(self.name) + extension
 
     @staticmethod
-    def get_available() -> 'List[Tuple[models.Assignment, models.AssignmentGroup]]':
-        """ Get all the assignments in the course (along with their first Group) """
-        assignments = Assignment.query.all()
-        return [(assignment, (models.AssignmentGroup.query
-                              .filter(models.AssignmentGroup.id == models.AssignmentGroupMembership.assignment_group_id,
-                                      assignment.id == models.AssignmentGroupMembership.assignment_id)
-                              .first()))
-                for assignment in assignments]
+    def get_available(course_id: int = None, page_offset: int = None,
+                      page_limit: int = None) -> 'List[Tuple[models.Assignment, models.AssignmentGroup]]':
+        """ Get all the assignments (optionally just for one course), along with their first Group.
+        The first group is resolved in the same query, by joining against each assignment's
+        earliest membership. """
+        membership = models.AssignmentGroupMembership
+        first_memberships = (db.session.query(membership.assignment_id.label('assignment_id'),
+                                              func.min(membership.id).label('membership_id'))
+                             .join(models.AssignmentGroup,
+                                   models.AssignmentGroup.id == membership.assignment_group_id)
+                             .group_by(membership.assignment_id)
+                             .subquery())
+        query = (db.session.query(Assignment, models.AssignmentGroup)
+                 .outerjoin(first_memberships, first_memberships.c.assignment_id == Assignment.id)
+                 .outerjoin(membership, membership.id == first_memberships.c.membership_id)
+                 .outerjoin(models.AssignmentGroup,
+                            models.AssignmentGroup.id == membership.assignment_group_id))
+        if course_id is not None:
+            query = query.filter(Assignment.course_id == course_id)
+        query = query.order_by(Assignment.id)
+        if page_offset is not None:
+            query = query.offset(page_offset)
+        if page_limit is not None:
+            query = query.limit(page_limit)
+        return query.all()
 
     @staticmethod
     # TODO: Rename parameter `type` to be `assignment_type`, or ditch it and provide a custom function
@@ -197,6 +243,16 @@ class Assignment(Base):
         """ Determine if the given assignment belongs to the given course. """
         return Assignment.query.get(assignment_id).course_id == course_id
 
+    def is_used_by(self, course_id: int) -> bool:
+        """ Whether the course owns this assignment, or has it in one of its groups. """
+        if course_id == self.course_id:
+            return True
+        membership, group = models.AssignmentGroupMembership, models.AssignmentGroup
+        return db.session.query(membership.query
+                                .join(group, group.id == membership.assignment_group_id)
+                                .filter(membership.assignment_id == self.id, group.course_id == course_id)
+                                .exists()).scalar()
+
     @staticmethod
     def by_course(course_id: int, exclude_maze=True) -> 'List[models.Assignment]':
         """ Get all of the assignments that belong to the given course. """
@@ -266,13 +322,52 @@ class Assignment(Base):
     def for_editor(self, user_id: int, course_id: int) -> dict:
         """ Returns a JSON version of this assignment, including the submission. """
         # Trust the user for now that they belong here, and give them a submission
-        submission = (None if user_id is None else
-                      self.load_or_new_submission(user_id, course_id).encode_json())
+        submission = None if user_id is None else self.load_or_new_submission(user_id, course_id)
+        return self.for_editor_with(submission)
+
+    def for_editor_with(self, submission: 'Optional[models.Submission]', owner: 'models.User' = None,
+                        for_grader: bool = True) -> dict:
+        """
+        Returns a JSON version of this assignment, including the given submission.
+        :param submission: The student's submission (or None)
+        :param owner: The submission's user, if already known (saves looking up their email)
+        :param for_grader: Whether to include the fields that only graders may see
+        """
         return {
-            'assignment': self.encode_json(),
-            'submission': submission,
+            'assignment': self.encode_json_for_editor(for_grader),
+            'submission': None if submission is None else submission.encode_json(owner or True),
         }
 
+    def encode_json_for_editor(self, for_grader: bool = True) -> dict:
+        """
+        The `encode_json` of this assignment (or, if not `for_grader`, its
+        `encode_json_for_student`), from a read-through cache. Every student
+        loads the same assignment, so it is only encoded once per version: the key
+        includes the version and modification date, so edits never see a stale copy.
+        (Changes to the assignment's tags or sample submissions, which do not modify
+        the assignment itself, are only picked up when it is next modified.)
+        The result is shared, so it must not be modified.
+        """
+        cache = get_editor_cache()
+        key = (self.id, self.version, str(self.date_modified), for_grader)
+        encoded = cache.get(key)
+        if encoded is None:
+            encoded = self.encode_json() if for_grader else self.encode_json_for_student()
+            cache.set(key, encoded)
+        return encoded
+
+    def encode_json_for_student(self) -> dict:
+        """ The `encode_json` of this assignment, without the fields and settings that only graders may see. """
+        encoded = self.encode_json()
+        for field in self.INSTRUCTOR_ONLY_FIELDS:
+            del encoded[field]
+        if self.settings:
+            settings = json.loads(self.settings)
+            for key in self.INSTRUCTOR_ONLY_SETTINGS:
+                settings.pop(key, None)
+            encoded['settings'] = json.dumps(settings)
+        return encoded
+
     def save_file(self, filename: str, code: str):
         """ Update the assignment with the new settings. Modifies the appropriate "file" intelligently
         based on the fields."""
@@ -314,29 +409,17 @@ class Assignment(Base):
         :param ip: String of IP Network Ranges or None
         :return: bool
         """
-        ranges = self.ip_ranges
-        if ranges is None or not ranges.strip():
-            return True
-        ranges = ranges.split(",")
-        try:
-            needle = ip_address(ip)
-        except ValueError:
-            return False
-        allowed, blacklisted, whitelisted = False, False, False
-        for network in ranges:
-            network = network.strip()
-            if not network:
-                continue
-            try:
-                if network.startswith("^") and needle in ip_network(network[1:]):
-                    blacklisted = True
-                if network.startswith("!") and needle in ip_network(network[1:]):
-                    whitelisted = True
-                elif needle in ip_network(network):
-                    allowed = True
-            except ValueError:
-                continue
-        return whitelisted or (not blacklisted and allowed)
+        return self.get_access_policy().is_allowed(ip)
+
+    def get_access_policy(self) -> IpRangePolicy:
+        """ Retrieves the compiled version of this assignment's `ip_ranges`, cached
+        by the assignment's id and version. """
+        key = (self.id, self.version)
+        policy = _ACCESS_POLICIES.get(key)
+        if policy is None or policy.source != self.ip_ranges:
+            policy = IpRangePolicy(self.ip_ranges)
+            _ACCESS_POLICIES.set(key, policy)
+        return policy
 
     def get_setting(self, key: str, default_value=None) -> Any:
         """ Retrieves the given value from the special `settings` field. """
@@ -5,8 +5,8 @@ from werkzeug.utils import secure_filename
 
 import models
 from models.generics.models import db, ma
+from models.generics.serializers import encode, register_encoder
 from models.generics.base import Base
-from common.dates import datetime_to_string
 from typing import List
 
 
@@ -29,19 +29,7 @@ class AssignmentGroup(Base):
         return '<Group {} in {} ({})>'.format(self.name, self.course_id, self.url)
 
     def encode_json(self):
-        user = models.User.query.get(self.owner_id)
-        return {'_schema_version': 2,
-                'name': self.name,
-                'url': self.url,
-                'forked_id': self.forked_id,
-                'forked_version': self.forked_version,
-                'owner_id': self.owner_id,
-                'owner_id__email': user.email if user else '',
-                'course_id': self.course_id,
-                'position': self.position,
-                'id': self.id,
-                'date_modified': datetime_to_string(self.date_modified),
-                'date_created': datetime_to_string(self.date_created)}
+        return encode(self)
 
     SCHEMA_V1_IGNORE_COLUMNS = Base.SCHEMA_V1_IGNORE_COLUMNS + ('owner_id__email',)
     SCHEMA_V2_IGNORE_COLUMNS = Base.SCHEMA_V2_IGNORE_COLUMNS + ('owner_id__email',)
@@ -131,10 +119,16 @@ class AssignmentGroup(Base):
                        .all())
 
     def get_select_url(self, menu):
+        return AssignmentGroup.select_url(self.id, self.url, menu)
+
+    @staticmethod
+    def select_url(assignment_group_id, assignment_group_url, menu):
         # TODO: Refactor web logic outside of model?
-        if self.url:
-            return url_for('assignments.load', assignment_group_url=self.url, _external=True, embed=menu == 'embed')
-        return url_for('assignments.load', assignment_group_id=self.id, _external=True, embed=menu == 'embed')
+        if assignment_group_url:
+            return url_for('assignments.load', assignment_group_url=assignment_group_url,
+                           _external=True, embed=menu == 'embed')
+        return url_for('assignments.load', assignment_group_id=assignment_group_id,
+                       _external=True, embed=menu == 'embed')
 
     def get_filename(self):
         if self.url:
@@ -143,6 +137,9 @@ class AssignmentGroup(Base):
             return secure_filename(self.name) + ".json"
 
 
+register_encoder(AssignmentGroup, ('name', 'url', 'forked_id', 'forked_version', 'owner_id',
+                                   'owner_id__email', 'course_id', 'position', 'id',
+                                   'date_modified', 'date_created'), schema_version=2)
 
 
 class GroupSchema(ma.SQLAlchemyAutoSchema):
@@ -26,15 +26,13 @@ class AssignmentGroupMembership(Base):
 
     @classmethod
     def get_existing(cls, data):
-        group_url = data['assignment_group_url']
-        assignment_url = data['assignment_url']
-        assignment = Assignment.by_url(assignment_url)
-        group = AssignmentGroup.by_url(group_url)
-        if not assignment or not group:
+        # The urls have already been stripped by `decode_json`, but the caller
+        # provides the remapped ids of the assignment and group.
+        if data.get('assignment_group_id') is None or data.get('assignment_id') is None:
             return None
         return (AssignmentGroupMembership.query
-                .filter_by(assignment_group_id=group.id,
-                           assignment_id=assignment.id)
+                .filter_by(assignment_group_id=data['assignment_group_id'],
+                           assignment_id=data['assignment_id'])
                 .first())
 
     def __str__(self):
@@ -0,0 +1,266 @@
+"""
+Point-in-time reconstruction of students' code, e.g. "as of the deadline".
+
+Every edit event (see `CODE_STATE_UPDATE_EVENT_TYPES`) carries the new contents of
+one file, so the code at any moment is each file's last edit before it, just as
+`to_progsnap_event` tracks it. Rather than replaying a student's whole history, a
+`CodeCheckpoint` of all their files is stored every `CODE_CHECKPOINT_INTERVAL`
+edits, so that a lookup costs one indexed seek for the latest checkpoint before the
+moment, plus a replay of at most that many edits after it.
+
+Checkpoints are written by `update_checkpoints`, which consumes each assignment's
+new edits since its watermark. Reconstruction never depends on them being up to
+date: edits since the latest checkpoint are always replayed.
+"""
+import json
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from flask import current_app, has_app_context
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Index, Text, and_, func, or_
+
+from models.generics.models import db
+from models.generics.streaming import get_chunk_size, stream, stream_columns
+from models.log import Log, CODE_STATE_UPDATE_EVENT_TYPES
+from models.log_summary import LogWatermark, for_each_assignment, get_settled_cutoff
+
+#: Edits between checkpoints, unless `CODE_CHECKPOINT_INTERVAL` is configured
+DEFAULT_INTERVAL = 50
+
+#: The columns of the edit events that code is reconstructed from
+EDIT_COLUMNS = ('id', 'date_created', 'course_id', 'assignment_id', 'subject_id', 'file_path', 'message')
+
+CodeKey = Tuple[Optional[int], int, int]
+
+
+def get_interval(interval: int = None) -> int:
+    if interval:
+        return interval
+    if has_app_context():
+        return current_app.config.get('CODE_CHECKPOINT_INTERVAL', DEFAULT_INTERVAL)
+    return DEFAULT_INTERVAL
+
+
+def get_watermark_name(assignment_id: int) -> str:
+    return 'code_checkpoint:{}'.format(assignment_id)
+
+
+def _after(moment: datetime, log_id: int):
+    """ The criterion for events after the given one, in (date_created, id) order. """
+    return or_(Log.date_created > moment, and_(Log.date_created == moment, Log.id > log_id))
+
+
+class CodeState(NamedTuple):
+    #: The contents of each file, by its path
+    files: Dict[str, str]
+    #: The last edit included, if any
+    log_id: Optional[int]
+    moment: Optional[datetime]
+    #: How many edits were included, in total
+    edits: int
+
+    def edited(self, event) -> 'CodeState':
+        files = dict(self.files)
+        files[event.file_path or ""] = event.message
+        return CodeState(files, event.id, event.date_created, self.edits + 1)
+
+    def encode_json(self):
+        return {
+            'files': self.files,
+            'log_id': self.log_id,
+            'date': None if self.moment is None else self.moment.isoformat() + 'Z'
+        }
+
+
+#: The code before any edits
+EMPTY = CodeState({}, None, None, 0)
+
+
+class CodeCheckpoint(db.Model):
+    __tablename__ = 'code_checkpoint'
+    id = Column(Integer(), primary_key=True)
+    course_id = Column(Integer(), ForeignKey('course.id'))
+    assignment_id = Column(Integer(), ForeignKey('assignment.id'), nullable=False)
+    subject_id = Column(Integer(), ForeignKey('user.id'), nullable=False)
+    # The last edit included, and when it happened
+    log_id = Column(Integer(), nullable=False)
+    moment = Column(DateTime(), nullable=False)
+    # How many of the student's edits are included, in total
+    edits = Column(Integer(), nullable=False)
+    # JSON encoded contents of each file, by its path
+    files = Column(Text(), nullable=False)
+
+    __table_args__ = (Index('code_checkpoint_lookup_index', "assignment_id", "subject_id", "moment"),)
+
+    def __str__(self):
+        return '<CodeCheckpoint of {} on {} at {}>'.format(self.subject_id, self.assignment_id, self.log_id)
+
+    @staticmethod
+    def of(key: CodeKey, state: CodeState) -> 'CodeCheckpoint':
+        return CodeCheckpoint(course_id=key[0], assignment_id=key[1], subject_id=key[2], log_id=state.log_id,
+                              moment=state.moment, edits=state.edits, files=json.dumps(state.files))
+
+    def to_state(self) -> CodeState:
+        return CodeState(json.loads(self.files), self.log_id, self.moment, self.edits)
+
+    @staticmethod
+    def latest(key: CodeKey, moment: datetime, log_id: int = None) -> Optional['CodeCheckpoint']:
+        """ The student's last checkpoint at or before the moment (and, at that moment, the given edit). """
+        course_id, assignment_id, subject_id = key
+        query = CodeCheckpoint.query.filter(CodeCheckpoint.assignment_id == assignment_id,
+                                            CodeCheckpoint.subject_id == subject_id,
+                                            CodeCheckpoint.course_id == course_id,
+                                            CodeCheckpoint.moment <= moment)
+        if log_id is not None:
+            query = query.filter(or_(CodeCheckpoint.moment < moment, CodeCheckpoint.log_id <= log_id))
+        return query.order_by(CodeCheckpoint.edits.desc()).first()
+
+
+def _edit_criteria(course_id, assignment_id):
+    return [Log.assignment_id == assignment_id, Log.course_id == course_id,
+            Log.event_type.in_(list(CODE_STATE_UPDATE_EVENT_TYPES))]
+
+
+def reconstruct(course_id: int, assignment_id: int, subject_id: int, moment: datetime,
+                log_id: int = None) -> CodeState:
+    """
+    The student's code on the assignment as of the moment.
+    :param course_id: The course the student worked in
+    :param assignment_id: The assignment
+    :param subject_id: The student's user id
+    :param moment: When (in server time, like `Log.date_created`)
+    :param log_id: Only include the edits at exactly `moment` up to this one, if given
+    :return: The files, and the last edit included
+    """
+    key = (course_id, assignment_id, subject_id)
+    checkpoint = CodeCheckpoint.latest(key, moment, log_id)
+    state = EMPTY if checkpoint is None else checkpoint.to_state()
+    criteria = _edit_criteria(course_id, assignment_id) + [Log.subject_id == subject_id, Log.date_created <= moment]
+    if log_id is not None:
+        criteria.append(or_(Log.date_created < moment, Log.id <= log_id))
+    if checkpoint is not None:
+        criteria.append(_after(checkpoint.moment, checkpoint.log_id))
+    edits = (db.session.query(*[getattr(Log, column) for column in EDIT_COLUMNS])
+             .filter(*criteria)
+             .order_by(Log.date_created.asc(), Log.id.asc()))
+    for edit in edits:
+        state = state.edited(edit)
+    return state
+
+
+def reconstruct_assignment(course_id: int, assignment_id: int, moment: datetime) -> Dict[int, CodeState]:
+    """
+    Every student's code on the assignment as of the moment (e.g., its deadline), with
+    one query for their latest checkpoints and one for the edits since them.
+    :return: The code, by the student's user id (for those who had edited it by then)
+    """
+    latest = (db.session.query(CodeCheckpoint.subject_id, func.max(CodeCheckpoint.edits).label('edits'))
+              .filter(CodeCheckpoint.assignment_id == assignment_id, CodeCheckpoint.course_id == course_id,
+                      CodeCheckpoint.moment <= moment)
+              .group_by(CodeCheckpoint.subject_id)
+              .subquery())
+    checkpoints = (CodeCheckpoint.query
+                   .join(latest, and_(CodeCheckpoint.subject_id == latest.c.subject_id,
+                                      CodeCheckpoint.edits == latest.c.edits))
+                   .filter(CodeCheckpoint.assignment_id == assignment_id, CodeCheckpoint.course_id == course_id))
+    states = {checkpoint.subject_id: checkpoint.to_state() for checkpoint in checkpoints}
+    # Only the edits since each student's checkpoint (or all of them, for those without one),
+    # found by joining against the checkpoints rather than listing every student in the query
+    since = checkpoints.with_entities(CodeCheckpoint.subject_id, CodeCheckpoint.moment,
+                                      CodeCheckpoint.log_id).subquery()
+    edits = (db.session.query(*[getattr(Log, column) for column in EDIT_COLUMNS])
+             .outerjoin(since, since.c.subject_id == Log.subject_id)
+             .filter(*_edit_criteria(course_id, assignment_id), Log.subject_id.isnot(None),
+                     Log.date_created <= moment,
+                     or_(since.c.subject_id.is_(None), Log.date_created > since.c.moment,
+                         and_(Log.date_created == since.c.moment, Log.id > since.c.log_id)))
+             .order_by(Log.subject_id.asc(), Log.date_created.asc(), Log.id.asc()))
+    for edit in stream(edits):
+        states[edit.subject_id] = states.get(edit.subject_id, EMPTY).edited(edit)
+    return states
+
+
+def update_checkpoints(assignment_id: int, interval: int = None, chunk_size: int = None,
+                       settle_seconds: float = None) -> int:
+    """
+    Checkpoint the students' code on the assignment every `interval` edits, consuming
+    the edits logged since the last update.
+    :param assignment_id: The assignment whose edits to consume
+    :param interval: Edits between checkpoints (defaults to `CODE_CHECKPOINT_INTERVAL`)
+    :param chunk_size: How many edits to read (and checkpoints to write) at once
+    :param settle_seconds: Leave edits younger than this for the next update
+                           (defaults to `LOG_SUMMARY_SETTLE_SECONDS`)
+    :return: How many edits were consumed
+    """
+    interval, chunk_size = get_interval(interval), get_chunk_size(chunk_size)
+    cutoff = get_settled_cutoff(settle_seconds)
+    watermark = LogWatermark.claim(get_watermark_name(assignment_id))
+    criteria = [Log.assignment_id == assignment_id, Log.subject_id.isnot(None),
+                Log.event_type.in_(list(CODE_STATE_UPDATE_EVENT_TYPES)), Log.date_created <= cutoff]
+    if watermark.moment is not None:
+        criteria.append(_after(watermark.moment, watermark.log_id))
+    edits = stream_columns(Log, EDIT_COLUMNS, *criteria,
+                           order_by=(Log.date_created.asc(), Log.id.asc()), chunk_size=chunk_size)
+    # Each student's code so far, and how many edits it has had since its last checkpoint
+    states: Dict[CodeKey, Tuple[CodeState, int]] = {}
+    written: List[CodeCheckpoint] = []
+    consumed, last = 0, None
+    for last in edits:
+        consumed += 1
+        key = (last.course_id, last.assignment_id, last.subject_id)
+        if key in states:
+            state, pending = states[key]
+        elif watermark.moment is None:
+            state, pending = EMPTY, 0
+        else:
+            state = reconstruct(*key, watermark.moment, watermark.log_id)
+            checkpoint = CodeCheckpoint.latest(key, watermark.moment, watermark.log_id)
+            pending = state.edits - (0 if checkpoint is None else checkpoint.edits)
+        state, pending = state.edited(last), pending + 1
+        if pending >= interval:
+            written.append(CodeCheckpoint.of(key, state))
+            pending = 0
+        states[key] = state, pending
+        if len(written) >= chunk_size:
+            _write_checkpoints(written)
+            written = []
+    _write_checkpoints(written)
+    if last is not None:
+        watermark.moment, watermark.log_id = last.date_created, last.id
+    db.session.commit()
+    return consumed
+
+
+def _write_checkpoints(checkpoints: Sequence[CodeCheckpoint]):
+    """ Save the checkpoints, and stop tracking them so that memory stays bounded. """
+    db.session.add_all(checkpoints)
+    db.session.flush()
+    for checkpoint in checkpoints:
+        db.session.expunge(checkpoint)
+
+
+def update_all_checkpoints(assignment_ids: Sequence[int] = None, workers: int = 1, **options) -> int:
+    """
+    Bring the checkpoints of every assignment (or the given ones) up to date.
+    :param options: Passed on to `update_checkpoints`
+    :return: How many edits were consumed
+    """
+    return for_each_assignment(update_checkpoints, assignment_ids, workers, **options)
+
+
+def rebuild_checkpoints(assignment_ids: Sequence[int] = None, workers: int = 1, **options) -> int:
+    """
+    Throw away the checkpoints of every assignment (or the given ones) and write them again.
+    :return: How many edits were consumed
+    """
+    checkpoints, watermarks = CodeCheckpoint.query, LogWatermark.query
+    if assignment_ids is None:
+        watermarks = watermarks.filter(LogWatermark.name.like(get_watermark_name('%')))
+    else:
+        checkpoints = checkpoints.filter(CodeCheckpoint.assignment_id.in_(assignment_ids))
+        watermarks = watermarks.filter(LogWatermark.name.in_([get_watermark_name(assignment_id)
+                                                              for assignment_id in assignment_ids]))
+    checkpoints.delete(synchronize_session=False)
+    watermarks.delete(synchronize_session=False)
+    db.session.commit()
+    return update_all_checkpoints(assignment_ids, workers, **options)
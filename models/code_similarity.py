@@ -0,0 +1,213 @@
+"""
+An index of similar code across each assignment's submissions, for spotting copying
+without exporting every submission and comparing every pair offline.
+
+Whenever a submission's code is saved, its MinHash signature (see `common.minhash`)
+is stored, along with its LSH bucket in each band. Similar submissions then share a
+bucket, so the candidate pairs of an assignment are found with one indexed
+self-join of the buckets, in time roughly linear in the number of submissions, and
+only those candidates have their signatures compared.
+
+Submissions whose code is blank or still the assignment's starting code are left
+out, since they would all match each other.
+"""
+import hashlib
+from array import array
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from flask import current_app, has_app_context
+from sqlalchemy import Column, Integer, SmallInteger, BigInteger, String, LargeBinary, ForeignKey, Index
+from sqlalchemy.orm import aliased
+
+import models
+from common.minhash import band_buckets, clusters, code_signature, similarity
+from models.generics.models import db
+from models.generics.streaming import get_chunk_size
+
+#: The estimated similarity above which submissions count as similar, unless
+#: `CODE_SIMILARITY_THRESHOLD` is configured
+DEFAULT_THRESHOLD = 0.7
+
+SimilarPair = Tuple[int, int, float]
+
+
+def get_threshold(threshold: float = None) -> float:
+    if threshold is not None:
+        return threshold
+    if has_app_context():
+        return current_app.config.get('CODE_SIMILARITY_THRESHOLD', DEFAULT_THRESHOLD)
+    return DEFAULT_THRESHOLD
+
+
+def hash_code(code: str) -> str:
+    return hashlib.sha1(code.encode('utf-8')).hexdigest()
+
+
+class CodeSignature(db.Model):
+    __tablename__ = 'code_signature'
+    id = Column(Integer(), primary_key=True)
+    submission_id = Column(Integer(), ForeignKey('submission.id'), nullable=False, unique=True)
+    course_id = Column(Integer(), ForeignKey('course.id'))
+    assignment_id = Column(Integer(), ForeignKey('assignment.id'))
+    # Of the code that was signed, so that unchanged code is not signed again
+    code_hash = Column(String(40), nullable=False)
+    # The MinHash values, as packed unsigned 64-bit integers
+    signature = Column(LargeBinary(), nullable=False)
+
+    def __str__(self):
+        return '<CodeSignature of {}>'.format(self.submission_id)
+
+    def get_values(self) -> array:
+        values = array('Q')
+        values.frombytes(self.signature)
+        return values
+
+    @staticmethod
+    def load_values(submission_ids: Iterable[int]) -> Dict[int, array]:
+        """ The signatures of the given submissions, in one query. """
+        submission_ids = list(submission_ids)
+        if not submission_ids:
+            return {}
+        signatures = {}
+        for submission_id, packed in (db.session.query(CodeSignature.submission_id, CodeSignature.signature)
+                                      .filter(CodeSignature.submission_id.in_(submission_ids))):
+            signatures[submission_id] = array('Q')
+            signatures[submission_id].frombytes(packed)
+        return signatures
+
+    @staticmethod
+    def similar_pairs(course_id: int, assignment_id: int, threshold: float = None) -> List[SimilarPair]:
+        """
+        The pairs of the assignment's submissions whose code is similar.
+        :param threshold: The least estimated similarity to include (defaults to `CODE_SIMILARITY_THRESHOLD`)
+        :return: The pairs of submission ids (smaller first), with their similarity, most similar first
+        """
+        first, second = aliased(CodeBand), aliased(CodeBand)
+        candidates = (db.session.query(first.submission_id, second.submission_id)
+                      .filter(first.assignment_id == assignment_id, first.course_id == course_id,
+                              second.assignment_id == assignment_id, second.course_id == course_id,
+                              second.band == first.band, second.bucket == first.bucket,
+                              first.submission_id < second.submission_id)
+                      .distinct()
+                      .all())
+        return _verify(candidates, get_threshold(threshold))
+
+    @staticmethod
+    def similar_to(submission_id: int, threshold: float = None) -> List[SimilarPair]:
+        """ The submissions (of the same assignment) whose code is similar to the given one's. """
+        own, other = aliased(CodeBand), aliased(CodeBand)
+        candidates = (db.session.query(own.submission_id, other.submission_id)
+                      .filter(own.submission_id == submission_id,
+                              other.assignment_id == own.assignment_id, other.course_id == own.course_id,
+                              other.band == own.band, other.bucket == own.bucket,
+                              other.submission_id != submission_id)
+                      .distinct()
+                      .all())
+        return _verify(candidates, get_threshold(threshold))
+
+    @staticmethod
+    def similar_clusters(course_id: int, assignment_id: int, threshold: float = None) -> List[List[int]]:
+        """ Groups of the assignment's submissions linked by similar code, largest first. """
+        return clusters((first, second) for first, second, _ in
+                        CodeSignature.similar_pairs(course_id, assignment_id, threshold))
+
+
+class CodeBand(db.Model):
+    """ The LSH bucket of one band of a submission's signature. """
+    __tablename__ = 'code_band'
+    id = Column(Integer(), primary_key=True)
+    submission_id = Column(Integer(), ForeignKey('submission.id'), nullable=False)
+    course_id = Column(Integer(), ForeignKey('course.id'))
+    assignment_id = Column(Integer(), ForeignKey('assignment.id'))
+    band = Column(SmallInteger(), nullable=False)
+    bucket = Column(BigInteger(), nullable=False)
+
+    __table_args__ = (Index('code_band_bucket_index', "assignment_id", "band", "bucket"),
+                      Index('code_band_submission_index', "submission_id"))
+
+
+def _verify(candidates: Sequence[Tuple[int, int]], threshold: float) -> List[SimilarPair]:
+    """ Compare the signatures of the candidate pairs, keeping those at least as similar as the threshold. """
+    signatures = CodeSignature.load_values({submission_id for pair in candidates for submission_id in pair})
+    pairs = []
+    for first, second in candidates:
+        score = similarity(signatures[first], signatures[second])
+        if score >= threshold:
+            pairs.append((first, second, score))
+    pairs.sort(key=lambda pair: (-pair[2], pair[0], pair[1]))
+    return pairs
+
+
+def _is_indexed(code: Optional[str], starting_code: Optional[str]) -> bool:
+    return bool(code and code.strip()) and code.strip() != (starting_code or "").strip()
+
+
+def _remove(submission_ids: Sequence[int]):
+    CodeBand.query.filter(CodeBand.submission_id.in_(submission_ids)).delete(synchronize_session=False)
+    CodeSignature.query.filter(CodeSignature.submission_id.in_(submission_ids)).delete(synchronize_session=False)
+
+
+def _store(rows: Sequence, existing: Dict[int, str]):
+    """
+    Sign the code of the given submissions (rows with their `id`, `course_id`,
+    `assignment_id`, and `code`), replacing their old signatures and buckets.
+    :param existing: The hash of each submission's currently signed code, to skip unchanged ones
+    """
+    changed = [row for row in rows if existing.get(row.id) != hash_code(row.code)]
+    if not changed:
+        return
+    _remove([row.id for row in changed])
+    signatures, bands = [], []
+    for row in changed:
+        values = code_signature(row.code)
+        signatures.append({'submission_id': row.id, 'course_id': row.course_id, 'assignment_id': row.assignment_id,
+                           'code_hash': hash_code(row.code), 'signature': values.tobytes()})
+        bands.extend({'submission_id': row.id, 'course_id': row.course_id, 'assignment_id': row.assignment_id,
+                      'band': band, 'bucket': bucket}
+                     for band, bucket in enumerate(band_buckets(values)))
+    db.session.execute(CodeSignature.__table__.insert(), signatures)
+    db.session.execute(CodeBand.__table__.insert(), bands)
+
+
+def index_submission(submission):
+    """
+    Bring the submission's signature up to date with its code, as part of the current
+    transaction. Does nothing unless `CODE_SIMILARITY_INDEX` is enabled.
+    """
+    if not current_app.config.get('CODE_SIMILARITY_INDEX', True):
+        return
+    if _is_indexed(submission.code, submission.assignment.starting_code):
+        existing = dict(db.session.query(CodeSignature.submission_id, CodeSignature.code_hash)
+                        .filter(CodeSignature.submission_id == submission.id))
+        _store([submission], existing)
+    else:
+        _remove([submission.id])
+
+
+def index_course(course_id: int, assignment_ids: Sequence[int] = None, chunk_size: int = None) -> int:
+    """
+    Sign every submission of the course (or of the given assignments) whose code is
+    not already signed, e.g. those saved before the index existed, a chunk (and
+    transaction) at a time.
+    :return: How many submissions were looked at
+    """
+    starting_codes = dict(db.session.query(models.Assignment.id, models.Assignment.starting_code))
+    criteria = [models.Submission.course_id == course_id]
+    if assignment_ids is not None:
+        criteria.append(models.Submission.assignment_id.in_(assignment_ids))
+    columns = [models.Submission.id, models.Submission.course_id, models.Submission.assignment_id,
+               models.Submission.code]
+    chunk_size, last_id, total = get_chunk_size(chunk_size), 0, 0
+    while True:
+        chunk = (db.session.query(*columns).filter(*criteria, models.Submission.id > last_id)
+                 .order_by(models.Submission.id).limit(chunk_size).all())
+        if not chunk:
+            return total
+        existing = dict(db.session.query(CodeSignature.submission_id, CodeSignature.code_hash)
+                        .filter(CodeSignature.submission_id.in_([row.id for row in chunk])))
+        indexed = [row for row in chunk if _is_indexed(row.code, starting_codes.get(row.assignment_id))]
+        indexed_ids = {row.id for row in indexed}
+        _remove([row.id for row in chunk if row.id in existing and row.id not in indexed_ids])
+        _store(indexed, existing)
+        db.session.commit()
+        last_id, total = chunk[-1].id, total + len(chunk)
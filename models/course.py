@@ -1,13 +1,31 @@
-from sqlalchemy import Column, String, Integer, ForeignKey, Text, Boolean
+from itertools import count
+from threading import Lock
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import Column, String, Integer, ForeignKey, Text, Boolean, event, func, or_
 from marshmallow import fields
 
 import models
 from models.generics.models import db, ma
+from models.generics.routing import RoutingSession, reporting
+from models.generics.serializers import encode, encode_many, register_encoder
 from models.generics.base import Base
-from common.dates import datetime_to_string, string_to_datetime
+from models.generics.cascades import CascadeStep, cascade_delete
+from common.caching import LRUCache
+from common.jobs import run_in_background
 from models.generics.resources import WithUrl, WithVersion, WithVisibility
 
 
+#: Rendered course navigation trees, keyed by (menu, host, generation, modification watermark)
+_NAVIGATION_TREES = LRUCache(max_size=64)
+#: Bumped whenever this process commits a change to the courses or groups
+_NAVIGATION_GENERATIONS = count(1)
+_navigation_generation = 0
+_navigation_lock = Lock()
+#: Session info key marking a transaction that changed the courses or groups
+_NAVIGATION_CHANGED = 'navigation_changed'
+
+
 class CourseSettingsSchema(ma.Schema):
     enforce_dates = fields.Boolean(default=False)
 
@@ -31,21 +49,7 @@ class Course(Base, WithUrl, WithVersion, WithVisibility):
     owner = db.relationship("User")
 
     def encode_json(self):
-        user = models.User.query.get(self.owner_id)
-        return {'_schema_version': 3,
-                'name': self.name,
-                'url': self.url,
-                'owner_id': self.owner_id,
-                'owner_id__email': user.email if user else '',
-                'service': self.service,
-                'external_id': self.external_id,
-                'endpoint': self.endpoint,
-                'visibility': self.visibility,
-                'settings': self.settings,
-                'term': self.term,
-                'id': self.id,
-                'date_modified': datetime_to_string(self.date_modified),
-                'date_created': datetime_to_string(self.date_created)}
+        return encode(self)
 
     SCHEMA_V1_IGNORE_COLUMNS = Base.SCHEMA_V1_IGNORE_COLUMNS + ('owner_id__email',)
     SCHEMA_V2_IGNORE_COLUMNS = Base.SCHEMA_V2_IGNORE_COLUMNS + ('owner_id__email',)
@@ -59,7 +63,7 @@ class Course(Base, WithUrl, WithVersion, WithVisibility):
         course_assignments = models.Assignment.by_course(course_id, False)
         # Get all course's assignment groups
         groups = course.get_assignment_groups()
-        assignment_groups = [a.encode_json() for a in groups]
+        assignment_groups = encode_many(models.AssignmentGroup, groups)
 
         # Get all assignment groups' memberships
         assignment_memberships = [a.encode_json()
@@ -81,24 +85,60 @@ class Course(Base, WithUrl, WithVersion, WithVisibility):
         return '<Course {}>'.format(self.id)
 
     @staticmethod
+    @reporting()
     def get_public():
         return Course.query.filter_by(visibility='public').all()
 
     @staticmethod
-    def remove(course_id, remove_linked=False):
-        Course.query.filter_by(id=course_id).delete()
+    def remove(course_id, remove_linked=False, background=False):
+        """
+        Delete the course. If `remove_linked` is set, then its roles, assignments,
+        groups, memberships, and sample submissions are also deleted, using bulk
+        DELETE statements in a single transaction.
+        :param course_id: The course to remove
+        :param remove_linked: Whether to remove all of the course's related data
+        :param background: Whether to run the deletion as a background job
+        :return: A dictionary of deleted row counts, or a Future of that dictionary
+            if `background` was set.
+        """
+        steps = Course.get_removal_steps(course_id, remove_linked)
+        if background:
+            return run_in_background(current_app._get_current_object(), cascade_delete, steps)
+        return cascade_delete(steps)
+
+    @staticmethod
+    def get_removal_steps(course_id, remove_linked=False):
+        """
+        Describe the bulk deletes needed to remove the course, ordered so that
+        dependent rows are removed before the rows they reference.
+        """
+        assignment_ids = (db.session.query(models.Assignment.id)
+                          .filter(models.Assignment.course_id == course_id)
+                          .scalar_subquery())
+        group_ids = (db.session.query(models.AssignmentGroup.id)
+                     .filter(models.AssignmentGroup.course_id == course_id)
+                     .scalar_subquery())
+        steps = []
         if remove_linked:
-            for m in models.AssignmentGroupMembership.by_course(course_id):
-                db.session.delete(m)
-            for a in models.Assignment.by_course(course_id):
-                for s in a.sample_submissions():
-                    db.session.delete(s)
-                db.session.delete(a)
-            for g in models.AssignmentGroup.by_course(course_id):
-                db.session.delete(g)
-            for r in models.Role.by_course(course_id):
-                db.session.delete(r)
-        db.session.commit()
+            tag_membership = models.assignment_tag_membership
+            membership = models.AssignmentGroupMembership.__table__
+            steps += [
+                CascadeStep('assignment_tag_memberships', tag_membership,
+                            tag_membership.c.assignment_id.in_(assignment_ids)),
+                CascadeStep('sample_submissions', models.SampleSubmission.__table__,
+                            models.SampleSubmission.assignment_id.in_(assignment_ids)),
+                CascadeStep('assignment_group_memberships', membership,
+                            or_(membership.c.assignment_group_id.in_(group_ids),
+                                membership.c.assignment_id.in_(assignment_ids))),
+                CascadeStep('assignments', models.Assignment.__table__,
+                            models.Assignment.course_id == course_id),
+                CascadeStep('assignment_groups', models.AssignmentGroup.__table__,
+                            models.AssignmentGroup.course_id == course_id),
+                CascadeStep('roles', models.Role.__table__,
+                            models.Role.course_id == course_id),
+            ]
+        steps.append(CascadeStep('courses', Course.__table__, Course.id == course_id))
+        return steps
 
     def get_users(self):
         return (db.session.query(models.Role, models.User)
@@ -127,6 +167,10 @@ class Course(Base, WithUrl, WithVersion, WithVisibility):
                 .filter(models.Submission.course_id == self.id)
                 .all())
 
+    def stream_submissions(self, chunk_size=None):
+        """ Stream this course's submissions as lightweight rows (see `Submission.stream_by_course`). """
+        return models.Submission.stream_by_course(self.id, chunk_size=chunk_size)
+
     def get_assignment_groups(self):
         return (db.session.query(models.AssignmentGroup)
                 .filter(models.AssignmentGroup.course_id == self.id)
@@ -139,15 +183,64 @@ class Course(Base, WithUrl, WithVersion, WithVisibility):
 
     @staticmethod
     def get_all_groups(menu='embed'):
-        courses = Course.query.all()
-        return [{'id': course.id,
-                 'name': course.name,
-                 'groups': [{'id': group.id,
-                             'name': group.name,
-                             'select_url': group.get_select_url(menu)}
-                            for group in models.AssignmentGroup.by_course(course.id)]
-                 }
-                for course in courses]
+        """
+        Build the navigation tree of every course and its assignment groups. The tree
+        is cached until a course or group is added, removed, or modified: changes
+        committed by this process invalidate it immediately (see
+        `invalidate_navigation`), and the watermark catches those made elsewhere.
+        :param menu: Which kind of menu the select URLs should be built for
+        :return: A list of course dictionaries, each with a list of groups
+        """
+        host = request.host_url if has_request_context() else None
+        key = (menu, host, _navigation_generation, Course.get_navigation_watermark())
+        tree = _NAVIGATION_TREES.get(key)
+        if tree is None:
+            tree = Course.build_navigation_tree(menu)
+            _NAVIGATION_TREES.set(key, tree)
+        return tree
+
+    @staticmethod
+    def get_navigation_watermark():
+        """
+        Summarize the state of the courses and groups tables (row counts and latest
+        modification dates) in a single round trip, to detect when the navigation
+        tree is stale. Modification dates are only as precise as the database's
+        clock (and on some, are the transaction's start time), so this only
+        detects changes made by other processes eventually.
+        :return: A tuple of the counts and dates
+        """
+        group = models.AssignmentGroup
+        return tuple(db.session.query(
+            db.session.query(func.count(Course.id)).scalar_subquery(),
+            db.session.query(func.max(Course.date_modified)).scalar_subquery(),
+            db.session.query(func.count(group.id)).scalar_subquery(),
+            db.session.query(func.max(group.date_modified)).scalar_subquery()
+        ).one())
+
+    @staticmethod
+    def build_navigation_tree(menu='embed'):
+        """
+        Fetch all the courses and their groups in one joined query, and then assemble
+        them into the navigation tree.
+        :param menu: Which kind of menu the select URLs should be built for
+        :return: A list of course dictionaries, each with a list of groups
+        """
+        group = models.AssignmentGroup
+        rows = (db.session.query(Course.id, Course.name, group.id, group.name, group.url)
+                .outerjoin(group, group.course_id == Course.id)
+                .order_by(Course.id, group.name)
+                .all())
+        courses = {}
+        for course_id, course_name, group_id, group_name, group_url in rows:
+            if course_id not in courses:
+                courses[course_id] = {'id': course_id, 'name': course_name, 'groups': []}
+            if group_id is not None:
+                courses[course_id]['groups'].append({
+                    'id': group_id,
+                    'name': group_name,
+                    'select_url': group.select_url(group_id, group_url, menu)
+                })
+        return list(courses.values())
 
     @staticmethod
     def rename(course_id, name=None):
@@ -196,11 +289,54 @@ class Course(Base, WithUrl, WithVersion, WithVisibility):
         else:
             return lti_course
 
-    def grading_grid(self):
-        # Return a list of lists of assignments/students/submissions
-        assignments = []
-        submissions = []
-        return assignments, submissions
+    def grading_grid(self) -> 'models.Gradebook':
+        # Return the student x assignment score matrix
+        return models.Gradebook.for_course(self.id)
+
+
+register_encoder(Course, ('name', 'url', 'owner_id', 'owner_id__email', 'service', 'external_id',
+                          'endpoint', 'visibility', 'settings', 'term', 'id', 'date_modified',
+                          'date_created'), schema_version=3)
+
+
+def invalidate_navigation():
+    """ Discard the cached navigation trees, e.g. after a course or group changed. """
+    global _navigation_generation
+    with _navigation_lock:
+        _navigation_generation = next(_NAVIGATION_GENERATIONS)
+        _NAVIGATION_TREES.clear()
+
+
+def _is_navigation_table(table) -> bool:
+    return table is not None and table.name in (Course.__tablename__, models.AssignmentGroup.__tablename__)
+
+
+def _note_flushed_changes(session, flush_context, instances):
+    if any(isinstance(instance, (Course, models.AssignmentGroup))
+           for instance in (*session.new, *session.dirty, *session.deleted)):
+        session.info[_NAVIGATION_CHANGED] = True
+
+
+def _note_bulk_changes(orm_execute_state):
+    # Bulk (and cascading) updates and deletes bypass the flush
+    if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+        if _is_navigation_table(getattr(orm_execute_state.statement, 'table', None)):
+            orm_execute_state.session.info[_NAVIGATION_CHANGED] = True
+
+
+def _after_commit(session):
+    if session.info.pop(_NAVIGATION_CHANGED, False):
+        invalidate_navigation()
+
+
+def _after_rollback(session):
+    session.info.pop(_NAVIGATION_CHANGED, None)
+
+
+event.listen(RoutingSession, 'before_flush', _note_flushed_changes)
+event.listen(RoutingSession, 'do_orm_execute', _note_bulk_changes)
+event.listen(RoutingSession, 'after_commit', _after_commit)
+event.listen(RoutingSession, 'after_rollback', _after_rollback)
 
 
 class CourseSchema(ma.SQLAlchemyAutoSchema):
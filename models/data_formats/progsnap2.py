@@ -10,8 +10,10 @@ from tqdm import tqdm
 
 from models.assignment_group import AssignmentGroup
 from models.course import Course
-from models.log import Log
+from models.generics.streaming import get_chunk_size
+from models.log import Log, CODE_STATE_UPDATE_EVENT_TYPES
 from models.user import User
+from models.work_session import Segmenter, get_idle_gap
 
 PROGSNAP_CSV_WRITER_OPTIONS = {'delimiter': ',', 'quotechar': '"', 'quoting': csv.QUOTE_MINIMAL}
 
@@ -104,20 +106,15 @@ HEADERS = [
     'EditType',
     'CompileMessageType', 'CompileMessageData', 'CodeStateSection',
     'InterventionCategory', 'InterventionType', 'InterventionMessage',
-    'ServerTimestamp', 'ServerTimezone', 'ToolInstances'
+    'ServerTimestamp', 'ServerTimezone', 'ToolInstances',
+    'SessionID'
 ]
 
 TOOL_INSTANCE_ID = "BPY5"
 
-CODE_STATE_UPDATE_EVENT_TYPES = {
-    "File.Edit": "GenericEdit",
-    "X-File.Add": "GenericEdit",
-    "X-Instructor.File.Edit": "GenericEdit",
-    "File.Create": "GenericEdit"
-}
 
 
-def to_progsnap_event(log, order_id, code_states, latest_code_states, scores):
+def to_progsnap_event(log, order_id, code_states, latest_code_states, scores, session_id=""):
     fields = [log.id, order_id, log.subject_id, log.assignment_id, log.course_id, log.event_type]
     submission_identification = (log.subject_id, log.assignment_id, log.course_id)
     # Figure out code_state
@@ -171,29 +168,38 @@ def to_progsnap_event(log, order_id, code_states, latest_code_states, scores):
                      intervention_message,
                      log.date_created.isoformat(),
                      str(time.timezone // 36).zfill(4),
-                     TOOL_INSTANCE_ID
+                     TOOL_INSTANCE_ID,
+                     session_id
                      ]
 
 
-def generate_maintable(zip_file, course_id, assignment_group_ids):
+def generate_maintable(zip_file, course_id, assignment_group_ids, chunk_size=None):
     code_states, latest_code_states, scores = {}, {}, {}
-    query = Log.query.filter_by(course_id=course_id)
+    assignment_ids = None
     if assignment_group_ids is not None:
         assignment_ids = [assignment.id
                           for group_id in assignment_group_ids
                           for assignment in AssignmentGroup.by_id(group_id).get_assignments()]
-        query = query.filter(Log.assignment_id.in_(assignment_ids))
-    estimated_size = query.count()
-    logs = query.order_by(Log.date_created.asc()).yield_per(100)
-    with io.StringIO() as maintable_file:
+    estimated_size = Log.count_for_course(course_id, assignment_ids)
+    logs = Log.stream_for_course(course_id, assignment_ids, chunk_size=chunk_size)
+    # Sessions are segmented as the (chronological) log streams by, identified by their first events
+    sessions = Segmenter(get_idle_gap())
+    sweep_every = get_chunk_size(chunk_size)
+    # Write the rows straight into the archive, rather than building the whole table in memory
+    with io.TextIOWrapper(zip_file.open("MainTable.csv", "w", force_zip64=True),
+                          encoding='utf-8', newline='') as maintable_file:
         writer = csv.writer(maintable_file, **PROGSNAP_CSV_WRITER_OPTIONS)
         writer.writerow(HEADERS)
         order_id = 0
         for log in tqdm(logs, total=estimated_size):
-            writer.writerow(to_progsnap_event(log, order_id, code_states, latest_code_states, scores))
+            session_id = sessions.add(log).first_log_id if log.subject_id is not None else ""
+            writer.writerow(to_progsnap_event(log, order_id, code_states, latest_code_states, scores,
+                                              session_id))
             order_id += 1
-        zip_file.writestr("MainTable.csv", maintable_file.getvalue())
-        return "MainTable.csv", code_states
+            if order_id % sweep_every == 0:
+                sessions.sweep(log.date_created)
+                sessions.pop_finished()
+    return "MainTable.csv", code_states
 
 
 def generate_link_subjects(zip_file, course_id):
@@ -298,10 +304,10 @@ def generate_link_assignments(zip_file, course_id, assignment_group_ids):
         yield "LinkTables/AssignmentGroup.csv"
 
 
-def dump_progsnap(zip_file, course_id, assignment_group_ids):
+def dump_progsnap(zip_file, course_id, assignment_group_ids, chunk_size=None):
     yield generate_readme(zip_file)
     yield generate_metadata(zip_file)
-    filename, code_states = generate_maintable(zip_file, course_id, assignment_group_ids)
+    filename, code_states = generate_maintable(zip_file, course_id, assignment_group_ids, chunk_size)
     yield filename
     for code_base, code_state_id in tqdm(code_states.items()):
         for filename, contents in code_base:
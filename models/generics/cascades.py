@@ -0,0 +1,39 @@
+"""
+Set-based cascading deletes. Rather than loading and deleting each object one at
+a time, a cascade is described as a sequence of (label, table, condition) steps
+that are issued as bulk DELETE statements, in dependency order, in a single
+transaction.
+"""
+from typing import Dict, List, NamedTuple
+
+from sqlalchemy import Table
+from sqlalchemy.sql import ClauseElement
+
+from models.generics.models import db
+
+
+class CascadeStep(NamedTuple):
+    """ One bulk DELETE in a cascade: which rows of which table to remove. """
+    label: str
+    table: Table
+    condition: ClauseElement
+
+
+def cascade_delete(steps: List[CascadeStep]) -> Dict[str, int]:
+    """
+    Issue each step's DELETE in order, committing once at the end. If any step
+    fails, the entire cascade is rolled back.
+
+    :param steps: The steps, ordered so that dependent rows are removed first.
+    :return: A dictionary mapping each step's label to the number of rows deleted.
+    """
+    counts = {}
+    try:
+        for step in steps:
+            result = db.session.execute(step.table.delete().where(step.condition))
+            counts[step.label] = counts.get(step.label, 0) + result.rowcount
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return counts
@@ -2,12 +2,13 @@
 All the most core components of the models, including the DB and the migrate.
 """
 
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_marshmallow import Marshmallow
 
-# Set up SQLAlchemy
-db = SQLAlchemy()
+from models.generics.routing import RoutingSQLAlchemy
+
+# Set up SQLAlchemy, with reporting queries routed to their own pool or a replica
+db = RoutingSQLAlchemy()
 
 # Set up Marshmallow
 ma = Marshmallow()
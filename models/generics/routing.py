@@ -0,0 +1,209 @@
+"""
+Database routing: separate connection pools for interactive and reporting work, and
+an optional read replica for the reporting work.
+
+There are up to three engines:
+
+* the primary (the default bind), for interactive requests like autosaves;
+* `reporting`, another engine on the primary database with its own (small) pool,
+  so that heavy exports can never use up the connections the primary needs;
+* `replica`, on `DATABASE_REPLICA_URI`, if it is set.
+
+Code that only reads (exports, histories, gradebooks) marks itself with `reporting()`,
+as a context manager or as a decorator. Its queries then go to the replica, unless
+the replica is unreachable or lagging more than `DATABASE_REPLICA_MAX_LAG` seconds
+behind, in which case they fall back to the `reporting` engine. Flushes and other
+writes always go to the primary.
+
+Pool sizes and statement timeouts are configured per engine, in `DATABASE_POOLS` and
+`DATABASE_STATEMENT_TIMEOUTS` (using the `reporting` settings for the replica too).
+SQLite has neither, so they are not applied to it, and with an SQLite primary the
+reporting work simply shares its engine; SQLite has its own tuning mode instead
+(see `models.generics.sqlite_tuning`).
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, _EngineConnector
+from sqlalchemy import orm, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from models.generics import sqlite_tuning
+
+log = logging.getLogger('blockpy.routing')  # pylint: disable=invalid-name
+
+#: Whether the current code has asked for its queries to go to the reporting engines
+_REPORTING: ContextVar[bool] = ContextVar('blockpy_reporting', default=False)
+
+#: Queries that give a replica's lag behind its primary, in seconds, by dialect
+LAG_QUERIES = {
+    'postgresql': "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"
+}
+
+
+@contextmanager
+def reporting():
+    """
+    Send the enclosed queries to the replica (or the reporting pool). Works as a
+    context manager or, with parentheses, as a decorator:
+
+        @staticmethod
+        @reporting()
+        def for_course(course_id): ...
+
+    Because the replica may be behind, this is only for reads that can tolerate
+    slightly stale data (i.e., not a read of something just written).
+    """
+    token = _REPORTING.set(True)
+    try:
+        yield
+    finally:
+        _REPORTING.reset(token)
+
+
+def set_statement_timeout(session, milliseconds: int):
+    """
+    Limit how long the statements in the session's current transaction may run,
+    overriding the engine's `DATABASE_STATEMENT_TIMEOUTS`. Does nothing on databases
+    without statement timeouts (e.g., SQLite).
+    :param session: The session (e.g., `db.session`)
+    :param milliseconds: The limit, or 0 for none
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        session.execute(text("SET LOCAL statement_timeout = {:d}".format(int(milliseconds))))
+    elif dialect == 'mysql':
+        session.execute(text("SET SESSION max_execution_time = {:d}".format(int(milliseconds))))
+
+
+class ReplicaMonitor:
+    """
+    Keeps track of whether the replica is fresh enough to use, checking its lag at
+    most once every `interval` seconds.
+    """
+
+    def __init__(self, max_lag: float, interval: float, lag_query: Optional[str] = None):
+        self.max_lag = max_lag
+        self.interval = interval
+        self.lag_query = lag_query
+        self.lag: Optional[float] = None
+        self.checked: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def measure_lag(self, engine) -> float:
+        query = self.lag_query or LAG_QUERIES.get(engine.dialect.name)
+        with engine.connect() as connection:
+            if query is None:
+                # No way to tell, but at least it is reachable
+                connection.execute(text("SELECT 1"))
+                return 0.0
+            return float(connection.execute(text(query)).scalar() or 0)
+
+    def is_fresh(self, get_engine, now: float = None) -> bool:
+        """
+        :param get_engine: Gives the replica's engine, if it needs to be checked
+        :param now: The current (monotonic) time
+        :return: Whether the replica was reachable and within `max_lag` when last checked
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.checked is None or now - self.checked >= self.interval:
+                self.checked = now
+                try:
+                    self.lag = self.measure_lag(get_engine())
+                except SQLAlchemyError as e:
+                    log.warning("Replica is unavailable, using the primary: %s", e)
+                    self.lag = None
+                else:
+                    if self.lag > self.max_lag:
+                        log.warning("Replica is %.1fs behind, using the primary", self.lag)
+            return self.lag is not None and self.lag <= self.max_lag
+
+
+class RoutingSession(SignallingSession):
+    """ Sends reads to the reporting engines inside of `reporting()`, and everything else to the primary. """
+
+    def __init__(self, db, autocommit=False, autoflush=True, **options):
+        self.db = db
+        super().__init__(db, autocommit=autocommit, autoflush=autoflush, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if _REPORTING.get() and not self._flushing and not getattr(clause, 'is_dml', False):
+            return self.db.get_reporting_engine(self.app)
+        return super().get_bind(mapper, clause)
+
+
+sqlite_tuning.serialize_writes(RoutingSession)
+
+
+class _RoutingConnector(_EngineConnector):
+    """ Creates each engine with its own pool and timeout settings. """
+
+    def get_uri(self):
+        if self._bind == 'reporting':
+            return self._app.config['SQLALCHEMY_DATABASE_URI']
+        if self._bind == 'replica':
+            return self._app.config['DATABASE_REPLICA_URI']
+        return super().get_uri()
+
+    def get_options(self, sa_url, echo):
+        sa_url, options = super().get_options(sa_url, echo)
+        if sa_url.drivername.startswith('sqlite'):
+            if self._app.config.get('SQLITE_TUNING'):
+                options = sqlite_tuning.apply_engine_options(self._app, sa_url, options)
+            return sa_url, options
+        role = 'primary' if self._bind is None else 'reporting'
+        options.update((self._app.config.get('DATABASE_POOLS') or {}).get(role, {}))
+        timeout = (self._app.config.get('DATABASE_STATEMENT_TIMEOUTS') or {}).get(role)
+        if timeout:
+            connect_args = options['connect_args'] = dict(options.get('connect_args', {}))
+            if sa_url.drivername.startswith('postgresql'):
+                connect_args['options'] = '-c statement_timeout={:d}'.format(timeout)
+            elif sa_url.drivername.startswith('mysql'):
+                connect_args['init_command'] = 'SET SESSION max_execution_time={:d}'.format(timeout)
+        return sa_url, options
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy, with per-engine pools and routing of reporting queries (see the module). """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def make_connector(self, app=None, bind=None):
+        return _RoutingConnector(self, self.get_app(app), bind)
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('_sqlite_pragmas', None)
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+            sqlite_tuning.install_pragmas(engine, pragmas)
+        return engine
+
+    def get_replica_monitor(self, app=None) -> ReplicaMonitor:
+        """ The app's replica monitor, created from its configuration when first needed. """
+        app = self.get_app(app)
+        monitor = app.extensions.get('database_routing')
+        if monitor is None:
+            monitor = app.extensions['database_routing'] = ReplicaMonitor(
+                app.config.get('DATABASE_REPLICA_MAX_LAG', 30),
+                app.config.get('DATABASE_REPLICA_LAG_CHECK_INTERVAL', 15),
+                app.config.get('DATABASE_REPLICA_LAG_QUERY'))
+        return monitor
+
+    def get_reporting_engine(self, app=None):
+        """
+        The engine for reporting queries: the replica if it is configured and fresh,
+        otherwise the reporting pool on the primary (or, for SQLite, the primary itself).
+        """
+        app = self.get_app(app)
+        if app.config.get('DATABASE_REPLICA_URI'):
+            if self.get_replica_monitor(app).is_fresh(lambda: self.get_engine(app, 'replica')):
+                return self.get_engine(app, 'replica')
+        if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+            return self.get_engine(app)
+        return self.get_engine(app, 'reporting')
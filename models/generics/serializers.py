@@ -0,0 +1,140 @@
+"""
+Compiled JSON encoders for models.
+
+Rather than building each row's dictionary by hand, a model registers the ordered
+fields of its JSON representation once, and an encoder function is generated for
+it from the table's column metadata: datetime columns are formatted with
+`datetime_to_string`, and `<foreign key>__<attribute>` fields (e.g.,
+`owner_id__email`) are looked up on the referenced model. When encoding many rows,
+those lookups are done with one query for the whole batch rather than one per row.
+
+Encoders work on model instances and on column-tuple query results alike, as long
+as the result has the registered field names.
+"""
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from sqlalchemy import DateTime
+
+from common.dates import datetime_to_string
+from models.generics.models import db
+
+#: The encoders by model (or their fields and schema version, until first compiled)
+ENCODERS: Dict[type, Union['ModelEncoder', tuple]] = {}
+
+
+def _datetime(value) -> Optional[str]:
+    return None if value is None else datetime_to_string(value)
+
+
+class _Constant(dict):
+    """ A lookup that gives the same value for every id. """
+
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
+
+    def get(self, key, default=None):
+        return self.value
+
+
+_BLANK = _Constant("")
+
+
+class ModelEncoder:
+    """
+    The generated encoder of one model's JSON representation.
+    """
+
+    def __init__(self, model: type, fields: Sequence[str], schema_version: Optional[int] = None):
+        self.model = model
+        self.fields = tuple(fields)
+        self.schema_version = schema_version
+        # Field name -> (foreign key field, referenced model, referenced attribute)
+        self.lookups: Dict[str, Tuple[str, type, str]] = {}
+        self._encode = self._compile()
+
+    def _compile(self):
+        columns = self.model.__table__.columns
+        lines = ['def encode(row, looked_up):', '    return {']
+        if self.schema_version is not None:
+            lines.append('        "_schema_version": {!r},'.format(self.schema_version))
+        for name in self.fields:
+            if '__' in name:
+                key_field, attribute = name.split('__', 1)
+                self.lookups[name] = (key_field, get_referenced_model(columns[key_field]), attribute)
+                lines.append('        {0!r}: looked_up[{0!r}].get(row.{1}, ""),'.format(name, key_field))
+            elif name in columns and isinstance(columns[name].type, DateTime):
+                lines.append('        {0!r}: _datetime(row.{0}),'.format(name))
+            else:
+                lines.append('        {0!r}: row.{0},'.format(name))
+        lines.append('    }')
+        namespace = {'_datetime': _datetime}
+        exec('\n'.join(lines), namespace)  # pylint: disable=exec-used
+        return namespace['encode']
+
+    def look_up(self, rows: Sequence[Any], use_owner: Union[bool, Any] = True) -> dict:
+        """
+        Resolve the lookup fields for the given rows: with one query per field if
+        `use_owner` is True, as blank if it is False, or from `use_owner` itself if
+        it is an instance of the referenced model (as in `optional_encoded_field`).
+        """
+        looked_up = {}
+        for name, (key_field, target, attribute) in self.lookups.items():
+            if use_owner is False:
+                looked_up[name] = _BLANK
+            elif use_owner is True:
+                keys = {getattr(row, key_field) for row in rows} - {None}
+                looked_up[name] = dict(db.session.query(target.id, getattr(target, attribute))
+                                       .filter(target.id.in_(keys))
+                                       .all()) if keys else {}
+            elif use_owner:
+                looked_up[name] = _Constant(getattr(use_owner, attribute))
+            else:
+                looked_up[name] = _BLANK
+        return looked_up
+
+    def encode(self, row: Any, use_owner: Union[bool, Any] = True) -> dict:
+        return self._encode(row, self.look_up((row,), use_owner))
+
+    def encode_many(self, rows: Iterable[Any], use_owner: Union[bool, Any] = True) -> List[dict]:
+        rows = rows if isinstance(rows, (list, tuple)) else list(rows)
+        looked_up = self.look_up(rows, use_owner)
+        encode = self._encode
+        return [encode(row, looked_up) for row in rows]
+
+
+def get_referenced_model(column) -> type:
+    """ Find the model mapped to the table that the column's foreign key refers to. """
+    table = next(iter(column.foreign_keys)).column.table
+    for mapper in db.Model.registry.mappers:
+        if mapper.local_table is table:
+            return mapper.class_
+    raise ValueError("No model is mapped to {}".format(table.name))
+
+
+def register_encoder(model: type, fields: Sequence[str], schema_version: Optional[int] = None):
+    """
+    Declare the JSON representation of the model. The encoder itself is only
+    compiled the first time it is needed, once every model has been mapped.
+    :param model: The model class
+    :param fields: The keys of the representation, in order
+    :param schema_version: The `_schema_version` to include, if any
+    """
+    ENCODERS[model] = (fields, schema_version)
+
+
+def get_encoder(model: type) -> ModelEncoder:
+    encoder = ENCODERS[model]
+    if not isinstance(encoder, ModelEncoder):
+        encoder = ENCODERS[model] = ModelEncoder(model, *encoder)
+    return encoder
+
+
+def encode(row: Any, use_owner: Union[bool, Any] = True, model: type = None) -> dict:
+    """ Encode a single model instance (or a row of the given `model`). """
+    return get_encoder(model or type(row)).encode(row, use_owner)
+
+
+def encode_many(model: type, rows: Iterable[Any], use_owner: Union[bool, Any] = True) -> List[dict]:
+    """ Encode many rows of the model, looking up related fields in bulk. """
+    return get_encoder(model).encode_many(rows, use_owner)
@@ -0,0 +1,114 @@
+"""
+A tuning mode for running SQLite in production (`SQLITE_TUNING`).
+
+Out of the box, concurrent autosaves and log events on SQLite fail with "database is
+locked": every writer blocks every reader in the rollback journal, and two writers
+in the same process race for the lock. In this mode:
+
+* every connection gets the `SQLITE_PRAGMAS` (WAL journaling, so that reads never
+  wait for the writer; relaxed `synchronous`, which is still safe in WAL; a
+  `busy_timeout` to wait for other processes; and a bigger page cache);
+* connections are kept in a pool, rather than reopened (and re-tuned) for every
+  request;
+* writes within a process are funneled through a single-writer lock, taken when a
+  session first writes and held until its transaction ends, so that they queue up
+  in order instead of failing. Reads never take it.
+"""
+import logging
+import threading
+from typing import Dict
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+log = logging.getLogger('blockpy.sqlite')  # pylint: disable=invalid-name
+
+#: Where sessions keep the write lock they hold
+_HELD = 'sqlite_write_lock'
+
+
+class WriteLock:
+    """ The single-writer lock of one database file. """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        if self._lock.acquire(timeout=self.timeout):
+            return True
+        # Let SQLite's own busy timeout arbitrate instead of failing here
+        log.warning("Waited %ss for the SQLite write lock; writing without it", self.timeout)
+        return False
+
+    def release(self):
+        self._lock.release()
+
+
+#: The write lock of each tuned database, by its URL
+WRITE_LOCKS: Dict[str, WriteLock] = {}
+
+
+def is_file_database(sa_url) -> bool:
+    return sa_url.drivername.startswith('sqlite') and sa_url.database not in (None, '', ':memory:')
+
+
+def apply_engine_options(app, sa_url, options: dict) -> dict:
+    """
+    Adjust the engine options of a tuned SQLite database: keep a pool of connections
+    shared across threads, and remember the pragmas to run on each new connection.
+    :return: The options
+    """
+    if is_file_database(sa_url):
+        options['poolclass'] = QueuePool
+        options['pool_size'] = app.config.get('SQLITE_POOL_SIZE', 5)
+        options['max_overflow'] = app.config.get('SQLITE_POOL_OVERFLOW', 10)
+        options['connect_args'] = dict(options.get('connect_args', {}), check_same_thread=False)
+        WRITE_LOCKS.setdefault(str(sa_url), WriteLock(app.config.get('SQLITE_WRITE_LOCK_TIMEOUT', 30)))
+    options['_sqlite_pragmas'] = app.config.get('SQLITE_PRAGMAS') or {}
+    return options
+
+
+def install_pragmas(engine, pragmas: Dict[str, object]):
+    """ Run the pragmas on every new connection of the engine. """
+    statements = ["PRAGMA {}={}".format(name, value) for name, value in pragmas.items()]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+    event.listen(engine, 'connect', set_pragmas)
+
+
+def _acquire(session):
+    if _HELD in session.info:
+        return
+    lock = WRITE_LOCKS.get(str(session.db.engine.url))
+    if lock is not None and lock.acquire():
+        session.info[_HELD] = lock
+
+
+def _before_flush(session, flush_context, instances):
+    _acquire(session)
+
+
+def _do_orm_execute(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        _acquire(orm_execute_state.session)
+
+
+def _after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        lock = session.info.pop(_HELD, None)
+        if lock is not None:
+            lock.release()
+
+
+def serialize_writes(session_class):
+    """ Make sessions of the class take their database's write lock (if it has one) while writing. """
+    event.listen(session_class, 'before_flush', _before_flush)
+    event.listen(session_class, 'do_orm_execute', _do_orm_execute)
+    event.listen(session_class, 'after_transaction_end', _after_transaction_end)
@@ -0,0 +1,74 @@
+"""
+Streaming reads of large result sets, for exports and reports that scan a whole
+course.
+
+Rather than loading every row (as full ORM objects, with their relationships ready
+to lazy load) with `.all()`, `stream_columns` selects only the columns it is asked
+for and yields them as lightweight row tuples, fetched from the database in chunks.
+On PostgreSQL (and MySQL) the rows come from a server-side cursor, so at most one
+chunk is held in memory at a time; SQLite's cursors already fetch incrementally.
+"""
+from typing import Any, Iterable, Iterator, List, Sequence
+
+from flask import current_app, has_app_context
+
+from models.generics.models import db
+
+#: How many rows to fetch at once, unless `STREAM_CHUNK_SIZE` is configured
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def get_chunk_size(chunk_size: int = None) -> int:
+    if chunk_size:
+        return chunk_size
+    if has_app_context():
+        return current_app.config.get('STREAM_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    return DEFAULT_CHUNK_SIZE
+
+
+def stream(query, chunk_size: int = None):
+    """
+    Make the query fetch its results in chunks, from a server-side cursor where the
+    database supports one. The session should not be committed until the results
+    have been consumed.
+    :param query: Any query; a column query is much lighter than an entity query
+    :param chunk_size: How many rows to fetch at once (defaults to `STREAM_CHUNK_SIZE`)
+    :return: The query, ready to be iterated over
+    """
+    chunk_size = get_chunk_size(chunk_size)
+    return (query.execution_options(stream_results=True, max_row_buffer=chunk_size)
+            .yield_per(chunk_size))
+
+
+def stream_columns(model, columns: Sequence[str], *criteria, order_by=None,
+                   chunk_size: int = None) -> Iterator[Any]:
+    """
+    Stream only the named columns of the model's rows that match the criteria.
+
+        for log in stream_columns(Log, ('id', 'message'), Log.course_id == course_id):
+            print(log.id, log.message)
+
+    :param model: The model to read
+    :param columns: The names of the columns to select; the rows have them as attributes
+    :param criteria: Filters for the query
+    :param order_by: What to order the rows by (a clause, or a sequence of them), if anything
+    :param chunk_size: How many rows to fetch at once (defaults to `STREAM_CHUNK_SIZE`)
+    :return: The rows, as named tuples
+    """
+    query = db.session.query(*[getattr(model, column) for column in columns]).filter(*criteria)
+    if order_by is not None:
+        query = query.order_by(*(order_by if isinstance(order_by, (list, tuple)) else (order_by,)))
+    return iter(stream(query, chunk_size))
+
+
+def chunked(rows: Iterable[Any], chunk_size: int = None) -> Iterator[List[Any]]:
+    """ Group streamed rows into lists of at most `chunk_size`, for batch processing. """
+    chunk_size = get_chunk_size(chunk_size)
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,194 @@
+"""
+Model for the outbound LTI grade queue.
+
+Rather than posting grades to the LMS during the student's request, the latest
+score for each (submission, lis_result_sourcedid) pair is recorded here and
+posted later by the background workers in `controllers.pylti.grade_queue`.
+A newer score for the same pair simply overwrites an unsent one.
+"""
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import Column, String, Integer, ForeignKey, Text, Boolean, Float, DateTime, Index, func
+from sqlalchemy.exc import IntegrityError
+
+from models.generics.models import db, ma
+from models.generics.base import Base
+from common.dates import datetime_to_string
+
+
+class GradePassbackStatuses:
+    # Waiting to be posted (possibly after a failed attempt)
+    PENDING = 'Pending'
+    # Claimed by a worker, which is currently posting it
+    SENDING = 'Sending'
+    # Successfully posted to the LMS
+    SENT = 'Sent'
+    # Gave up after too many failed attempts
+    FAILED = 'Failed'
+
+    VALID_CHOICES = (PENDING, SENDING, SENT, FAILED)
+
+
+class GradePassbackFormats:
+    # LTI 1.1 Outcomes (XML replaceResult), from `LTI.post_grade`
+    XML = 'xml'
+    # LTI 2.0 Result service (JSON), from `LTI.post_grade2`
+    JSON = 'json'
+
+
+class GradePassback(Base):
+    __tablename__ = 'grade_passback'
+    submission_id = Column(Integer(), ForeignKey('submission.id'), nullable=True)
+    lis_result_sourcedid = Column(String(255))
+    consumer_key = Column(String(255))
+    url = Column(Text())
+    format = Column(String(10), default=GradePassbackFormats.XML)
+    # Should be between 0 and 1
+    score = Column(Float())
+    message = Column(Text(), default="")
+    message_is_url = Column(Boolean(), default=False)
+    # Delivery tracking
+    status = Column(String(20), default=GradePassbackStatuses.PENDING)
+    attempts = Column(Integer(), default=0)
+    next_attempt = Column(DateTime(), default=func.current_timestamp())
+    last_error = Column(Text(), default="")
+    # Incremented whenever a newer score replaces this one
+    version = Column(Integer(), default=0)
+
+    __table_args__ = (Index('grade_passback_target_index', "submission_id", "lis_result_sourcedid", unique=True),
+                      Index('grade_passback_due_index', "status", "next_attempt"))
+
+    def __str__(self):
+        return '<GradePassback {} for {} ({})>'.format(self.id, self.submission_id, self.status)
+
+    def encode_json(self):
+        return {
+            'id': self.id,
+            'submission_id': self.submission_id,
+            'lis_result_sourcedid': self.lis_result_sourcedid,
+            'format': self.format,
+            'score': self.score,
+            'status': self.status,
+            'attempts': self.attempts,
+            'next_attempt': datetime_to_string(self.next_attempt),
+            'last_error': self.last_error,
+            'version': self.version,
+            'date_modified': datetime_to_string(self.date_modified),
+            'date_created': datetime_to_string(self.date_created)
+        }
+
+    @staticmethod
+    def enqueue(submission_id, lis_result_sourcedid, consumer_key, url, score,
+                message="", message_is_url=False,
+                format=GradePassbackFormats.XML) -> 'Tuple[GradePassback, bool]':
+        """
+        Record the latest score for the given submission and sourcedid. If an older
+        score is still waiting (or being sent), it is superseded by this one.
+        :return: The queued grade, and whether it superseded an unsent older score
+        """
+        try:
+            return GradePassback._record(submission_id, lis_result_sourcedid, consumer_key, url, score,
+                                         message, message_is_url, format)
+        except IntegrityError:
+            # Another worker queued the first score for this target at the same time; replace it instead
+            db.session.rollback()
+            return GradePassback._record(submission_id, lis_result_sourcedid, consumer_key, url, score,
+                                         message, message_is_url, format)
+
+    @staticmethod
+    def _record(submission_id, lis_result_sourcedid, consumer_key, url, score,
+                message, message_is_url, format) -> 'Tuple[GradePassback, bool]':
+        queued = (GradePassback.query
+                  .filter_by(submission_id=submission_id,
+                             lis_result_sourcedid=lis_result_sourcedid)
+                  .first())
+        if queued is None:
+            superseded = False
+            queued = GradePassback(submission_id=submission_id,
+                                   lis_result_sourcedid=lis_result_sourcedid,
+                                   version=0)
+            db.session.add(queued)
+        else:
+            superseded = queued.status in (GradePassbackStatuses.PENDING, GradePassbackStatuses.SENDING)
+            queued.version = GradePassback.version + 1
+        queued.consumer_key = consumer_key
+        queued.url = url
+        queued.format = format
+        queued.score = score
+        queued.message = message
+        queued.message_is_url = message_is_url
+        queued.status = GradePassbackStatuses.PENDING
+        queued.attempts = 0
+        queued.next_attempt = datetime.utcnow()
+        queued.last_error = ""
+        db.session.commit()
+        return queued, superseded
+
+    @staticmethod
+    def get_due(limit: int = 50) -> 'List[GradePassback]':
+        """ Get the pending grades whose next attempt is due, oldest first. """
+        return (GradePassback.query
+                .filter(GradePassback.status == GradePassbackStatuses.PENDING,
+                        GradePassback.next_attempt <= datetime.utcnow())
+                .order_by(GradePassback.next_attempt)
+                .limit(limit)
+                .all())
+
+    def claim(self) -> bool:
+        """
+        Atomically mark this grade as being sent, so that no other worker (in this or
+        any other process) sends it too.
+        :return: Whether this worker won the claim
+        """
+        claimed = (GradePassback.query
+                   .filter_by(id=self.id, version=self.version, status=GradePassbackStatuses.PENDING)
+                   .update({'status': GradePassbackStatuses.SENDING}, synchronize_session=False))
+        db.session.commit()
+        return claimed == 1
+
+    def mark_sent(self) -> bool:
+        """
+        Record a successful post. If a newer score arrived while this one was being
+        sent, the row is left pending so that the newer score is posted too.
+        :return: Whether this was still the latest score
+        """
+        finished = (GradePassback.query
+                    .filter_by(id=self.id, version=self.version)
+                    .update({'status': GradePassbackStatuses.SENT,
+                             'attempts': GradePassback.attempts + 1,
+                             'last_error': ""}, synchronize_session=False))
+        db.session.commit()
+        return finished == 1
+
+    def mark_failed(self, error: str, delay: Optional[float]) -> bool:
+        """
+        Record a failed post, scheduling another attempt after `delay` seconds (or
+        giving up entirely, if the `delay` is None).
+        :return: Whether this was still the latest score
+        """
+        if delay is None:
+            updates = {'status': GradePassbackStatuses.FAILED}
+        else:
+            updates = {'status': GradePassbackStatuses.PENDING,
+                       'next_attempt': datetime.utcnow() + timedelta(seconds=delay)}
+        updates['attempts'] = GradePassback.attempts + 1
+        updates['last_error'] = error
+        finished = (GradePassback.query
+                    .filter_by(id=self.id, version=self.version)
+                    .update(updates, synchronize_session=False))
+        db.session.commit()
+        return finished == 1
+
+    @staticmethod
+    def count_by_status() -> dict:
+        """ Count how many queued grades are in each status. """
+        return dict(db.session.query(GradePassback.status, func.count(GradePassback.id))
+                    .group_by(GradePassback.status)
+                    .all())
+
+
+class GradePassbackSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = GradePassback
+        include_fk = True
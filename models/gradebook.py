@@ -0,0 +1,190 @@
+"""
+The gradebook engine: computes the student x assignment score matrix for a course.
+
+Instead of calling `Submission.by_student` per student and `full_score` per submission
+(each of which queries for reviews), everything needed is loaded in a few bulk column
+queries and the scores are written into flat, column-major arrays.
+"""
+import csv
+import io
+from array import array
+from math import isnan
+from typing import Dict, List
+
+from sqlalchemy import and_, func, or_
+
+import models
+from models.generics.models import db
+from models.generics.routing import reporting
+
+#: Marker for a student that has no submission for an assignment
+MISSING = float('nan')
+
+
+class Gradebook:
+    """
+    A compact, columnar gradebook. Students and assignments are stored as parallel
+    lists of their fields, and `scores` holds one array per assignment (in the same
+    order as `assignment_ids`), each with one entry per student (in the same order
+    as `student_ids`). Scores use the same 0-1 scale as `Submission.full_score`, with
+    NaN marking a missing submission.
+    """
+
+    def __init__(self, course_id: int, students: List[tuple], assignments: List[tuple]):
+        self.course_id = course_id
+        self.student_ids = [student[0] for student in students]
+        self.first_names = [student[1] for student in students]
+        self.last_names = [student[2] for student in students]
+        self.emails = [student[3] for student in students]
+        self.assignment_ids = [assignment[0] for assignment in assignments]
+        self.assignment_names = [assignment[1] for assignment in assignments]
+        self.assignment_reviewed = [bool(assignment[2]) for assignment in assignments]
+        self.scores = [array('d', [MISSING]) * len(students) for _ in assignments]
+
+    @staticmethod
+    @reporting()
+    def for_course(course_id: int) -> 'Gradebook':
+        """
+        Build the gradebook for the given course.
+        :param course_id: The course to grade
+        :return: The filled-in gradebook
+        """
+        submission = models.Submission
+        submissions = (db.session.query(submission.id, submission.user_id, submission.assignment_id,
+                                        submission.score, submission.correct)
+                       .filter(submission.course_id == course_id)
+                       .all())
+        submitted_users = {row[1] for row in submissions}
+        submitted_assignments = {row[2] for row in submissions}
+        students = Gradebook._load_students(course_id, submitted_users)
+        assignments = Gradebook._load_assignments(course_id, submitted_assignments)
+        gradebook = Gradebook(course_id, students, assignments)
+        review_totals = Gradebook._load_review_totals(course_id)
+        gradebook._fill(submissions, review_totals)
+        return gradebook
+
+    @staticmethod
+    def _load_students(course_id: int, submitted_users: set) -> List[tuple]:
+        """
+        The course's learners, and anyone else who submitted without having a role in
+        the course (e.g., a student who has since dropped), but not its staff.
+        """
+        user, role = models.User, models.Role
+        in_course = (db.session.query(role.user_id)
+                     .filter(role.course_id == course_id))
+        learners = in_course.filter(func.lower(role.name).in_(models.User.LEARNER_ROLES))
+        condition = user.id.in_(learners)
+        if submitted_users:
+            condition = or_(condition, and_(user.id.in_(submitted_users), user.id.notin_(in_course)))
+        return (db.session.query(user.id, user.first_name, user.last_name, user.email)
+                .filter(condition)
+                .order_by(user.last_name, user.first_name, user.id)
+                .all())
+
+    @staticmethod
+    def _load_assignments(course_id: int, submitted_assignments: set) -> List[tuple]:
+        assignment = models.Assignment
+        condition = assignment.course_id == course_id
+        if submitted_assignments:
+            condition = or_(condition, assignment.id.in_(submitted_assignments))
+        return (db.session.query(assignment.id, assignment.name, assignment.reviewed)
+                .filter(condition)
+                .order_by(assignment.name, assignment.id)
+                .all())
+
+    @staticmethod
+    def _load_review_totals(course_id: int) -> Dict[int, int]:
+        """
+        Sum up the actual scores of every review for the course's submissions. Reviews
+        without their own score inherit the score of the review they were forked from,
+        so forked reviews are resolved in bulk (one query per level of forking).
+        """
+        review = models.Review
+        course_submissions = (db.session.query(models.Submission.id)
+                              .filter(models.Submission.course_id == course_id))
+        reviews = (db.session.query(review.id, review.submission_id, review.score, review.forked_id)
+                   .filter(review.submission_id.in_(course_submissions))
+                   .all())
+        known = {review_id: (score, forked_id) for review_id, _, score, forked_id in reviews}
+        missing = {forked_id for score, forked_id in known.values()
+                   if score is None and forked_id is not None and forked_id not in known}
+        while missing:
+            found = (db.session.query(review.id, review.score, review.forked_id)
+                     .filter(review.id.in_(missing))
+                     .all())
+            for review_id, score, forked_id in found:
+                known[review_id] = (score, forked_id)
+            missing = {forked_id for review_id, score, forked_id in found
+                       if score is None and forked_id is not None and forked_id not in known}
+        totals = {}
+        for review_id, submission_id, _, _ in reviews:
+            totals[submission_id] = totals.get(submission_id, 0) + Gradebook._actual_score(review_id, known)
+        return totals
+
+    @staticmethod
+    def _actual_score(review_id: int, known: Dict[int, tuple]) -> int:
+        """ Mirrors `Review.get_actual_score`, but against the preloaded reviews. """
+        seen = set()
+        while review_id in known and review_id not in seen:
+            seen.add(review_id)
+            score, forked_id = known[review_id]
+            if score is not None:
+                return score
+            if forked_id is None:
+                return 0
+            review_id = forked_id
+        return 0
+
+    def _fill(self, submissions: List[tuple], review_totals: Dict[int, int]):
+        student_index = {student_id: index for index, student_id in enumerate(self.student_ids)}
+        assignment_index = {assignment_id: index for index, assignment_id in enumerate(self.assignment_ids)}
+        for submission_id, user_id, assignment_id, score, correct in submissions:
+            row = student_index.get(user_id)
+            column = assignment_index.get(assignment_id)
+            if row is None or column is None:
+                continue
+            score = score or 0
+            if self.assignment_reviewed[column]:
+                value = (score + review_totals.get(submission_id, 0)) / 100.0
+            else:
+                value = float(bool(correct)) or score / 100.0
+            scores = self.scores[column]
+            if isnan(scores[row]) or value > scores[row]:
+                scores[row] = value
+
+    def encode_json(self) -> dict:
+        """
+        Create a columnar JSON representation of this gradebook. Missing submissions
+        are represented as None.
+        :return:
+        """
+        return {
+            'course_id': self.course_id,
+            'students': {
+                'id': self.student_ids,
+                'first_name': self.first_names,
+                'last_name': self.last_names,
+                'email': self.emails
+            },
+            'assignments': {
+                'id': self.assignment_ids,
+                'name': self.assignment_names,
+                'reviewed': self.assignment_reviewed
+            },
+            'scores': [[None if isnan(value) else value for value in column]
+                       for column in self.scores]
+        }
+
+    def to_csv(self) -> str:
+        """
+        Create a CSV version of this gradebook, with one row per student and one
+        column per assignment.
+        :return:
+        """
+        with io.StringIO() as output:
+            writer = csv.writer(output)
+            writer.writerow(['SubjectID', 'Last Name', 'First Name', 'Email'] + self.assignment_names)
+            for row, student_id in enumerate(self.student_ids):
+                writer.writerow([student_id, self.last_names[row], self.first_names[row], self.emails[row]] +
+                                ['' if isnan(column[row]) else column[row] for column in self.scores])
+            return output.getvalue()
@@ -2,14 +2,26 @@ import logging
 from collections import OrderedDict
 import json
 
-from sqlalchemy import Column, String, Integer, ForeignKey, Text, func, JSON
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, Text, func, JSON
 
 from models.assignment import Assignment
 import models
 from models.generics.models import db, ma
+from models.generics.serializers import encode, encode_many, register_encoder
+from models.generics.routing import reporting
+from models.generics.streaming import stream_columns
 from models.generics.base import Base
 from common.dates import datetime_to_string, string_to_datetime
 from models.user import User
+from models.search_index import index_feedback
+
+#: The events that change the code, each with its ProgSnap2 EditType; their message is the file's new contents
+CODE_STATE_UPDATE_EVENT_TYPES = {
+    "File.Edit": "GenericEdit",
+    "X-File.Add": "GenericEdit",
+    "X-Instructor.File.Edit": "GenericEdit",
+    "File.Create": "GenericEdit"
+}
 
 
 class Log(Base):
@@ -32,6 +44,8 @@ class Log(Base):
     subject = db.relationship("User")
     course = db.relationship("Course")
 
+    __table_args__ = (Index('log_subject_index', "assignment_id", "subject_id", "date_created"),)
+
     # event_type
     # => event_id
     # subject_id
@@ -56,24 +70,7 @@ class Log(Base):
     # => score
 
     def encode_json(self):
-        return {
-            '_schema_version': 2,
-            'id': self.id,
-            'date_modified': datetime_to_string(self.date_modified),
-            'date_created': datetime_to_string(self.date_created),
-
-            'assignment_id': self.assignment_id,
-            'assignment_version': self.assignment_version,
-            'course_id': self.course_id,
-            'subject_id': self.subject_id,
-            'event_type': self.event_type,
-            'file_path': self.file_path,
-            'category': self.category,
-            'label': self.label,
-            'message': self.message,
-            'client_timestamp': self.client_timestamp,
-            'client_timezone': self.client_timezone
-        }
+        return encode(self)
 
     @staticmethod
     def new(assignment_id, assignment_version, course_id, subject_id, event_type,
@@ -86,28 +83,63 @@ class Log(Base):
                   client_timestamp=client_timestamp,
                   client_timezone=client_timezone)
         db.session.add(log)
+        if event_type == 'Intervention':
+            db.session.flush()
+            index_feedback(log)
         db.session.commit()
         # Single-file logging
         logging.getLogger('Events').info(log.for_file())
         return log
 
     def __str__(self):
-        return '<Log {} for {}>'.format(self.event, self.action)
+        return '<Log {} for {}>'.format(self.event_type, self.subject_id)
 
     @staticmethod
     def calculate_feedbacks(assignment_id, course_id):
-        return (db.session.query(func.count(Log.id))
-                .filter(Log.assignment_id == assignment_id)
-                .filter(Log.course_id == course_id)
-                .filter(Log.event == 'feedback')
-                .filter(Log.action != "Success")
-                .group_by(Log.subject_id)
+        """ How much (non-completion) feedback each student got on the assignment, from the log summaries. """
+        return (db.session.query(models.LogSummary.feedbacks)
+                .filter(models.LogSummary.assignment_id == assignment_id)
+                .filter(models.LogSummary.course_id == course_id)
+                .filter(models.LogSummary.feedbacks > 0)
                 .all())
 
     @staticmethod
     def get_logs_for_course(course_id):
         return Log.query.filter_by(course_id=course_id).all()
 
+    #: The columns that describe an event, for streaming whole-course scans
+    EVENT_COLUMNS = ('id', 'date_created', 'assignment_id', 'assignment_version', 'course_id',
+                     'subject_id', 'event_type', 'file_path', 'category', 'label', 'message',
+                     'client_timestamp', 'client_timezone')
+
+    @staticmethod
+    def _course_criteria(course_id, assignment_ids=None):
+        criteria = [Log.course_id == course_id]
+        if assignment_ids is not None:
+            criteria.append(Log.assignment_id.in_(assignment_ids))
+        return criteria
+
+    @staticmethod
+    def count_for_course(course_id, assignment_ids=None) -> int:
+        return (db.session.query(func.count(Log.id))
+                .filter(*Log._course_criteria(course_id, assignment_ids))
+                .scalar())
+
+    @staticmethod
+    def stream_for_course(course_id, assignment_ids=None, columns=EVENT_COLUMNS, chunk_size=None):
+        """
+        Stream the course's events in chronological order (and by id within the same
+        moment, like `update_sessions`), as lightweight rows with only the given
+        columns, without ever holding more than a chunk of them.
+        :param course_id: The course whose events to read
+        :param assignment_ids: Only read the events of these assignments, if given
+        :param columns: The names of the columns to read
+        :param chunk_size: How many rows to fetch at once (defaults to `STREAM_CHUNK_SIZE`)
+        :return: An iterator of the rows
+        """
+        return stream_columns(Log, columns, *Log._course_criteria(course_id, assignment_ids),
+                              order_by=(Log.date_created.asc(), Log.id.asc()), chunk_size=chunk_size)
+
     @staticmethod
     def get_users_for_course(course_id):
         return (db.session.query(User)
@@ -125,6 +157,7 @@ class Log(Base):
                 .all())
 
     @staticmethod
+    @reporting()
     def get_history(course_id, assignment_id, user_id, page_offset=None, page_limit=None):
         logs = (
             Log.query.filter_by(
@@ -137,7 +170,7 @@ class Log(Base):
             logs.offset(page_offset)
         if page_limit is not None:
             logs.limit(page_limit)
-        return [log.encode_json() for log in logs.all()]
+        return encode_many(Log, logs.all())
 
     def for_file(self):
         return ", ".join((
@@ -156,6 +189,11 @@ class Log(Base):
         ))
 
 
+register_encoder(Log, ('id', 'date_modified', 'date_created', 'assignment_id', 'assignment_version',
+                       'course_id', 'subject_id', 'event_type', 'file_path', 'category', 'label',
+                       'message', 'client_timestamp', 'client_timezone'), schema_version=2)
+
+
 class LogSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Log
@@ -0,0 +1,304 @@
+"""
+Per-assignment analytics, precomputed from the event log.
+
+Dashboards need counts like how often each student ran their code, hit a compile
+error, or got feedback, and how long (and how many runs) it took them to finish.
+Rather than scanning the whole `Log` for every dashboard, a summary row per
+(course, assignment, student) is kept up to date incrementally: `update_summaries`
+consumes only the events logged since its watermark (the id of the last event it
+summarized), in chunks, committing the summaries and the watermark together so that
+an interrupted update simply resumes. `rebuild_summaries` recomputes everything
+from scratch, e.g. after the definitions below change.
+
+Ids are assigned when an event is inserted, but become visible when its transaction
+commits, so an update stops at events younger than `LOG_SUMMARY_SETTLE_SECONDS`
+rather than risk skipping one that commits late (measured by the database's clock,
+which stamped the events).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from statistics import median
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from flask import current_app, has_app_context
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index, func
+from sqlalchemy.exc import IntegrityError
+
+from models.generics.models import db
+from models.generics.streaming import get_chunk_size
+from models.log import Log
+
+#: The events that count as running the program
+RUN_EVENTS = ('Run.Program',)
+#: The events that count as a compile (syntax) error
+COMPILE_ERROR_EVENTS = ('Compile.Error',)
+#: Feedback interventions with this category mean the student finished
+COMPLETE_CATEGORY = 'Complete'
+
+#: The columns of the events that the summaries are computed from
+SUMMARY_COLUMNS = ('id', 'date_created', 'course_id', 'assignment_id', 'subject_id', 'event_type', 'category')
+
+#: The name of the summaries' watermark
+WATERMARK = 'log_summary'
+
+SummaryKey = Tuple[int, int, int]
+
+
+class LogWatermark(db.Model):
+    """
+    How far through the event log a consumer of it has gotten: by id, or for those
+    that read it in time order, by (date_created, id).
+    """
+    __tablename__ = 'log_watermark'
+    name = Column(String(64), primary_key=True)
+    log_id = Column(Integer(), nullable=False, default=0)
+    moment = Column(DateTime())
+
+    def __str__(self):
+        return '<LogWatermark {} at {}>'.format(self.name, self.log_id)
+
+    @staticmethod
+    def claim(name: str) -> 'LogWatermark':
+        """
+        Get the named watermark (creating it if needed), locked until the transaction
+        ends. Rather than rely on SELECT ... FOR UPDATE (which SQLite ignores), the row
+        is locked by writing to it, on the condition that it still holds what was
+        read; if another consumer advanced it in the meantime, it is read again, so
+        that no event is ever consumed twice.
+        """
+        while True:
+            watermark = LogWatermark.query.filter_by(name=name).populate_existing().first()
+            if watermark is None:
+                try:
+                    db.session.add(LogWatermark(name=name, log_id=0))
+                    db.session.commit()
+                except IntegrityError:
+                    # Another consumer created it first
+                    db.session.rollback()
+                continue
+            locked = (LogWatermark.query
+                      .filter_by(name=name, log_id=watermark.log_id, moment=watermark.moment)
+                      .update({'log_id': watermark.log_id}, synchronize_session=False))
+            if locked:
+                return watermark
+            db.session.rollback()
+
+
+class LogSummary(db.Model):
+    __tablename__ = 'log_summary'
+    id = Column(Integer(), primary_key=True)
+    course_id = Column(Integer(), ForeignKey('course.id'), nullable=False)
+    assignment_id = Column(Integer(), ForeignKey('assignment.id'), nullable=False)
+    subject_id = Column(Integer(), ForeignKey('user.id'), nullable=False)
+    # Counts of events
+    events = Column(Integer(), nullable=False, default=0)
+    runs = Column(Integer(), nullable=False, default=0)
+    compile_errors = Column(Integer(), nullable=False, default=0)
+    feedbacks = Column(Integer(), nullable=False, default=0)
+    # When the student started, last worked on, and first finished the assignment
+    first_event = Column(DateTime())
+    last_event = Column(DateTime())
+    completed = Column(DateTime())
+    # Runs up until the student first finished, or None if they have not yet
+    attempts_before_correct = Column(Integer())
+
+    __table_args__ = (Index('log_summary_key_index', "course_id", "assignment_id", "subject_id", unique=True),)
+
+    def __str__(self):
+        return '<LogSummary of {} on {} in {}>'.format(self.subject_id, self.assignment_id, self.course_id)
+
+    @property
+    def time_to_completion(self) -> Optional[float]:
+        """ Seconds from the student's first event to finishing, or None if they have not yet. """
+        if self.completed is None or self.first_event is None:
+            return None
+        return (self.completed - self.first_event).total_seconds()
+
+    def add_event(self, event):
+        """ Count the event (a row with the `SUMMARY_COLUMNS`) towards this summary. """
+        moment = event.date_created
+        self.events = (self.events or 0) + 1
+        if moment is not None:
+            if self.first_event is None or moment < self.first_event:
+                self.first_event = moment
+            if self.last_event is None or moment > self.last_event:
+                self.last_event = moment
+        if event.event_type in RUN_EVENTS:
+            self.runs = (self.runs or 0) + 1
+        elif event.event_type in COMPILE_ERROR_EVENTS:
+            self.compile_errors = (self.compile_errors or 0) + 1
+        elif event.event_type == 'Intervention':
+            if event.category != COMPLETE_CATEGORY:
+                self.feedbacks = (self.feedbacks or 0) + 1
+            elif self.completed is None:
+                self.completed = moment
+                self.attempts_before_correct = self.runs or 0
+
+    def encode_json(self):
+        return {
+            'course_id': self.course_id,
+            'assignment_id': self.assignment_id,
+            'subject_id': self.subject_id,
+            'events': self.events,
+            'runs': self.runs,
+            'compile_errors': self.compile_errors,
+            'feedbacks': self.feedbacks,
+            'completed': self.completed is not None,
+            'time_to_completion': self.time_to_completion,
+            'attempts_before_correct': self.attempts_before_correct
+        }
+
+    @staticmethod
+    def by_assignment(course_id: int, assignment_id: int) -> 'List[LogSummary]':
+        return (LogSummary.query.filter_by(course_id=course_id, assignment_id=assignment_id)
+                .order_by(LogSummary.subject_id)
+                .all())
+
+    @staticmethod
+    def overview(course_id: int, assignment_id: int) -> dict:
+        """
+        The totals of the assignment's summaries, for the instructor's dashboard.
+        :return: The number of students, their total runs, compile errors, and
+                 feedback, how many finished, and the median time (in seconds) and
+                 mean runs it took them
+        """
+        students, runs, compile_errors, feedbacks, attempts = (
+            db.session.query(func.count(LogSummary.id), func.sum(LogSummary.runs),
+                             func.sum(LogSummary.compile_errors), func.sum(LogSummary.feedbacks),
+                             func.avg(LogSummary.attempts_before_correct))
+            .filter_by(course_id=course_id, assignment_id=assignment_id)
+            .one())
+        durations = [(completed - started).total_seconds()
+                     for started, completed in (db.session.query(LogSummary.first_event, LogSummary.completed)
+                                                .filter_by(course_id=course_id, assignment_id=assignment_id)
+                                                .filter(LogSummary.completed.isnot(None)))]
+        return {
+            'students': students,
+            'runs': runs or 0,
+            'compile_errors': compile_errors or 0,
+            'feedbacks': feedbacks or 0,
+            'completed': len(durations),
+            'median_time_to_completion': median(durations) if durations else None,
+            'mean_attempts_before_correct': None if attempts is None else float(attempts)
+        }
+
+
+def get_settle_seconds(settle_seconds: float = None) -> float:
+    if settle_seconds is not None:
+        return settle_seconds
+    if has_app_context():
+        return current_app.config.get('LOG_SUMMARY_SETTLE_SECONDS', 5)
+    return 5
+
+
+def get_settled_cutoff(settle_seconds: float = None) -> datetime:
+    """
+    The moment before which events count as settled, by the database's clock: the
+    same clock that stamps their `date_created`, whatever the app server's clock and
+    time zone.
+    :param settle_seconds: How old events must be (defaults to `LOG_SUMMARY_SETTLE_SECONDS`)
+    """
+    now = db.session.query(func.current_timestamp()).scalar()
+    # Stored dates are naive, in the database session's time zone
+    return now.replace(tzinfo=None) - timedelta(seconds=get_settle_seconds(settle_seconds))
+
+
+def for_each_assignment(update: Callable[..., int], assignment_ids: Sequence[int] = None,
+                        workers: int = 1, **options) -> int:
+    """
+    Run a per-assignment consumer of the event log for every assignment (or the given ones).
+    :param update: Given an assignment id (and the options), consumes its new events
+    :param assignment_ids: The assignments to update (defaults to all that have events)
+    :param workers: How many assignments to update at once, each in its own thread and
+                    transaction (for databases that allow concurrent writers)
+    :return: The total of what `update` returned
+    """
+    if assignment_ids is None:
+        assignment_ids = [assignment_id for assignment_id, in (db.session.query(Log.assignment_id)
+                                                               .filter(Log.assignment_id.isnot(None))
+                                                               .distinct())]
+    if workers <= 1:
+        return sum(update(assignment_id, **options) for assignment_id in assignment_ids)
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+
+    def work(assignment_id):
+        with app.app_context():
+            try:
+                return update(assignment_id, **options)
+            finally:
+                db.session.remove()
+    with ThreadPoolExecutor(workers) as pool:
+        return sum(pool.map(work, assignment_ids))
+
+
+def _load_summaries(keys) -> Dict[SummaryKey, LogSummary]:
+    """ The existing summaries among the given keys, loaded in one query. """
+    summaries = (LogSummary.query
+                 .filter(LogSummary.assignment_id.in_({key[1] for key in keys}))
+                 .filter(LogSummary.subject_id.in_({key[2] for key in keys}))
+                 .all())
+    return {(summary.course_id, summary.assignment_id, summary.subject_id): summary
+            for summary in summaries
+            if (summary.course_id, summary.assignment_id, summary.subject_id) in keys}
+
+
+def update_summaries(chunk_size: int = None, settle_seconds: float = None, limit: int = None) -> int:
+    """
+    Summarize the events logged since the last update.
+    :param chunk_size: How many events to summarize per transaction (defaults to `STREAM_CHUNK_SIZE`)
+    :param settle_seconds: Leave events younger than this for the next update
+                           (defaults to `LOG_SUMMARY_SETTLE_SECONDS`)
+    :param limit: Stop after this many events, if given, leaving the rest for the next update
+    :return: How many events were consumed
+    """
+    chunk_size = get_chunk_size(chunk_size)
+    cutoff = get_settled_cutoff(settle_seconds)
+    columns = [getattr(Log, column) for column in SUMMARY_COLUMNS]
+    consumed = 0
+    while limit is None or consumed < limit:
+        watermark = LogWatermark.claim(WATERMARK)
+        batch = chunk_size if limit is None else min(chunk_size, limit - consumed)
+        events = (db.session.query(*columns)
+                  .filter(Log.id > watermark.log_id)
+                  .order_by(Log.id.asc())
+                  .limit(batch)
+                  .all())
+        settled = []
+        for event in events:
+            if event.date_created is not None and event.date_created > cutoff:
+                # Keep to id order: stop at the first event that might not be settled yet
+                break
+            settled.append(event)
+        if not settled:
+            db.session.commit()
+            break
+        keys = {(event.course_id, event.assignment_id, event.subject_id) for event in settled
+                if None not in (event.course_id, event.assignment_id, event.subject_id)}
+        summaries = _load_summaries(keys) if keys else {}
+        for event in settled:
+            key = (event.course_id, event.assignment_id, event.subject_id)
+            if key not in keys:
+                continue
+            summary = summaries.get(key)
+            if summary is None:
+                summary = summaries[key] = LogSummary(course_id=key[0], assignment_id=key[1], subject_id=key[2],
+                                                      events=0, runs=0, compile_errors=0, feedbacks=0)
+                db.session.add(summary)
+            summary.add_event(event)
+        watermark.log_id = settled[-1].id
+        db.session.commit()
+        consumed += len(settled)
+        if len(settled) < batch:
+            break
+    return consumed
+
+
+def rebuild_summaries(chunk_size: int = None, settle_seconds: float = None) -> int:
+    """
+    Throw away all the summaries and recompute them from the whole event log.
+    :return: How many events were consumed
+    """
+    LogWatermark.claim(WATERMARK).log_id = 0
+    LogSummary.query.delete()
+    db.session.commit()
+    return update_summaries(chunk_size, settle_seconds)
@@ -0,0 +1,70 @@
+"""
+Shared storage for the OAuth nonces of LTI launches, so that a replayed launch is
+rejected even when it reaches a different process than the original did.
+"""
+from datetime import datetime
+import threading
+
+from sqlalchemy import Column, String, Integer, Index
+from sqlalchemy.exc import IntegrityError
+
+from models.generics.models import db
+
+
+class LtiNonce(db.Model):
+    __tablename__ = 'lti_nonce'
+    id = Column(Integer(), primary_key=True)
+    # "<consumer_key>:<nonce>"
+    key = Column(String(255), nullable=False, unique=True)
+    # Unix timestamp after which the nonce can be forgotten
+    expires = Column(Integer(), nullable=False)
+
+    __table_args__ = (Index('lti_nonce_expires_index', "expires"),)
+
+    def __str__(self):
+        return '<LtiNonce {} until {}>'.format(self.key, datetime.utcfromtimestamp(self.expires))
+
+
+class DatabaseNonceStore:
+    """
+    A nonce store (see `controllers.pylti.common.NonceCache`) backed by the `lti_nonce`
+    table. Each check-and-store is a single atomic statement (the unique key rejects a
+    concurrent insert, and an expired key is only reclaimed by an update that still
+    finds it expired), so a replay is rejected across processes. Nonces are written on
+    their own connection, never committing or rolling back the request's session.
+    Expired nonces are purged every `purge_interval` insertions.
+    """
+
+    def __init__(self, purge_interval: int = 1000):
+        self.purge_interval = purge_interval
+        self._added = 0
+        self._lock = threading.Lock()
+
+    def add(self, key: str, expires: int, now: int) -> bool:
+        """
+        Remember the key until it expires.
+        :return: False if the key was already present (a replay)
+        """
+        with self._lock:
+            self._added += 1
+            purging = self._added % self.purge_interval == 0
+        if purging:
+            self.purge(now)
+        table = LtiNonce.__table__
+        try:
+            with db.engine.begin() as connection:
+                reclaimed = connection.execute(table.update()
+                                               .where(table.c.key == key, table.c.expires <= now)
+                                               .values(expires=expires)).rowcount
+                if not reclaimed:
+                    connection.execute(table.insert().values(key=key, expires=expires))
+        except IntegrityError:
+            return False
+        return True
+
+    @staticmethod
+    def purge(now: int) -> int:
+        """ Delete every nonce that has already expired. """
+        table = LtiNonce.__table__
+        with db.engine.begin() as connection:
+            return connection.execute(table.delete().where(table.c.expires <= now)).rowcount
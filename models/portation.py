@@ -17,10 +17,12 @@ from natsort import natsorted
 from werkzeug.utils import secure_filename
 
 from models.generics.models import db
+from models.generics.routing import reporting
 from models.assignment import Assignment
 from models.assignment_group import AssignmentGroup
 from models.assignment_group_membership import AssignmentGroupMembership
 from models.course import Course
+from models.submission import Submission
 from models.data_formats.progsnap2 import dump_progsnap
 
 
@@ -88,6 +90,7 @@ def import_bundle(bundle, owner_id, course_id=None, update=True):
 
 
 # noinspection PyTypeHints
+@reporting()
 def export_bundle(**kwargs):
     """
     Can consume lists of IDs, URLs, or objects to serialize into JSON data. Named parameters
@@ -117,12 +120,13 @@ def export_bundle(**kwargs):
     return dumped
 
 
-def export_progsnap2(output, course_id, assignment_group_ids=None):
+@reporting()
+def export_progsnap2(output, course_id, assignment_group_ids=None, chunk_size=None):
     output_zip = output+".zip"
     # Start filling it up
     with zipfile.ZipFile(output_zip, "w", zipfile.ZIP_DEFLATED) as zip_file:
         print("Starting")
-        for filename in dump_progsnap(zip_file, course_id, assignment_group_ids):
+        for filename in dump_progsnap(zip_file, course_id, assignment_group_ids, chunk_size):
             print("Completed", filename)
         print("Files completed. Writing to disk.")
 
@@ -133,31 +137,33 @@ def export_peml():
 
 
 # noinspection PyTypeHints
+@reporting()
 def export_zip(assignments=None, submissions=None, users=None):
-    dumped = {}
-    assignment_paths = {}
-    if assignments:
-        for assignment in assignments:
-            assignment_paths[assignment.id] = assignment.get_filename(extension='')
-            dumped[assignment.get_filename(extension='.md')] = json.dumps(assignment.encode_json())
-    user_paths = {}
-    user_names = []
-    if users:
-        for user in users:
-            user_paths[user.id] = secure_filename(user.name())
-            user_names.append(user.name())
-    dumped['users.txt'] = "\n".join(user_names)
-    if submissions:
-        for submission in submissions:
-            files = submission.encode_human()
-            for filename, contents in files.items():
-                path = assignment_paths[submission.assignment_id]+'/'
-                path += user_paths[submission.user_id]+'/'
-                path += filename
-                dumped[path] = contents
-    print(list(dumped.keys()))
+    """
+    Zip up the assignments' definitions and the submissions' human-readable files.
+    The submissions can be streamed (e.g., from `Submission.stream_by_course`); each
+    one is compressed into the archive as soon as it is read.
+    """
     zip_buffer = io.BytesIO()
     with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for file_name, data in dumped.items():
-            zip_file.writestr(file_name, data)
+        assignment_paths = {}
+        if assignments:
+            for assignment in assignments:
+                assignment_paths[assignment.id] = assignment.get_filename(extension='')
+                zip_file.writestr(assignment.get_filename(extension='.md'), json.dumps(assignment.encode_json()))
+        user_paths = {}
+        user_names = []
+        if users:
+            for user in users:
+                user_paths[user.id] = secure_filename(user.name())
+                user_names.append(user.name())
+        zip_file.writestr('users.txt', "\n".join(user_names))
+        if submissions:
+            for submission in submissions:
+                files = Submission.human_files(submission)
+                for filename, contents in files.items():
+                    path = assignment_paths[submission.assignment_id]+'/'
+                    path += user_paths[submission.user_id]+'/'
+                    path += filename
+                    zip_file.writestr(path, contents)
     return zip_buffer.getvalue()
\ No newline at end of file
@@ -8,10 +8,12 @@ from sqlalchemy import Column, Text, Integer, Boolean, ForeignKey, Index, func,
 
 import models
 from models.generics.models import db, ma
+from models.generics.serializers import encode, register_encoder
 from models.generics.base import Base
 from common.dates import datetime_to_string, string_to_datetime
 from common.databases import optional_encoded_field
 from common.filesystem import ensure_dirs
+from models.search_index import index_review, remove_review
 
 
 class Review(Base):
@@ -39,24 +41,7 @@ class Review(Base):
         return "<Review {} for {}>".format(self.id, self.submission_id)
 
     def encode_json(self):
-        return {
-            '_schema_version': 2,
-            'id': self.id,
-            'date_modified': self.date_modified,
-            'date_created': self.date_created,
-            'comment': self.comment,
-            'location': self.location,
-            'generic': self.generic,
-            'tag_id': self.tag_id,
-            'score': self.score,
-            'submission_id': self.submission_id,
-            'author_id': self.author_id,
-            'assignment_version': self.assignment_version,
-            'submission_version': self.submission_version,
-            'version': self.version,
-            'forked_id': self.forked_id,
-            'forked_version': self.forked_version
-        }
+        return encode(self)
 
     @staticmethod
     def new(data):
@@ -73,6 +58,8 @@ class Review(Base):
                             forked_id=(data['forked_id']),
                             forked_version=0) #TODO: Handle forked_version
         db.session.add(new_review)
+        db.session.flush()
+        index_review(new_review)
         db.session.commit()
         return new_review
 
@@ -89,10 +76,12 @@ class Review(Base):
                 changes = changes or (old != new)
         if changes:
             self.version += 1
+            index_review(self)
         db.session.commit()
         return self
 
     def delete(self):
+        remove_review(self.id)
         db.session.delete(self)
         db.session.commit()
 
@@ -117,6 +106,10 @@ class Review(Base):
                 return forked.get_actual_score()
 
 
+register_encoder(Review, ('id', 'date_modified', 'date_created', 'comment', 'location', 'generic',
+                          'tag_id', 'score', 'submission_id', 'author_id', 'assignment_version',
+                          'submission_version', 'version', 'forked_id', 'forked_version'), schema_version=2)
+
 
 class ReviewSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
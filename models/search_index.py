@@ -0,0 +1,288 @@
+"""
+Full-text search over students' code, the feedback they were given (`Intervention`
+events), and reviewers' comments, e.g. for "every submission that calls `open(`"
+or "every student who was told X", without exporting anything.
+
+Each searchable text is copied into a `SearchDocument`, scoped by its course and
+assignment, and each distinct trigram (three consecutive characters, lowercased) of
+it is posted to `SearchTrigram`. A document can only contain a term if it has all
+of the term's trigrams, so a search intersects the terms' posting lists with one
+indexed query and only checks those candidates against the terms themselves. This
+is how PostgreSQL's pg_trgm indexes answer `LIKE` queries, but kept in ordinary
+tables so that it works the same on every database the app runs on.
+
+Documents are updated as their sources are written. When a text changes, only the
+trigrams it gained or lost are posted or removed, so an autosave that changes a line
+of code touches a handful of rows.
+"""
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+import re
+
+from flask import current_app
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, Index, distinct, func
+
+import models
+from models.generics.models import db
+from models.generics.streaming import chunked, get_chunk_size
+
+#: What can be searched: submissions' code, feedback events, and reviews' comments
+DOCUMENT_KINDS = ('code', 'feedback', 'review')
+
+#: The characters in a trigram
+GRAM_SIZE = 3
+
+#: The most matching lines to show for each result
+MAX_MATCHED_LINES = 3
+
+#: Terms (with an optional leading `-` to exclude them), either "quoted" or up to the next space
+_TERM = re.compile(r'(-?)(?:"([^"]*)"|(\S+))')
+
+
+def trigrams(text: str) -> Set[str]:
+    """ The distinct (lowercased) trigrams of the text. """
+    text = text.lower()
+    return {text[index:index + GRAM_SIZE] for index in range(len(text) - GRAM_SIZE + 1)}
+
+
+class Query(NamedTuple):
+    #: The terms that results must contain, and those that they must not (all lowercased)
+    included: List[str]
+    excluded: List[str]
+
+    @staticmethod
+    def parse(text: str) -> 'Query':
+        """
+        Parse a search, e.g. `open( -with "print(x)"`. Terms are matched as substrings,
+        ignoring case; those starting with `-` are excluded.
+        :raises ValueError: If no included term is long enough to look up in the index
+        """
+        included, excluded = [], []
+        for negated, quoted, word in _TERM.findall(text):
+            term = (quoted or word).lower()
+            if term:
+                (excluded if negated else included).append(term)
+        if not any(len(term) >= GRAM_SIZE for term in included):
+            raise ValueError("Search for at least one term of {} or more characters".format(GRAM_SIZE))
+        return Query(included, excluded)
+
+    def trigrams(self) -> Set[str]:
+        return set().union(*(trigrams(term) for term in self.included))
+
+    def matches(self, text: str) -> bool:
+        text = text.lower()
+        return (all(term in text for term in self.included) and
+                not any(term in text for term in self.excluded))
+
+    def matched_lines(self, text: str, limit: int = MAX_MATCHED_LINES) -> List[Tuple[int, str]]:
+        """ The first few lines (and their numbers, from 1) that contain an included term. """
+        lines = []
+        for number, line in enumerate(text.splitlines(), 1):
+            if any(term in line.lower() for term in self.included):
+                lines.append((number, line))
+                if len(lines) >= limit:
+                    break
+        return lines
+
+
+class SearchDocument(db.Model):
+    __tablename__ = 'search_document'
+    id = Column(Integer(), primary_key=True)
+    # One of the DOCUMENT_KINDS, and the id of the submission, log event, or review it was copied from
+    kind = Column(String(16), nullable=False)
+    source_id = Column(Integer(), nullable=False)
+    course_id = Column(Integer(), ForeignKey('course.id'))
+    assignment_id = Column(Integer(), ForeignKey('assignment.id'))
+    # The student whose code it is, who was given the feedback, or whose submission was reviewed
+    subject_id = Column(Integer(), ForeignKey('user.id'))
+    text = Column(Text(), nullable=False)
+
+    __table_args__ = (Index('search_document_source_index', "kind", "source_id", unique=True),)
+
+    def __str__(self):
+        return '<SearchDocument of {} {}>'.format(self.kind, self.source_id)
+
+    def encode_json(self, query: Query = None):
+        result = {
+            'kind': self.kind,
+            'id': self.source_id,
+            'course_id': self.course_id,
+            'assignment_id': self.assignment_id,
+            'subject_id': self.subject_id
+        }
+        if query is not None:
+            result['lines'] = [{'line': number, 'text': line} for number, line in query.matched_lines(self.text)]
+        return result
+
+
+class SearchTrigram(db.Model):
+    """ The posting of one trigram of a document. """
+    __tablename__ = 'search_trigram'
+    id = Column(Integer(), primary_key=True)
+    document_id = Column(Integer(), ForeignKey('search_document.id'), nullable=False)
+    course_id = Column(Integer(), ForeignKey('course.id'))
+    trigram = Column(String(GRAM_SIZE), nullable=False)
+
+    __table_args__ = (Index('search_trigram_lookup_index', "course_id", "trigram", "document_id"),
+                      # Each trigram is posted once per document, which `search` relies on
+                      Index('search_trigram_document_index', "document_id", "trigram", unique=True))
+
+
+def search(course_id: int, query: Query, assignment_id: int = None, kinds: Sequence[str] = None,
+           after: int = None, limit: int = 20, chunk_size: int = None) -> Tuple[List[SearchDocument], Optional[int]]:
+    """
+    The course's documents that match the search, most recently indexed first.
+    :param course_id: The course to search
+    :param query: The parsed search
+    :param assignment_id: Only search this assignment, if given
+    :param kinds: Only search these DOCUMENT_KINDS, if given
+    :param after: Continue from this cursor, as returned for the previous page
+    :param limit: The most documents to return
+    :param chunk_size: How many candidates to check at once
+    :return: The documents, and the cursor for the next page (or None, if this was the last)
+    """
+    grams = query.trigrams()
+    chunk_size = get_chunk_size(chunk_size)
+    # The documents that have every trigram of every included term
+    candidates = (db.session.query(SearchTrigram.document_id)
+                  .filter(SearchTrigram.course_id == course_id, SearchTrigram.trigram.in_(grams))
+                  .group_by(SearchTrigram.document_id)
+                  .having(func.count(distinct(SearchTrigram.trigram)) == len(grams)))
+    criteria = [SearchDocument.id.in_(candidates)]
+    if assignment_id is not None:
+        criteria.append(SearchDocument.assignment_id == assignment_id)
+    if kinds:
+        criteria.append(SearchDocument.kind.in_(list(kinds)))
+    results = []
+    while True:
+        page_criteria = criteria if after is None else criteria + [SearchDocument.id < after]
+        chunk = (SearchDocument.query.filter(*page_criteria)
+                 .order_by(SearchDocument.id.desc()).limit(chunk_size).all())
+        for document in chunk:
+            after = document.id
+            if query.matches(document.text):
+                results.append(document)
+                if len(results) >= limit:
+                    return results, after
+        if len(chunk) < chunk_size:
+            return results, None
+
+
+def _remove_postings(document_id: int, grams: Iterable[str]):
+    # A batch at a time, since a whole file's worth of trigrams could exceed the database's parameter limit
+    for batch in chunked(grams, 500):
+        (SearchTrigram.query.filter(SearchTrigram.document_id == document_id, SearchTrigram.trigram.in_(batch))
+         .delete(synchronize_session=False))
+
+
+def _index(kind: str, source_id: int, course_id: Optional[int], assignment_id: Optional[int],
+           subject_id: Optional[int], text: Optional[str], document: Optional[SearchDocument]):
+    """
+    Bring the source's document (if it has one yet) up to date with its text, posting
+    and removing only the trigrams that changed. Blank texts are not indexed.
+    """
+    if not text or not text.strip():
+        if document is not None:
+            SearchTrigram.query.filter_by(document_id=document.id).delete(synchronize_session=False)
+            db.session.delete(document)
+        return
+    if document is None:
+        document = SearchDocument(kind=kind, source_id=source_id, course_id=course_id, text="")
+        db.session.add(document)
+        db.session.flush()
+    elif document.course_id != course_id:
+        # Postings are scoped by course, so start them over
+        SearchTrigram.query.filter_by(document_id=document.id).delete(synchronize_session=False)
+        document.course_id, document.text = course_id, ""
+    document.assignment_id, document.subject_id = assignment_id, subject_id
+    if document.text == text:
+        return
+    old, new = trigrams(document.text), trigrams(text)
+    _remove_postings(document.id, old - new)
+    added = [{'document_id': document.id, 'course_id': course_id, 'trigram': gram} for gram in new - old]
+    if added:
+        db.session.execute(SearchTrigram.__table__.insert(), added)
+    document.text = text
+
+
+def _find(kind: str, source_id: int) -> Optional[SearchDocument]:
+    return SearchDocument.query.filter_by(kind=kind, source_id=source_id).first()
+
+
+def is_enabled() -> bool:
+    return current_app.config.get('SEARCH_INDEX', True)
+
+
+def feedback_text(category: str, label: str, message: str) -> str:
+    return "\n".join(part for part in (category, label, message) if part)
+
+
+def index_code(submission):
+    """ Bring the submission's code up to date in the index, as part of the current transaction. """
+    if is_enabled():
+        _index('code', submission.id, submission.course_id, submission.assignment_id, submission.user_id,
+               submission.code, _find('code', submission.id))
+
+
+def index_feedback(log):
+    """ Add the (flushed) `Intervention` event to the index, as part of the current transaction. """
+    if is_enabled():
+        _index('feedback', log.id, log.course_id, log.assignment_id, log.subject_id,
+               feedback_text(log.category, log.label, log.message), None)
+
+
+def index_review(review):
+    """ Bring the (flushed) review's comment up to date in the index, as part of the current transaction. """
+    if not is_enabled():
+        return
+    submission = review.submission
+    if submission is None:
+        remove_review(review.id)
+    else:
+        _index('review', review.id, submission.course_id, submission.assignment_id, submission.user_id,
+               review.comment, _find('review', review.id))
+
+
+def remove_review(review_id: int):
+    if is_enabled():
+        _index('review', review_id, None, None, None, None, _find('review', review_id))
+
+
+def index_course(course_id: int, assignment_ids: Sequence[int] = None, chunk_size: int = None) -> int:
+    """
+    Index every submission, feedback event, and review of the course (or of the given
+    assignments), e.g. those written before the index existed, a chunk (and
+    transaction) at a time. Sources that are already up to date are left alone.
+    :return: How many sources were looked at
+    """
+    chunk_size, total = get_chunk_size(chunk_size), 0
+    Submission, Log, Review = models.Submission, models.Log, models.Review
+    sources = [
+        ('code', Submission.id, [Submission.id, Submission.course_id, Submission.assignment_id,
+                                 Submission.user_id, Submission.code],
+         [Submission.course_id == course_id], lambda row: row.code),
+        ('feedback', Log.id, [Log.id, Log.course_id, Log.assignment_id, Log.subject_id,
+                              Log.category, Log.label, Log.message],
+         [Log.course_id == course_id, Log.event_type == 'Intervention'],
+         lambda row: feedback_text(row.category, row.label, row.message)),
+        ('review', Review.id, [Review.id, Submission.course_id, Submission.assignment_id,
+                               Submission.user_id, Review.comment],
+         [Submission.course_id == course_id, Review.submission_id == Submission.id], lambda row: row.comment),
+    ]
+    for kind, id_column, columns, criteria, get_text in sources:
+        if assignment_ids is not None:
+            assignment_column = Log.assignment_id if kind == 'feedback' else Submission.assignment_id
+            criteria = criteria + [assignment_column.in_(assignment_ids)]
+        last_id = 0
+        while True:
+            chunk = (db.session.query(*columns).filter(*criteria, id_column > last_id)
+                     .order_by(id_column).limit(chunk_size).all())
+            if not chunk:
+                break
+            documents = {document.source_id: document for document in
+                         SearchDocument.query.filter(SearchDocument.kind == kind,
+                                                     SearchDocument.source_id.in_([row[0] for row in chunk]))}
+            for row in chunk:
+                _index(kind, row[0], row[1], row[2], row[3], get_text(row), documents.get(row[0]))
+            db.session.commit()
+            last_id, total = chunk[-1][0], total + len(chunk)
+    return total
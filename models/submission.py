@@ -12,11 +12,13 @@ import models
 from models.assignment import Assignment
 from models.log import Log
 from models.generics.models import db, ma
+from models.generics.serializers import encode, encode_many, register_encoder
+from models.generics.streaming import stream_columns
 from models.generics.base import Base
-from common.dates import datetime_to_string
-from common.databases import optional_encoded_field
 from common.filesystem import ensure_dirs
 from models.review import Review
+from models.code_similarity import index_submission
+from models.search_index import index_code
 
 
 class SubmissionStatuses:
@@ -71,30 +73,24 @@ class Submission(Base):
                             "course_id", "user_id"),)
 
     def encode_json(self, use_owner=True):
-        return {
-            '_schema_version': 2,
-            'code': self.code,
-            'extra_files': self.extra_files,
-            'url': self.url,
-            'endpoint': self.endpoint,
-            'score': self.score,
-            'correct': self.correct,
-            'assignment_id': self.assignment_id,
-            'course_id': self.course_id,
-            'user_id': self.user_id,
-            'assignment_version': self.assignment_version,
-            'version': self.version,
-            'submission_status': self.submission_status,
-            'grading_status': self.grading_status,
-            'user_id__email': optional_encoded_field(self.user_id, use_owner, models.User.query.get, 'email'),
-            'id': self.id,
-            'date_modified': datetime_to_string(self.date_modified),
-            'date_created': datetime_to_string(self.date_created)
-        }
+        return encode(self, use_owner)
 
     def encode_human(self):
+        return Submission.human_files(self)
+
+    #: The columns needed by `human_files`
+    HUMAN_COLUMNS = ('id', 'code', 'extra_files', 'score', 'correct', 'submission_status', 'grading_status',
+                     'assignment_id', 'course_id', 'user_id', 'assignment_version', 'version')
+
+    @staticmethod
+    def human_files(row):
+        """
+        The human-readable files of a submission: its code, its grade, and its extra files.
+        :param row: A submission, or a streamed row with the `HUMAN_COLUMNS`
+        :return: The contents of the files, by filename
+        """
         try:
-            extra_files = json.loads(self.extra_files)
+            extra_files = json.loads(row.extra_files)
             if isinstance(extra_files, dict):
                 extra_files = {k:v for k,v in extra_files.items()}
             else:
@@ -102,18 +98,18 @@ class Submission(Base):
         except json.JSONDecodeError:
             extra_files = {}
         files = {
-            'answer.py': self.code,
+            'answer.py': row.code,
             '_grade.json': json.dumps({
-                'score': self.score,
-                'correct': self.correct,
-                'submission_status': self.submission_status,
-                'grading_status': self.grading_status,
-                'assignment_id': self.assignment_id,
-                'id': self.id,
-                'course_id': self.course_id,
-                'user_id': self.user_id,
-                'assignment_version': self.assignment_version,
-                'version': self.version,
+                'score': row.score,
+                'correct': row.correct,
+                'submission_status': row.submission_status,
+                'grading_status': row.grading_status,
+                'assignment_id': row.assignment_id,
+                'id': row.id,
+                'course_id': row.course_id,
+                'user_id': row.user_id,
+                'assignment_version': row.assignment_version,
+                'version': row.version,
                 'files': ['answer.py']+[f[0] for f in extra_files]
             }),
             **extra_files
@@ -132,6 +128,15 @@ class Submission(Base):
         else:
             return result
 
+    @staticmethod
+    def get_owners(submission_ids) -> 'Dict[int, int]':
+        """ The user id of each of the given submissions' students, by submission id. """
+        submission_ids = list(submission_ids)
+        if not submission_ids:
+            return {}
+        return dict(db.session.query(Submission.id, Submission.user_id)
+                    .filter(Submission.id.in_(submission_ids)))
+
     @staticmethod
     def by_assignment(assignment_id, course_id):
         return (db.session.query(Submission, models.User, models.Assignment)
@@ -141,6 +146,22 @@ class Submission(Base):
                 .filter(Submission.course_id == course_id)
                 .all())
 
+    @staticmethod
+    def stream_by_course(course_id, assignment_ids=None, columns=HUMAN_COLUMNS, chunk_size=None):
+        """
+        Stream the course's submissions as lightweight rows with only the given
+        columns, without ever holding more than a chunk of them.
+        :param course_id: The course whose submissions to read
+        :param assignment_ids: Only read the submissions to these assignments, if given
+        :param columns: The names of the columns to read
+        :param chunk_size: How many rows to fetch at once (defaults to `STREAM_CHUNK_SIZE`)
+        :return: An iterator of the rows
+        """
+        criteria = [Submission.course_id == course_id]
+        if assignment_ids is not None:
+            criteria.append(Submission.assignment_id.in_(assignment_ids))
+        return stream_columns(Submission, columns, *criteria, order_by=Submission.id, chunk_size=chunk_size)
+
     @staticmethod
     def get_latest(assignment_id, course_id):
         return (db.session.query(func.max(Submission.date_modified))
@@ -248,6 +269,8 @@ class Submission(Base):
             self.extra_files = code
         elif filename == "answer.py":
             self.code = code
+            index_submission(self)
+            index_code(self)
         self.version += 1
         self.assignment_version = self.assignment.version
         db.session.commit()
@@ -366,13 +389,17 @@ class Submission(Base):
             blockly_logfile.write(self.code)
 
     def get_reviews(self):
-        return [review.encode_json() for review in
-                Review.query.filter_by(submission_id=self.id).all()]
+        return encode_many(Review, Review.query.filter_by(submission_id=self.id).all())
 
     @staticmethod
     def get_meta_reviews():
-        return [review.encode_json() for review in
-                Review.query.filter_by(generic=True).all()]
+        return encode_many(Review, Review.query.filter_by(generic=True).all())
+
+
+register_encoder(Submission, ('code', 'extra_files', 'url', 'endpoint', 'score', 'correct',
+                              'assignment_id', 'course_id', 'user_id', 'assignment_version',
+                              'version', 'submission_status', 'grading_status', 'user_id__email',
+                              'id', 'date_modified', 'date_created'), schema_version=2)
 
 
 class SubmissionSchema(ma.SQLAlchemyAutoSchema):
@@ -3,6 +3,7 @@ from sqlalchemy import Column, Integer, String, Boolean, DateTime, func
 
 import models
 from models.generics.models import db, ma
+from models.generics.serializers import encode, register_encoder
 from models.generics.base import Base
 
 
@@ -28,14 +29,10 @@ class User(Base, UserMixin):
                    "instructor", "contentdeveloper", "teachingassistant",
                    "urn:lti:role:ims/lis/instructor",
                    "urn:lti:role:ims/lis/contentdeveloper"]
+    LEARNER_ROLES = ["learner", "student", "urn:lti:role:ims/lis/learner"]
 
     def encode_json(self, use_owner=True):
-        return {
-            'id': self.id,
-            'first_name': self.first_name,
-            'last_name': self.last_name,
-            'email': self.email
-        }
+        return encode(self)
 
     @staticmethod
     def new_from_instructor(email, first_name='', last_name=''):
@@ -82,29 +79,29 @@ class User(Base, UserMixin):
         return bool(models.Role.query.filter_by(course_id=course_id, user_id=self.id).first())
 
     def is_admin(self):
-        return 'admin' in {role.name.lower() for role in self.roles.all()}
+        return 'admin' in {role.name.lower() for role in self.get_roles()}
 
     def is_instructor(self, course_id=None):
         if course_id is not None:
-            return 'instructor' in {role.name.lower() for role in self.roles.all()
+            return 'instructor' in {role.name.lower() for role in self.get_roles()
                                     if role.course_id == course_id}
-        return 'instructor' in {role.name.lower() for role in self.roles.all()}
+        return 'instructor' in {role.name.lower() for role in self.get_roles()}
 
     def is_grader(self, course_id=None):
         if course_id is not None:
-            role_strings = {role.name.lower() for role in self.roles.all()
+            role_strings = {role.name.lower() for role in self.get_roles()
                             if role.course_id == course_id}
         else:
-            role_strings = {role.name.lower() for role in self.roles.all()}
+            role_strings = {role.name.lower() for role in self.get_roles()}
         return ('instructor' in role_strings or
                 'urn:lti:sysrole:ims/lis/none' in role_strings or
                 'urn:lti:role:ims/lis/teachingassistant' in role_strings)
 
     def is_student(self, course_id=None):
         if course_id is not None:
-            return 'learner' in {role.name.lower() for role in self.roles.all()
+            return 'learner' in {role.name.lower() for role in self.get_roles()
                                  if role.course_id == course_id}
-        return 'learner' in {role.name.lower() for role in self.roles.all()}
+        return 'learner' in {role.name.lower() for role in self.get_roles()}
 
     def add_role(self, name, course_id):
         new_role = models.Role(name=name, user_id=self.id, course_id=course_id)
@@ -112,7 +109,7 @@ class User(Base, UserMixin):
         db.session.commit()
 
     def update_roles(self, new_roles, course_id):
-        old_roles = [role for role in self.roles.all() if role.course_id == course_id]
+        old_roles = [role for role in self.get_roles() if role.course_id == course_id]
         new_role_names = set(new_role_name.lower() for new_role_name in new_roles)
         for old_role in old_roles:
             if old_role.name.lower() not in new_role_names:
@@ -185,6 +182,9 @@ class User(Base, UserMixin):
             return lti.user
 
 
+register_encoder(User, ('id', 'first_name', 'last_name', 'email'))
+
+
 class UserSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = User
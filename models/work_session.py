@@ -0,0 +1,274 @@
+"""
+Work sessions: the stretches of time that a student spends working on an assignment,
+segmented out of the event log, for time-on-task.
+
+A student's events on an assignment, in time order, belong to the same session until
+they go quiet for longer than `WORK_SESSION_IDLE_GAP` seconds; the next event starts
+a new session. Sessions are timed by the server's `date_created` rather than the
+client's timestamp, since client clocks drift and jump, and the log is stored (and
+exported) in server time.
+
+The segmentation is a single streaming pass (see `Segmenter`) that only keeps the
+sessions that might still continue in memory. The same pass runs in two places:
+
+* `update_sessions` stores each assignment's sessions, consuming the events logged
+  since its own watermark, so it can be run incrementally and for many assignments
+  in parallel (`update_all_sessions`);
+* the ProgSnap2 export labels each event with its session as it streams the log.
+
+Each session is identified by the id of its first event, so both agree on the
+`SessionID`s without the export having to read the stored sessions.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from flask import current_app, has_app_context
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Index, and_, or_
+
+from models.generics.models import db
+from models.generics.streaming import get_chunk_size, stream_columns
+from models.log import Log
+from models.log_summary import LogWatermark, for_each_assignment, get_settled_cutoff
+
+#: Seconds of inactivity that end a session, unless `WORK_SESSION_IDLE_GAP` is configured
+DEFAULT_IDLE_GAP = 15 * 60
+
+#: The columns of the events that sessions are segmented from
+SESSION_COLUMNS = ('id', 'date_created', 'course_id', 'assignment_id', 'subject_id')
+
+SessionKey = Tuple[Optional[int], int, int]
+
+
+def get_idle_gap(idle_gap: float = None) -> timedelta:
+    if idle_gap is None:
+        idle_gap = DEFAULT_IDLE_GAP
+        if has_app_context():
+            idle_gap = current_app.config.get('WORK_SESSION_IDLE_GAP', DEFAULT_IDLE_GAP)
+    return timedelta(seconds=idle_gap)
+
+
+def get_watermark_name(assignment_id: int) -> str:
+    return 'work_session:{}'.format(assignment_id)
+
+
+class WorkSession(db.Model):
+    __tablename__ = 'work_session'
+    id = Column(Integer(), primary_key=True)
+    course_id = Column(Integer(), ForeignKey('course.id'))
+    assignment_id = Column(Integer(), ForeignKey('assignment.id'), nullable=False)
+    subject_id = Column(Integer(), ForeignKey('user.id'), nullable=False)
+    # The session's first event, whose id also identifies the session (e.g., as its ProgSnap2 SessionID)
+    first_log_id = Column(Integer(), nullable=False, unique=True)
+    last_log_id = Column(Integer(), nullable=False)
+    started = Column(DateTime(), nullable=False)
+    ended = Column(DateTime(), nullable=False)
+    events = Column(Integer(), nullable=False, default=1)
+
+    __table_args__ = (Index('work_session_assignment_index', "assignment_id", "ended"),)
+
+    def __str__(self):
+        return '<WorkSession {} of {} on {}>'.format(self.first_log_id, self.subject_id, self.assignment_id)
+
+    @property
+    def key(self) -> SessionKey:
+        return self.course_id, self.assignment_id, self.subject_id
+
+    @property
+    def duration(self) -> float:
+        """ The seconds from the session's first event to its last. """
+        return (self.ended - self.started).total_seconds()
+
+    @staticmethod
+    def starting_with(event) -> 'WorkSession':
+        return WorkSession(course_id=event.course_id, assignment_id=event.assignment_id,
+                           subject_id=event.subject_id, first_log_id=event.id, last_log_id=event.id,
+                           started=event.date_created, ended=event.date_created, events=1)
+
+    def extend(self, event):
+        self.last_log_id = event.id
+        self.ended = event.date_created
+        self.events += 1
+
+    def encode_json(self):
+        return {
+            'id': self.first_log_id,
+            'course_id': self.course_id,
+            'assignment_id': self.assignment_id,
+            'subject_id': self.subject_id,
+            'started': self.started.isoformat() + 'Z',
+            'ended': self.ended.isoformat() + 'Z',
+            'events': self.events,
+            'duration': self.duration
+        }
+
+    @staticmethod
+    def time_on_task(course_id: int, assignment_id: int) -> Dict[int, dict]:
+        """
+        Each student's number of sessions on the assignment, and total seconds spent in them.
+        :return: The totals, by the student's user id
+        """
+        totals = {}
+        for subject_id, started, ended in (db.session.query(WorkSession.subject_id, WorkSession.started,
+                                                            WorkSession.ended)
+                                           .filter_by(course_id=course_id, assignment_id=assignment_id)):
+            total = totals.setdefault(subject_id, {'sessions': 0, 'time_on_task': 0.0})
+            total['sessions'] += 1
+            total['time_on_task'] += (ended - started).total_seconds()
+        return totals
+
+
+class Segmenter:
+    """
+    Assigns events, given in time order, to work sessions. Only the sessions that are
+    still open are kept; finished ones are set aside until collected with
+    `pop_finished`, and `sweep` finishes those that have gone idle.
+    """
+
+    def __init__(self, idle_gap: timedelta, sessions: Iterable[WorkSession] = ()):
+        """
+        :param idle_gap: How long a session can go without events before it ends
+        :param sessions: Sessions to continue (e.g., the latest stored ones)
+        """
+        self.idle_gap = idle_gap
+        self.open: Dict[SessionKey, WorkSession] = {}
+        self.finished: List[WorkSession] = []
+        for session in sessions:
+            latest = self.open.get(session.key)
+            if latest is None or session.ended > latest.ended:
+                self.open[session.key] = session
+
+    def add(self, event) -> WorkSession:
+        """
+        :param event: A row with the `SESSION_COLUMNS`
+        :return: The session that the event belongs to
+        """
+        key = (event.course_id, event.assignment_id, event.subject_id)
+        session = self.open.get(key)
+        if session is not None and event.date_created - session.ended <= self.idle_gap:
+            session.extend(event)
+            return session
+        if session is not None:
+            self.finished.append(session)
+        session = self.open[key] = WorkSession.starting_with(event)
+        return session
+
+    def sweep(self, now: datetime):
+        """ Finish the sessions that have been idle for too long as of `now`. """
+        idle = [key for key, session in self.open.items() if now - session.ended > self.idle_gap]
+        for key in idle:
+            self.finished.append(self.open.pop(key))
+
+    def pop_finished(self) -> List[WorkSession]:
+        finished, self.finished = self.finished, []
+        return finished
+
+    def pop_open(self) -> List[WorkSession]:
+        still_open, self.open = list(self.open.values()), {}
+        return still_open
+
+
+def segment(events: Iterable, idle_gap: timedelta, sessions: Iterable[WorkSession] = (),
+            sweep_every: int = 1000) -> Iterator[WorkSession]:
+    """
+    Segment the events (in time order) into sessions, yielding each one once it is
+    finished, and finally those that were still open.
+    :param events: Rows with the `SESSION_COLUMNS`
+    :param idle_gap: How long a session can go without events before it ends
+    :param sessions: Sessions to continue
+    :param sweep_every: How many events to take between looking for idle sessions
+    """
+    segmenter = Segmenter(idle_gap, sessions)
+    for count, event in enumerate(events, 1):
+        segmenter.add(event)
+        if count % sweep_every == 0:
+            segmenter.sweep(event.date_created)
+            yield from segmenter.pop_finished()
+    yield from segmenter.pop_finished()
+    yield from segmenter.pop_open()
+
+
+def update_sessions(assignment_id: int, idle_gap: float = None, chunk_size: int = None,
+                    settle_seconds: float = None, limit: int = None) -> int:
+    """
+    Segment the assignment's events logged since the last update into sessions,
+    continuing the stored sessions that they might extend.
+    :param assignment_id: The assignment whose events to segment
+    :param idle_gap: Seconds of inactivity that end a session (defaults to `WORK_SESSION_IDLE_GAP`)
+    :param chunk_size: How many events to read (and sessions to write) at once
+    :param settle_seconds: Leave events younger than this for the next update
+                           (defaults to `LOG_SUMMARY_SETTLE_SECONDS`)
+    :param limit: Stop after this many events, if given, leaving the rest for the next update
+    :return: How many events were consumed
+    """
+    idle_gap, chunk_size = get_idle_gap(idle_gap), get_chunk_size(chunk_size)
+    cutoff = get_settled_cutoff(settle_seconds)
+    watermark = LogWatermark.claim(get_watermark_name(assignment_id))
+    criteria = [Log.assignment_id == assignment_id, Log.subject_id.isnot(None), Log.date_created <= cutoff]
+    resumed = []
+    if watermark.moment is not None:
+        criteria.append(or_(Log.date_created > watermark.moment,
+                            and_(Log.date_created == watermark.moment, Log.id > watermark.log_id)))
+        resumed = (WorkSession.query.filter(WorkSession.assignment_id == assignment_id,
+                                            WorkSession.ended >= watermark.moment - idle_gap)
+                   .all())
+    events = stream_columns(Log, SESSION_COLUMNS, *criteria,
+                            order_by=(Log.date_created.asc(), Log.id.asc()), chunk_size=chunk_size)
+    consumed, last = 0, None
+
+    def counted(rows):
+        nonlocal consumed, last
+        for row in rows:
+            if limit is not None and consumed >= limit:
+                # As if the log ended here: the open sessions are resumed next time
+                return
+            consumed, last = consumed + 1, row
+            yield row
+
+    written = []
+    for session in segment(counted(events), idle_gap, resumed, sweep_every=chunk_size):
+        written.append(session)
+        if len(written) >= chunk_size:
+            _write_sessions(written)
+            written = []
+    _write_sessions(written)
+    if last is not None:
+        watermark.moment, watermark.log_id = last.date_created, last.id
+    db.session.commit()
+    return consumed
+
+
+def _write_sessions(sessions: Sequence[WorkSession]):
+    """ Save the sessions, and stop tracking them so that memory stays bounded. """
+    db.session.add_all(sessions)
+    db.session.flush()
+    for session in sessions:
+        db.session.expunge(session)
+
+
+def update_all_sessions(assignment_ids: Sequence[int] = None, workers: int = 1, **options) -> int:
+    """
+    Bring the sessions of every assignment (or the given ones) up to date.
+    :param assignment_ids: The assignments to update (defaults to all that have events)
+    :param workers: How many assignments to update at once (see `for_each_assignment`)
+    :param options: Passed on to `update_sessions`
+    :return: How many events were consumed
+    """
+    return for_each_assignment(update_sessions, assignment_ids, workers, **options)
+
+
+def rebuild_sessions(assignment_ids: Sequence[int] = None, workers: int = 1, **options) -> int:
+    """
+    Throw away the stored sessions of every assignment (or the given ones) and segment them again.
+    :return: How many events were consumed
+    """
+    sessions, watermarks = WorkSession.query, LogWatermark.query
+    if assignment_ids is None:
+        watermarks = watermarks.filter(LogWatermark.name.like(get_watermark_name('%')))
+    else:
+        sessions = sessions.filter(WorkSession.assignment_id.in_(assignment_ids))
+        watermarks = watermarks.filter(LogWatermark.name.in_([get_watermark_name(assignment_id)
+                                                              for assignment_id in assignment_ids]))
+    sessions.delete(synchronize_session=False)
+    watermarks.delete(synchronize_session=False)
+    db.session.commit()
+    return update_all_sessions(assignment_ids, workers, **options)
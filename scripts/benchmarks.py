@@ -0,0 +1,270 @@
+"""
+End-to-end benchmarks of the data model's hot paths, run against a synthetic course
+(see `scripts.synthetic`). The results are plain JSON, so that runs from different
+releases can be compared to spot regressions.
+
+    python manage.py benchmark --events 2000000 --output results.json
+"""
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import sqlalchemy
+from flask import current_app
+
+from models.generics.models import db
+from models.assignment import Assignment
+from models.assignment_group_membership import AssignmentGroupMembership
+from models.gradebook import Gradebook
+from models.log import Log
+from models.submission import Submission
+from models.user import User
+from models.portation import export_bundle, export_progsnap2, export_zip, import_bundle
+from scripts.synthetic import SyntheticCourse
+
+#: How many operations the per-call benchmarks (e.g., `Log.new`) do in each run
+OPERATIONS = 100
+
+
+class BenchmarkContext(NamedTuple):
+    course: SyntheticCourse
+    rng: random.Random
+    directory: str
+
+
+#: The benchmarks, by name. Each one does a single run and returns how many operations it did.
+BENCHMARKS: Dict[str, Callable[[BenchmarkContext], int]] = {}
+
+
+def benchmark(name: str):
+    """ Register the decorated function as a benchmark. """
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+@benchmark('log_new')
+def bench_log_new(context: BenchmarkContext) -> int:
+    course = context.course
+    for index in range(OPERATIONS):
+        Log.new(context.rng.choice(course.assignment_ids), 0, course.course_id,
+                context.rng.choice(course.student_ids), 'File.Edit', 'answer.py', '', '',
+                'print({})\n'.format(index) * 20, str(int(time.time() * 1000)), '-0400')
+    return OPERATIONS
+
+
+@benchmark('get_history')
+def bench_get_history(context: BenchmarkContext) -> int:
+    course = context.course
+    for _ in range(OPERATIONS):
+        Log.get_history(course.course_id, context.rng.choice(course.assignment_ids),
+                        context.rng.choice(course.student_ids))
+    return OPERATIONS
+
+
+@benchmark('by_pending_review')
+def bench_by_pending_review(context: BenchmarkContext) -> int:
+    return len(Submission.by_pending_review(context.course.course_id))
+
+
+@benchmark('export_progsnap2')
+def bench_export_progsnap2(context: BenchmarkContext) -> int:
+    export_progsnap2(os.path.join(context.directory, 'progsnap2'), context.course.course_id)
+    return context.course.events
+
+
+@benchmark('export_zip')
+def bench_export_zip(context: BenchmarkContext) -> int:
+    course = context.course
+    export_zip(assignments=Assignment.query.filter(Assignment.id.in_(course.assignment_ids)).all(),
+               submissions=Submission.stream_by_course(course.course_id),
+               users=User.query.filter(User.id.in_(course.student_ids)).all())
+    return len(course.submission_ids)
+
+
+@benchmark('import_bundle')
+def bench_import_bundle(context: BenchmarkContext) -> int:
+    course = context.course
+    memberships = (AssignmentGroupMembership.query
+                   .filter(AssignmentGroupMembership.assignment_group_id.in_(course.group_ids))
+                   .all())
+    bundle = export_bundle(assignments=course.assignment_ids, groups=course.group_ids,
+                           memberships=memberships)
+    import_bundle(bundle, course.instructor_id, course_id=course.course_id)
+    return len(bundle['assignments']) + len(bundle['groups']) + len(bundle['memberships'])
+
+
+@benchmark('gradebook')
+def bench_gradebook(context: BenchmarkContext) -> int:
+    gradebook = Gradebook.for_course(context.course.course_id)
+    return len(gradebook.student_ids) * len(gradebook.assignment_ids)
+
+
+def summarize(name: str, timings: List[float], operations: int) -> dict:
+    """ Describe the timings (in seconds) of one benchmark's runs. """
+    return {
+        'name': name,
+        'runs': len(timings),
+        'operations': operations,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'max': max(timings),
+        'per_operation': statistics.median(timings) / operations if operations else None
+    }
+
+
+def run_benchmarks(course: SyntheticCourse, repeat: int = 3, only: Optional[List[str]] = None,
+                   seed: int = 0) -> List[dict]:
+    """
+    Time each benchmark `repeat` times against the course. A benchmark that fails is
+    reported with its error, rather than stopping the others.
+    Must be called within an app context.
+    :return: The summary of each benchmark
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        context = BenchmarkContext(course, random.Random(seed), directory)
+        for name, function in BENCHMARKS.items():
+            if only and name not in only:
+                continue
+            timings, operations = [], 0
+            try:
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    operations = function(context)
+                    timings.append(time.perf_counter() - started)
+                    db.session.expire_all()
+            except Exception as e:
+                db.session.rollback()
+                results.append({'name': name, 'error': '{}: {}'.format(type(e).__name__, e)})
+                continue
+            results.append(summarize(name, timings, operations))
+    return results
+
+
+def describe_error(error: Exception) -> str:
+    """ The exception's type and message (for database errors, the driver's). """
+    return '{}: {}'.format(type(error).__name__, getattr(error, 'orig', None) or error)
+
+
+def run_concurrent_writes(app, writers: int, operations: int, readers: int = 2) -> dict:
+    """
+    Hammer the app's database the way a lab full of students does: each writer
+    thread autosaves its submission and logs the edit, `operations` times, while
+    reader threads keep loading histories.
+    :return: The throughput of the writes, and how many of them (and of the reads) failed
+    """
+    with app.app_context():
+        db.metadata.create_all(db.engine, tables=[Log.__table__, Submission.__table__])
+        submissions = [Submission(code='', course_id=1, assignment_id=1, user_id=writer + 1, version=0)
+                       for writer in range(writers)]
+        db.session.add_all(submissions)
+        db.session.commit()
+        submission_ids = [submission.id for submission in submissions]
+        db.session.remove()
+    failures, read_failures, done = [], [], threading.Event()
+
+    def write(writer, submission_id):
+        with app.app_context():
+            for index in range(operations):
+                code = 'print({})\n'.format(index) * 20
+                try:
+                    submission = Submission.query.get(submission_id)
+                    submission.code = code
+                    submission.version += 1
+                    db.session.commit()
+                    Log.new(1, 0, 1, writer + 1, 'File.Edit', 'answer.py', '', '', code,
+                            str(int(time.time() * 1000)), '-0400')
+                except Exception as e:  # pylint: disable=broad-except
+                    # Count every failure, so that a broken write can't pass for a fast one
+                    db.session.rollback()
+                    failures.append(describe_error(e))
+            db.session.remove()
+
+    def read():
+        with app.app_context():
+            while not done.is_set():
+                try:
+                    Log.get_history(1, 1, 1)
+                except Exception as e:  # pylint: disable=broad-except
+                    db.session.rollback()
+                    read_failures.append(describe_error(e))
+                db.session.remove()
+
+    threads = [threading.Thread(target=read) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    started = time.perf_counter()
+    writing = [threading.Thread(target=write, args=(writer, submission_id))
+               for writer, submission_id in enumerate(submission_ids)]
+    for thread in writing:
+        thread.start()
+    for thread in writing:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    for thread in threads:
+        thread.join()
+    attempted = writers * operations
+    return {'writers': writers, 'readers': readers, 'attempted': attempted,
+            'failed': len(failures), 'failed_reads': len(read_failures), 'elapsed': elapsed,
+            'throughput': (attempted - len(failures)) / elapsed,
+            'sample_errors': sorted(set(failures + read_failures))[:3]}
+
+
+def compare_sqlite_tuning(writers: int = 8, operations: int = 50, readers: int = 2) -> List[dict]:
+    """
+    Run the same concurrent autosave workload against a fresh SQLite file with and
+    without `SQLITE_TUNING`.
+    :return: The results of each run
+    """
+    from main import create_app
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for tuned in (False, True):
+            app = create_app('testing')
+            path = os.path.join(directory, 'tuned-{}.db'.format(tuned))
+            app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + path, SQLITE_TUNING=tuned)
+            result = run_concurrent_writes(app, writers, operations, readers)
+            result['sqlite_tuning'] = tuned
+            results.append(result)
+            with app.app_context():
+                db.engine.dispose()
+    return results
+
+
+def get_revision() -> Optional[str]:
+    """ The git commit being benchmarked, if known. """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def describe_environment(course: SyntheticCourse) -> dict:
+    """ Everything needed to tell whether two benchmark runs are comparable. """
+    return {
+        'date': datetime.utcnow().isoformat(),
+        'revision': get_revision(),
+        'site_version': current_app.config.get('SITE_VERSION'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'database': db.engine.dialect.name,
+        'students': len(course.student_ids),
+        'assignments': len(course.assignment_ids),
+        'groups': len(course.group_ids),
+        'submissions': len(course.submission_ids),
+        'events': course.events
+    }
@@ -0,0 +1,270 @@
+"""
+Replays request traces (recorded by `controllers.tracing`, or seeded from a typical
+mix of lab-session traffic) against an in-process app or a live local server, and
+reports the latency distribution and errors.
+
+    python manage.py seed_trace --duration 600 --rate 20 --output lab.jsonl
+    python manage.py loadtest lab.jsonl --url http://localhost:5000 --speedup 4 --concurrency 32
+"""
+import http.client
+import json
+import math
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlencode, urlsplit
+
+from flask import Flask
+
+#: The traffic of a typical lab session: for each kind of request, its share of the
+#: traffic, its method and URL rule (one of this app's routes), the names of its query
+#: parameters, and the median size of its body (in bytes). LTI launches are left out,
+#: since they need OAuth signatures that a seeded trace cannot make up.
+DEFAULT_MIX = {
+    'autosave': {'weight': 0.55, 'method': 'PUT', 'rule': '/v1/submissions/<int:submission_id>/code',
+                 'content_type': 'application/json', 'request_bytes': 2400},
+    'load_editor': {'weight': 0.24, 'method': 'GET', 'rule': '/v1/assignments/<int:assignment_id>/editor',
+                    'request_bytes': 0},
+    'get_submission': {'weight': 0.12, 'method': 'GET', 'rule': '/v1/submissions/<int:submission_id>',
+                       'request_bytes': 0},
+    'get_group': {'weight': 0.05, 'method': 'GET', 'rule': '/v1/groups/<int:group_id>', 'request_bytes': 0},
+    'analytics': {'weight': 0.02, 'method': 'GET', 'rule': '/v1/assignments/<int:assignment_id>/analytics',
+                  'request_bytes': 0},
+    'search': {'weight': 0.02, 'method': 'GET', 'rule': '/v1/courses/<int:course_id>/search', 'query': ['q'],
+               'request_bytes': 0},
+}
+
+_CONVERTERS = re.compile(r"<(?:(\w+)(?:\([^)]*\))?:)?(\w+)>")
+
+
+def load_trace(path: str) -> List[dict]:
+    """ Read a JSON-lines trace, in order of arrival. """
+    with open(path) as trace_file:
+        entries = [json.loads(line) for line in trace_file if line.strip()]
+    return sorted(entries, key=lambda entry: entry['offset'])
+
+
+def save_trace(entries: List[dict], path: str):
+    with open(path, 'w') as trace_file:
+        for entry in entries:
+            trace_file.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def seed_trace(duration: float = 60.0, rate: float = 5.0, mix: Dict[str, dict] = None,
+               seed: int = 0) -> List[dict]:
+    """
+    Generate a synthetic trace: requests arrive at random (Poisson) at the given
+    average rate, their kinds drawn from the mix, and their sizes spread around
+    each kind's median.
+    :param duration: Seconds of traffic to generate
+    :param rate: Average requests per second
+    :param mix: The kinds of requests (see `DEFAULT_MIX`)
+    :param seed: Random seed, for reproducible traces
+    :return: The trace entries
+    """
+    mix = mix or DEFAULT_MIX
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind]['weight'] for kind in kinds]
+    entries, offset = [], rng.expovariate(rate)
+    while offset < duration:
+        kind = rng.choices(kinds, weights)[0]
+        shape = mix[kind]
+        entries.append({'offset': round(offset, 6), 'kind': kind, 'method': shape['method'],
+                        'endpoint': kind, 'rule': shape['rule'], 'query': shape.get('query', []),
+                        'content_type': shape.get('content_type'),
+                        'request_bytes': int(shape['request_bytes'] * rng.lognormvariate(0, 0.5))})
+        offset += rng.expovariate(rate)
+    return entries
+
+
+def course_params(course) -> Dict[str, str]:
+    """ Values for the URL rule variables and query parameters of `DEFAULT_MIX`, from a synthetic course. """
+    return {'course_id': str(course.course_id), 'assignment_id': str(course.assignment_ids[0]),
+            'group_id': str(course.group_ids[0]), 'submission_id': str(course.submission_ids[0]), 'q': 'print'}
+
+
+def check_rules(entries: List[dict], url_map):
+    """
+    Make sure that every entry's URL rule (and method) is one of the app's routes, so
+    that a replay never quietly measures nothing but 404s.
+    :param entries: The trace
+    :param url_map: The app's `url_map`
+    :raises ValueError: If any are not
+    """
+    routes = {(rule.rule, method) for rule in url_map.iter_rules() for method in rule.methods}
+    unknown = sorted({'{} {}'.format(entry['method'], entry['rule']) for entry in entries
+                      if entry.get('rule') and (entry['rule'], entry['method']) not in routes})
+    if unknown:
+        raise ValueError("The trace has requests that are not routes of this app: " + ", ".join(unknown))
+
+
+def make_path(entry: dict, params: Dict[str, str] = None) -> str:
+    """
+    Turn the entry's URL rule back into a concrete path, filling in each variable
+    from `params` (or with a placeholder), and its query parameters with dummy values.
+    """
+    params = params or {}
+
+    def fill(match):
+        converter, name = match.groups()
+        if name in params:
+            return str(params[name])
+        return '1' if converter in ('int', 'float') else 'x'
+    path = _CONVERTERS.sub(fill, entry.get('rule') or '/')
+    if entry.get('query'):
+        path += '?' + urlencode({name: params.get(name, 'x') for name in entry['query']})
+    return path
+
+
+def make_body(entry: dict) -> Optional[bytes]:
+    """ A filler body of the same size and type as the original. """
+    size = entry.get('request_bytes') or 0
+    if not size:
+        return None
+    if entry.get('content_type') == 'application/json':
+        return json.dumps({'code': 'x' * max(0, size - 12)}).encode('utf-8')
+    if entry.get('content_type') == 'application/x-www-form-urlencoded':
+        return ('code=' + 'x' * max(0, size - 5)).encode('utf-8')
+    return b'x' * size
+
+
+class FlaskTarget:
+    """ Sends requests to an app in this process, through its test client. """
+
+    def __init__(self, app: Flask, headers: Dict[str, str] = None):
+        """
+        :param app: The app to send requests to
+        :param headers: Sent with every request (e.g., an Authorization token)
+        """
+        self.app = app
+        self.headers = headers or {}
+        self._local = threading.local()
+
+    def send(self, method: str, path: str, body: Optional[bytes], content_type: Optional[str]) -> int:
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, data=body, content_type=content_type, headers=self.headers)
+        return response.status_code
+
+
+class HttpTarget:
+    """ Sends requests to a live server, over one keep-alive connection per worker thread. """
+
+    def __init__(self, base_url: str, timeout: float = 30, headers: Dict[str, str] = None):
+        parts = urlsplit(base_url)
+        self.connection_class = (http.client.HTTPSConnection if parts.scheme == 'https'
+                                 else http.client.HTTPConnection)
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.headers = headers or {}
+        self._local = threading.local()
+
+    def send(self, method: str, path: str, body: Optional[bytes], content_type: Optional[str]) -> int:
+        headers = dict(self.headers)
+        if content_type:
+            headers['Content-Type'] = content_type
+        for attempt in range(2):
+            connection = getattr(self._local, 'connection', None)
+            if connection is None:
+                connection = self._local.connection = self.connection_class(self.netloc, timeout=self.timeout)
+            try:
+                connection.request(method, self.prefix + path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                return response.status
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+
+def percentile(ordered: List[float], fraction: float) -> Optional[float]:
+    """ The value below which the given fraction of the (sorted) values fall. """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def summarize_latencies(latencies: List[float]) -> dict:
+    ordered = sorted(latencies)
+    return {'count': len(ordered),
+            'p50': percentile(ordered, 0.5),
+            'p90': percentile(ordered, 0.9),
+            'p99': percentile(ordered, 0.99),
+            'max': ordered[-1] if ordered else None,
+            'mean': sum(ordered) / len(ordered) if ordered else None}
+
+
+def replay(entries: List[dict], target, speedup: float = 1.0, concurrency: int = 8,
+           params: Dict[str, str] = None) -> dict:
+    """
+    Send each entry's request at its (sped up) offset. At most `concurrency` requests
+    are in flight at once; if they are all busy, later requests wait, and that wait
+    is reported as lag.
+    :param entries: The trace (see `load_trace` and `seed_trace`)
+    :param target: A `FlaskTarget` or `HttpTarget`
+    :param speedup: How many times faster than recorded to send the requests
+    :param concurrency: The most requests to have in flight at once
+    :param params: Values for the variables in the URL rules
+    :return: The report, with latencies (in seconds) overall and for each kind of request
+    """
+    results, lock = [], threading.Lock()
+
+    def send(entry, scheduled):
+        started = time.perf_counter()
+        try:
+            status, error = target.send(entry['method'], make_path(entry, params), make_body(entry),
+                                        entry.get('content_type')), None
+        except Exception as e:  # pylint: disable=broad-except
+            status, error = None, '{}: {}'.format(type(e).__name__, e)
+        finished = time.perf_counter()
+        with lock:
+            results.append((entry.get('kind') or entry.get('endpoint') or entry.get('rule'),
+                            status, error, finished - started, started - scheduled))
+
+    began = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='blockpy-loadtest') as executor:
+        for entry in entries:
+            scheduled = began + entry['offset'] / speedup
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, entry, scheduled)
+    elapsed = time.perf_counter() - began
+    return build_report(results, elapsed)
+
+
+def is_failure(status: Optional[int], error: Optional[str]) -> bool:
+    """ Whether the request failed: it raised, or was answered with anything but a success or redirect. """
+    return bool(error) or status is None or not 200 <= status < 400
+
+
+def build_report(results: List[tuple], elapsed: float) -> dict:
+    by_kind = {}
+    for kind, status, error, latency, lag in results:
+        by_kind.setdefault(kind, []).append((status, error, latency, lag))
+    report = {'elapsed': elapsed,
+              'requests': len(results),
+              'throughput': len(results) / elapsed if elapsed else None,
+              'kinds': {}}
+    for kind, outcomes in sorted(by_kind.items(), key=lambda item: str(item[0])):
+        statuses = {}
+        for status, _, _, _ in outcomes:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        report['kinds'][str(kind)] = {
+            'latency': summarize_latencies([latency for _, _, latency, _ in outcomes]),
+            'lag': summarize_latencies([lag for _, _, _, lag in outcomes]),
+            'statuses': statuses,
+            'errors': sum(1 for status, error, _, _ in outcomes if is_failure(status, error)),
+            'sample_errors': sorted({error for _, error, _, _ in outcomes if error})[:5]
+        }
+    report['latency'] = summarize_latencies([latency for _, _, _, latency, _ in results])
+    report['errors'] = sum(kind['errors'] for kind in report['kinds'].values())
+    return report
@@ -0,0 +1,194 @@
+"""
+Generate realistic synthetic courses, for benchmarking and load testing.
+
+A synthetic course has an instructor and a roster of students, assignments
+organized into groups, a submission per student per assignment, reviews of the
+reviewed assignments, and a stream of `Log` events (edits with growing code bodies,
+runs, errors, feedback, and submissions) for every submission.
+
+Small objects are created through the ORM; the log events, which can number in the
+millions, are inserted in bulk batches.
+"""
+import random
+from datetime import datetime, timedelta
+from typing import List, NamedTuple
+
+from models.generics.models import db
+from models.user import User
+from models.role import Role
+from models.course import Course
+from models.assignment import Assignment
+from models.assignment_group import AssignmentGroup
+from models.assignment_group_membership import AssignmentGroupMembership
+from models.submission import Submission, SubmissionStatuses, GradingStatuses
+from models.review import Review
+from models.log import Log
+
+#: How many log events to insert at once
+BATCH_SIZE = 5000
+
+CODE_LINES = [
+    "{name} = {value}",
+    "print({name})",
+    "for {name} in range({value}):",
+    "    total = total + {name}",
+    "if {name} > {value}:",
+    "    print('{word}')",
+    "def {name}_{word}({name}):",
+    "    return {name} * {value}",
+    "{name} = [{value}, {value}, {value}]",
+    "import {word}",
+]
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'weather', 'sneks', 'maze', 'stock', 'grade', 'total']
+FEEDBACK = ['Complete', 'Syntax Error', 'Runtime Error', 'Instructor Feedback', 'Analyzer Error']
+
+
+class SyntheticCourse(NamedTuple):
+    """ The identifiers of everything generated for a synthetic course. """
+    course_id: int
+    instructor_id: int
+    student_ids: List[int]
+    assignment_ids: List[int]
+    group_ids: List[int]
+    submission_ids: List[int]
+    events: int
+
+
+def generate_code(rng: random.Random, lines: int) -> str:
+    """ Make a plausible-looking Python program of the given number of lines. """
+    return "\n".join(rng.choice(CODE_LINES).format(name=rng.choice(WORDS)[:rng.randint(1, 5)],
+                                                  value=rng.randint(0, 100), word=rng.choice(WORDS))
+                     for _ in range(lines))
+
+
+def generate_course(students: int = 30, assignments: int = 20, groups: int = 4,
+                    events: int = 20000, reviewed_fraction: float = 0.25,
+                    seed: int = 0, label: str = None) -> SyntheticCourse:
+    """
+    Create a synthetic course in the current database.
+
+    :param students: How many students to enroll
+    :param assignments: How many assignments to create
+    :param groups: How many assignment groups to spread the assignments across
+    :param events: Roughly how many log events to create, in total
+    :param reviewed_fraction: The fraction of assignments that are manually reviewed
+    :param seed: Seed for the random generator, so that runs are reproducible
+    :param label: Distinguishes this course's names, emails and urls from other synthetic courses
+    :return: The identifiers of the generated data
+    """
+    rng = random.Random(seed)
+    label = label or 'synthetic-{}-{}'.format(seed, rng.getrandbits(32))
+    instructor = User(first_name='Instructor', last_name=label, email='{}-instructor@example.com'.format(label),
+                      password='', active=True)
+    db.session.add(instructor)
+    db.session.flush()
+    course = Course(name='Course ' + label, url=label, owner_id=instructor.id, visibility='private')
+    db.session.add(course)
+    db.session.flush()
+    db.session.add(Role(name='instructor', user_id=instructor.id, course_id=course.id))
+
+    learners = [User(first_name='Student{}'.format(index), last_name=rng.choice(WORDS).title(),
+                     email='{}-student{}@example.com'.format(label, index), password='', active=True)
+                for index in range(students)]
+    db.session.add_all(learners)
+    db.session.flush()
+    db.session.add_all([Role(name='learner', user_id=learner.id, course_id=course.id) for learner in learners])
+
+    assignment_rows = [Assignment(name='{} {}'.format(rng.choice(WORDS).title(), index),
+                                  url='{}/assignment/{}'.format(label, index),
+                                  type='blockpy', instructions='Write a program about ' + rng.choice(WORDS),
+                                  reviewed=rng.random() < reviewed_fraction,
+                                  starting_code=generate_code(rng, 3), on_run=generate_code(rng, 5),
+                                  owner_id=instructor.id, course_id=course.id, version=0)
+                       for index in range(assignments)]
+    db.session.add_all(assignment_rows)
+    group_rows = [AssignmentGroup(name='Week {}'.format(index), url='{}/group/{}'.format(label, index),
+                                  owner_id=instructor.id, course_id=course.id, position=index)
+                  for index in range(groups)]
+    db.session.add_all(group_rows)
+    db.session.flush()
+    if group_rows:
+        db.session.add_all([AssignmentGroupMembership(assignment_group_id=group_rows[index % groups].id,
+                                                      assignment_id=assignment.id, position=index)
+                            for index, assignment in enumerate(assignment_rows)])
+
+    submission_rows = []
+    for learner in learners:
+        for assignment in assignment_rows:
+            status = rng.choice(SubmissionStatuses.VALID_CHOICES)
+            correct = status == SubmissionStatuses.COMPLETED or rng.random() < 0.3
+            submission_rows.append(Submission(
+                code=generate_code(rng, rng.randint(5, 40)), assignment_id=assignment.id,
+                course_id=course.id, user_id=learner.id, submission_status=status,
+                grading_status=(GradingStatuses.PENDING_MANUAL if assignment.reviewed
+                                else GradingStatuses.FULLY_GRADED if correct else GradingStatuses.NOT_READY),
+                score=100 if correct else rng.randint(0, 99), correct=correct,
+                assignment_version=0, version=0))
+    db.session.add_all(submission_rows)
+    db.session.flush()
+
+    reviews = []
+    for submission, assignment in zip(submission_rows, assignment_rows * students):
+        if assignment.reviewed and rng.random() < 0.5:
+            review = Review(comment='Looks like ' + rng.choice(WORDS), location=str(rng.randint(1, 20)),
+                            score=rng.randint(-10, 10), submission_id=submission.id,
+                            author_id=instructor.id, version=0)
+            reviews.append(review)
+    db.session.add_all(reviews)
+    db.session.commit()
+
+    generated = generate_events(rng, course.id, submission_rows, events)
+    return SyntheticCourse(course.id, instructor.id, [learner.id for learner in learners],
+                           [assignment.id for assignment in assignment_rows],
+                           [group.id for group in group_rows],
+                           [submission.id for submission in submission_rows], generated)
+
+
+def generate_events(rng: random.Random, course_id: int, submissions: List[Submission], events: int) -> int:
+    """
+    Insert roughly `events` log events spread across the submissions, in bulk.
+    Each submission gets a chronological work history: edits whose code grows over
+    time, interleaved with runs, errors, feedback, and occasional submissions.
+    :return: How many events were inserted
+    """
+    if not submissions:
+        return 0
+    per_submission = max(1, events // len(submissions))
+    start = datetime.utcnow() - timedelta(days=60)
+    table = Log.__table__
+    batch, inserted = [], 0
+    for submission in submissions:
+        moment = start + timedelta(minutes=rng.randint(0, 60 * 24 * 50))
+        lines = rng.randint(1, 5)
+        for _ in range(per_submission):
+            moment += timedelta(seconds=rng.randint(2, 600))
+            roll = rng.random()
+            if roll < 0.45:
+                lines += rng.randint(0, 2)
+                event = ('File.Edit', 'answer.py', '', '', generate_code(rng, lines))
+            elif roll < 0.7:
+                event = ('Run.Program', 'answer.py', 'ProgramRun', '', '')
+            elif roll < 0.8:
+                event = ('Compile.Error', 'answer.py', '', '', 'SyntaxError: bad input on line {}'.format(lines))
+            elif roll < 0.97:
+                category = rng.choice(FEEDBACK)
+                event = ('Intervention', 'answer.py', category, rng.choice(WORDS), 'Feedback about ' + category)
+            else:
+                event = ('X-Submission.LMS', '', '', '', str(rng.random()))
+            event_type, file_path, category, label, message = event
+            batch.append({'assignment_id': submission.assignment_id, 'assignment_version': 0,
+                          'course_id': course_id, 'subject_id': submission.user_id,
+                          'event_type': event_type, 'file_path': file_path, 'category': category,
+                          'label': label, 'message': message,
+                          'client_timestamp': str(int(moment.timestamp() * 1000)),
+                          'client_timezone': '-0400',
+                          'date_created': moment, 'date_modified': moment})
+            if len(batch) >= BATCH_SIZE:
+                db.session.execute(table.insert(), batch)
+                inserted += len(batch)
+                batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+        inserted += len(batch)
+    db.session.commit()
+    return inserted
@@ -2,10 +2,15 @@
 Testing functionality specifically related to LTI login/access.
 """
 
+import json
+import os
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from flask import g
 
+from common.ip_ranges import IpRangePolicy
 from main import create_app
 
 
@@ -22,3 +27,1489 @@ class BasicTests(unittest.TestCase):
         """ Check that we can even access the context """
         with self.app.app_context():
             self.assertTrue(g)
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Gives each test its own SQLite database, within an app context
+    """
+    def setUp(self):
+        """ Create the database and its tables """
+        import tempfile
+        from models.generics.models import db
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app('testing')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(self.directory.name, 'test.db')
+        self.context = self.app.app_context()
+        self.context.push()
+        self.db = db
+        db.create_all()
+        # The controllers only register the login check with the first app that imports them
+        from controllers.auth import check_login
+        if check_login not in self.app.before_request_funcs.get(None, []):
+            self.app.before_request(check_login)
+
+    def tearDown(self):
+        """ Throw the database away """
+        self.db.session.remove()
+        self.db.get_engine().dispose()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def make_user(self, email, roles=(), course_id=None):
+        """ A user with the given roles in the course """
+        from models.user import User
+        user = User(email=email, first_name='First', last_name='Last', active=True)
+        self.db.session.add(user)
+        self.db.session.commit()
+        for role in roles:
+            user.add_role(role, course_id)
+        return user
+
+    def logged_in(self, email=None):
+        """ Treat requests as coming from the user with this email (or anonymously), while patched """
+        from unittest import mock
+        from controllers import auth
+        if email is None:
+            return mock.patch.object(auth, 'get_identity_from_request',
+                                     side_effect=auth.NoAuthorizationError("No token"))
+        return mock.patch.object(auth, 'get_identity_from_request', return_value={'email': email})
+
+
+class IpRangePolicyTests(unittest.TestCase):
+    """
+    Confirm that compiled IP access policies follow the `ip_ranges` rules
+    """
+    def test_unrestricted(self):
+        """ Blank ranges allow anyone """
+        self.assertTrue(IpRangePolicy("").is_allowed("8.8.8.8"))
+        self.assertTrue(IpRangePolicy(None).is_allowed("not an ip"))
+
+    def test_whitelist_and_blacklist(self):
+        """ Networks, blacklists, and overrides """
+        policy = IpRangePolicy("192.168.0.0/24, ^192.168.0.8/29, !192.168.0.9, junk")
+        self.assertTrue(policy.is_allowed("192.168.0.5"))
+        self.assertFalse(policy.is_allowed("192.168.0.10"))
+        self.assertTrue(policy.is_allowed("192.168.0.9"))
+        self.assertFalse(policy.is_allowed("10.0.0.1"))
+        self.assertFalse(policy.is_allowed("::1"))
+        self.assertFalse(policy.is_allowed("garbage"))
+
+
+class StubLMSHandler(BaseHTTPRequestHandler):
+    """ Pretends to be an LMS outcome service that accepts every grade """
+    protocol_version = 'HTTP/1.1'
+    SUCCESS = b"<imsx_codeMajor>success</imsx_codeMajor>"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.seen.append((self.client_address, self.headers.get('Authorization', '')))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(self.SUCCESS)))
+        self.end_headers()
+        self.wfile.write(self.SUCCESS)
+
+    def log_message(self, *args):
+        pass
+
+
+class LTIConnectionPoolTests(unittest.TestCase):
+    """
+    Confirm that grade posts reuse keep-alive connections to the LMS
+    """
+    def setUp(self):
+        """ Start the stub LMS """
+        self.app = create_app('testing')
+        from controllers.pylti import common
+        self.common = common
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubLMSHandler)
+        self.server.seen = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/grade'.format(self.server.server_address[1])
+        self.consumers = {'key': {'secret': 'secret'}}
+
+    def tearDown(self):
+        """ Stop the stub LMS """
+        self.common.configure_connection_pools()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        """ Sequential posts share one connection """
+        for _ in range(5):
+            xml = self.common.generate_request_xml('id', 'replaceResult', 'sourcedid', 0.5)
+            self.assertTrue(self.common.post_message(self.consumers, 'key', self.url, xml))
+        self.assertEqual(len(self.server.seen), 5)
+        self.assertEqual(len({address for address, _ in self.server.seen}), 1)
+        self.assertTrue(all(header.startswith('OAuth') for _, header in self.server.seen))
+
+    def test_concurrency_limit(self):
+        """ Concurrent posts never open more connections than allowed """
+        self.common.configure_connection_pools(max_connections=2)
+        xml = self.common.generate_request_xml('id', 'replaceResult', 'sourcedid', 1.0)
+        threads = [threading.Thread(target=self.common.post_message, args=(self.consumers, 'key', self.url, xml))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.seen), 8)
+        self.assertLessEqual(len({address for address, _ in self.server.seen}), 2)
+
+
+class NonceCacheTests(unittest.TestCase):
+    """
+    Confirm that replayed LTI launches are rejected
+    """
+    def setUp(self):
+        """ Set up the nonce cache """
+        self.app = create_app('testing')
+        from controllers.pylti import common
+        self.common = common
+        self.cache = common.NonceCache(common.MemoryNonceStore(max_size=3), timestamp_threshold=300)
+
+    def test_replay_rejected(self):
+        """ A nonce can only be used once per consumer """
+        self.cache.check('key', 'abc', 1000, now=1000)
+        self.cache.check('other', 'abc', 1000, now=1000)
+        self.assertRaises(self.common.oauth2.Error, self.cache.check, 'key', 'abc', 1000, now=1100)
+
+    def test_stale_timestamp_rejected(self):
+        """ Timestamps outside the window are rejected, so expired nonces can be forgotten """
+        self.assertRaises(self.common.oauth2.Error, self.cache.check, 'key', 'abc', 1000, now=1301)
+        self.assertRaises(self.common.oauth2.Error, self.cache.check, 'key', 'abc', 1000, now=699)
+        self.cache.check('key', 'abc', 1000, now=1000)
+        self.cache.check('key', 'abc', 2000, now=2000)
+
+    def test_bounded(self):
+        """ The store never grows past its size """
+        for index in range(10):
+            self.cache.check('key', str(index), 1000, now=1000)
+        self.assertLessEqual(len(self.cache.store._entries), 3)
+
+
+class DatabaseNonceStoreTests(DatabaseTestCase):
+    """
+    Confirm that nonces stored in the database are shared between stores, and forgotten when they expire
+    """
+    def test_replay_across_stores(self):
+        """ A nonce used through one store (i.e., process) is rejected by another """
+        from concurrent.futures import ThreadPoolExecutor
+        from models.lti_nonce import DatabaseNonceStore
+        self.assertTrue(DatabaseNonceStore().add('key:abc', 1300, 1000))
+        self.assertFalse(DatabaseNonceStore().add('key:abc', 1400, 1100))
+        self.assertTrue(DatabaseNonceStore().add('other:abc', 1300, 1000))
+
+        def add(_):
+            with self.app.app_context():
+                return DatabaseNonceStore().add('key:racing', 1300, 1000)
+        with ThreadPoolExecutor(4) as pool:
+            self.assertEqual(sorted(pool.map(add, range(8))), [False] * 7 + [True])
+
+    def test_expiry(self):
+        """ An expired nonce can be used again, and is purged """
+        from models.lti_nonce import DatabaseNonceStore, LtiNonce
+        store = DatabaseNonceStore(purge_interval=3)
+        self.assertTrue(store.add('key:abc', 1300, 1000))
+        self.assertTrue(store.add('key:def', 1300, 1000))
+        self.assertFalse(store.add('key:abc', 1599, 1299))
+        self.assertTrue(store.add('key:abc', 1700, 1400))
+        self.assertEqual(LtiNonce.query.filter_by(key='key:abc').one().expires, 1700)
+        self.assertFalse(store.add('key:abc', 1800, 1500))
+        # Every third insertion purges the nonces expired by then
+        self.assertTrue(store.add('key:ghi', 1900, 1600))
+        self.assertEqual(sorted(nonce.key for nonce in LtiNonce.query), ['key:abc', 'key:ghi'])
+
+    def test_request_session_untouched(self):
+        """ Checking a nonce neither commits nor rolls back the request's own work """
+        from models.course import Course
+        from models.lti_nonce import DatabaseNonceStore
+        course = Course(name='CS1')
+        self.db.session.add(course)
+        self.assertTrue(DatabaseNonceStore().add('key:abc', 1300, 1000))
+        self.assertFalse(DatabaseNonceStore().add('key:abc', 1300, 1000))
+        self.assertIn(course, self.db.session.new)
+        self.db.session.rollback()
+        self.assertEqual(Course.query.count(), 0)
+
+
+class JWTFastPathTests(unittest.TestCase):
+    """
+    Confirm that check_login finds and verifies tokens without the full JWT machinery
+    """
+    def setUp(self):
+        """ Create a token to authenticate with """
+        self.app = create_app('testing')
+        from flask_jwt_extended import create_access_token
+        from controllers import auth
+        self.auth = auth
+        with self.app.app_context():
+            self.token = create_access_token(identity='ada@example.com')
+
+    def test_header_token_cached(self):
+        """ A header token is verified once, then served from the cache """
+        auth = self.auth
+        for _ in range(2):
+            with self.app.test_request_context('/', headers={'Authorization': 'Bearer ' + self.token}):
+                self.assertEqual(auth.get_identity_from_request(), 'ada@example.com')
+        self.assertTrue(any(entry[1]['sub'] == 'ada@example.com'
+                            for entry in auth._VERIFIED_TOKENS._data.values()))
+
+    def test_json_body_ignored(self):
+        """ Tokens in JSON bodies are only used if configured """
+        auth = self.auth
+        with self.app.test_request_context('/', method='POST', json={'access_token': self.token}):
+            self.assertRaises(auth.NoAuthorizationError, auth.get_identity_from_request)
+        self.app.config['JWT_CHECK_JSON_BODY'] = True
+        with self.app.test_request_context('/', method='POST', json={'access_token': self.token}):
+            self.assertEqual(auth.get_identity_from_request(), 'ada@example.com')
+
+    def test_cookie_requires_csrf(self):
+        """ Cookie tokens still need the CSRF header on unsafe methods """
+        auth = self.auth
+        cookie = '{}={}'.format(self.app.config.get('JWT_ACCESS_COOKIE_NAME', 'access_token_cookie'), self.token)
+        with self.app.test_request_context('/', method='POST', headers={'Cookie': cookie}):
+            self.assertRaises(auth.CSRFError, auth.get_identity_from_request)
+        with self.app.test_request_context('/', method='POST', headers={'Cookie': cookie, 'X-CSRF-TOKEN': 'nope'}):
+            self.assertRaises(auth.CSRFError, auth.get_identity_from_request)
+        with self.app.test_request_context('/', method='GET', headers={'Cookie': cookie}):
+            self.assertEqual(auth.get_identity_from_request(), 'ada@example.com')
+
+
+class QueryInstrumentationTests(unittest.TestCase):
+    """
+    Confirm that repeated per-row queries are detected
+    """
+    def setUp(self):
+        """ Load the instrumentation """
+        self.app = create_app('testing')
+
+    def test_fingerprint(self):
+        """ Queries that differ only in their parameters share a fingerprint """
+        from controllers.instrumentation import fingerprint
+        self.assertEqual(fingerprint("SELECT * FROM user WHERE id IN (?, ?, ?)"),
+                         fingerprint("SELECT *  FROM user\nWHERE id IN (?, ?)"))
+        self.assertEqual(fingerprint("SELECT * FROM user WHERE id = 5 AND name = 'Ada'"),
+                         "SELECT * FROM user WHERE id = ? AND name = ?")
+
+    def test_n_plus_one(self):
+        """ Repeated statements above the threshold are flagged """
+        from controllers.instrumentation import EndpointQueries, RequestQueries
+        queries = RequestQueries()
+        for _ in range(12):
+            queries.record("SELECT * FROM user WHERE user.id = ?", 0.001)
+        queries.record("SELECT * FROM course", 0.002)
+        repeated = queries.get_repeated(10)
+        self.assertEqual(repeated, {"SELECT * FROM user WHERE user.id = ?": 12})
+        stats = EndpointQueries()
+        stats.add(queries, repeated)
+        report = stats.encode_json()
+        self.assertEqual(report['queries'], 13)
+        self.assertEqual(report['n_plus_one'][0]['requests'], 1)
+
+    def test_report_restricted(self):
+        """ Instrumentation is off unless enabled, and its report is only served to the metrics addresses """
+        from config import DevelopmentConfig, ProductionConfig
+        from werkzeug.exceptions import NotFound
+        from controllers.instrumentation import get_query_stats, init_instrumentation
+        self.assertFalse(ProductionConfig.SQL_INSTRUMENTATION)
+        self.assertTrue(DevelopmentConfig.SQL_INSTRUMENTATION)
+        self.assertNotIn('sql_instrumentation', self.app.extensions)
+        self.app.config['SQL_INSTRUMENTATION'] = True
+        init_instrumentation(self.app)
+        with self.app.test_request_context(environ_base={'REMOTE_ADDR': '10.1.2.3'}):
+            self.assertRaises(NotFound, get_query_stats)
+        with self.app.test_request_context(environ_base={'REMOTE_ADDR': '127.0.0.1'}):
+            self.assertEqual(get_query_stats().get_json()['endpoints'], {})
+
+
+class RequestMetricsTests(unittest.TestCase):
+    """
+    Confirm that latency histograms are rendered and aggregated across processes
+    """
+    def setUp(self):
+        """ Load the metrics """
+        self.app = create_app('testing')
+        from controllers import metrics
+        self.metrics = metrics
+
+    def test_histogram(self):
+        """ Requests land in cumulative buckets, with the database time split out """
+        collected = self.metrics.RequestMetrics(buckets=(0.1, 1.0))
+        for duration in (0.05, 0.5, 5.0):
+            collected.start('v1.get_thing')
+            collected.finish('v1.get_thing', 'GET', 200, duration, 0.01)
+        text = collected.render()
+        labels = 'endpoint="v1.get_thing",method="GET",status="200"'
+        self.assertIn('blockpy_request_duration_seconds_bucket{%s,le="0.1"} 1' % labels, text)
+        self.assertIn('blockpy_request_duration_seconds_bucket{%s,le="1.0"} 2' % labels, text)
+        self.assertIn('blockpy_request_duration_seconds_bucket{%s,le="+Inf"} 3' % labels, text)
+        self.assertIn('blockpy_request_duration_seconds_count{%s} 3' % labels, text)
+        self.assertIn('blockpy_requests_in_flight{endpoint="v1.get_thing"} 0', text)
+
+    def test_multiprocess(self):
+        """ Snapshots written by other workers are added in """
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            other = self.metrics.RequestMetrics(buckets=(0.1,), multiprocess_dir=directory)
+            other.start('lti_launch')
+            other.finish('lti_launch', 'POST', 302, 0.05, 0.0)
+            snapshot = other.snapshot()
+            snapshot['pid'] = -1
+            with open(os.path.join(directory, 'metrics_other.json'), 'w') as snapshot_file:
+                json.dump(snapshot, snapshot_file)
+            mine = self.metrics.RequestMetrics(buckets=(0.1,), multiprocess_dir=directory)
+            mine.start('lti_launch')
+            mine.finish('lti_launch', 'POST', 302, 0.05, 0.0)
+            self.assertIn('blockpy_request_duration_seconds_count{endpoint="lti_launch",method="POST",'
+                          'status="302"} 2', mine.render())
+
+
+class MetricsAccessTests(DatabaseTestCase):
+    """
+    Confirm that request metrics time the database on their own, and are only served to metrics clients
+    """
+    def test_db_time(self):
+        """ Statements are timed even when the query instrumentation is off """
+        from unittest import mock
+        from models.course import Course
+        self.assertFalse(self.app.config['SQL_INSTRUMENTATION'])
+        self.app.add_url_rule('/count', 'count', lambda: str(Course.query.count()))
+        metrics = self.app.extensions['metrics']
+        with self.logged_in(), mock.patch.object(metrics, 'finish') as finish:
+            self.app.test_client().get('/count')
+        endpoint, method, status, duration, db_time = finish.call_args[0]
+        self.assertEqual((endpoint, status), ('count', 200))
+        self.assertTrue(0 < db_time <= duration)
+
+    def test_token(self):
+        """ Once a token is configured, even local callers must present it """
+        client = self.app.test_client()
+        self.assertEqual(client.get('/metrics', environ_base={'REMOTE_ADDR': '10.1.2.3'}).status_code, 404)
+        self.assertEqual(client.get('/metrics').status_code, 200)
+        self.app.config['METRICS_TOKEN'] = 'sesame'
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        self.assertEqual(client.get('/metrics', headers={'X-Metrics-Token': 'nope'}).status_code, 404)
+        self.assertEqual(client.get('/metrics', headers={'X-Metrics-Token': 'sesame'},
+                                    environ_base={'REMOTE_ADDR': '10.1.2.3'}).status_code, 200)
+
+    def test_behind_proxy(self):
+        """ With a trusted proxy, the client's own address is checked rather than the proxy's """
+        from unittest import mock
+        import config
+        with mock.patch.object(config.TestConfig, 'PROXY_FIX_X_FOR', 1):
+            client = create_app('testing').test_client()
+        forwarded = {'X-Forwarded-For': '203.0.113.5'}
+        self.assertEqual(client.get('/metrics', headers=forwarded).status_code, 404)
+        self.assertEqual(client.get('/metrics').status_code, 200)
+
+
+class BenchmarkTests(unittest.TestCase):
+    """
+    Confirm that the benchmark harness runs against a fresh database
+    """
+    def test_benchmark_command(self):
+        """ The default temporary SQLite database is created, filled, and timed """
+        import tempfile
+        from click.testing import CliRunner
+        from manage import benchmark
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            result = CliRunner().invoke(benchmark, ['--students', '3', '--assignments', '2', '--groups', '1',
+                                                    '--events', '50', '--repeat', '1', '--only', 'gradebook',
+                                                    '--output', output])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with open(output) as f:
+                results = json.load(f)
+        self.assertEqual([run['name'] for run in results['results']], ['gradebook'])
+        self.assertGreater(results['results'][0]['operations'], 0)
+
+
+class LoadTestTests(unittest.TestCase):
+    """
+    Confirm that traces can be seeded and replayed
+    """
+    def setUp(self):
+        """ Load the load tester """
+        self.app = create_app('testing')
+        from scripts import loadtest
+        self.loadtest = loadtest
+
+    def test_seed_trace(self):
+        """ Seeded traces are reproducible, ordered, and follow the mix """
+        first = self.loadtest.seed_trace(duration=30, rate=10, seed=3)
+        self.assertEqual(first, self.loadtest.seed_trace(duration=30, rate=10, seed=3))
+        self.assertEqual([entry['offset'] for entry in first], sorted(entry['offset'] for entry in first))
+        self.assertEqual({entry['kind'] for entry in first}, set(self.loadtest.DEFAULT_MIX))
+
+    def test_make_path(self):
+        """ Rules are filled in with the given parameters, or placeholders """
+        entry = {'rule': '/v1/course/<int:course_id>/<name>', 'query': ['page']}
+        self.assertEqual(self.loadtest.make_path(entry, {'name': 'cs1'}), '/v1/course/1/cs1?page=x')
+
+    def test_replay(self):
+        """ Replaying against the app reports every request """
+        entries = [{'offset': index / 1000, 'method': 'GET', 'rule': '/metrics', 'kind': 'metrics'}
+                   for index in range(20)]
+        report = self.loadtest.replay(entries, self.loadtest.FlaskTarget(self.app), speedup=10, concurrency=4)
+        self.assertEqual(report['requests'], 20)
+        self.assertEqual(report['kinds']['metrics']['statuses'], {'200': 20})
+        self.assertEqual(report['errors'], 0)
+
+    def test_mix_routes(self):
+        """ The default mix only uses the app's routes, and unknown ones are refused """
+        entries = self.loadtest.seed_trace(duration=30, rate=10, seed=3)
+        self.loadtest.check_rules(entries, self.app.url_map)
+        entries.append({'offset': 31, 'method': 'POST', 'rule': '/blockpy/log_event', 'kind': 'log_event'})
+        self.assertRaises(ValueError, self.loadtest.check_rules, entries, self.app.url_map)
+
+    def test_failures_counted(self):
+        """ Client errors count as failures, like server errors """
+        entries = [{'offset': 0, 'method': 'GET', 'rule': '/v1/submissions/<int:submission_id>', 'kind': 'get'},
+                   {'offset': 0, 'method': 'GET', 'rule': '/metrics', 'kind': 'metrics'}]
+        report = self.loadtest.replay(entries, self.loadtest.FlaskTarget(self.app), speedup=10, concurrency=2)
+        self.assertEqual(report['kinds']['get']['errors'], 1)
+        self.assertEqual(report['kinds']['metrics']['errors'], 0)
+        self.assertEqual(report['errors'], 1)
+
+
+class DateCodecTests(unittest.TestCase):
+    """
+    Confirm that timestamps round-trip through the fast codec
+    """
+    def test_round_trip(self):
+        """ Timestamps with and without fractional seconds parse back to the same datetime """
+        from datetime import datetime
+        from common.dates import datetime_to_string, string_to_datetime
+        for moment in (datetime(2020, 1, 2, 3, 4, 5), datetime(2020, 1, 2, 3, 4, 5, 120000)):
+            self.assertEqual(string_to_datetime(datetime_to_string(moment)), moment)
+        self.assertEqual(string_to_datetime('2020-01-02T03:04:05.12Z'), datetime(2020, 1, 2, 3, 4, 5, 120000))
+        self.assertRaises(ValueError, string_to_datetime, 'yesterday')
+
+
+class SerializerTests(unittest.TestCase):
+    """
+    Confirm that the compiled encoders match the models' JSON representations
+    """
+    def setUp(self):
+        self.app = create_app('testing')
+
+    def test_encode_submission(self):
+        """ Columns, datetimes and owner lookups are encoded in order """
+        from datetime import datetime
+        from models.submission import Submission
+        from models.user import User
+        from models.generics.serializers import encode_many
+        moment = datetime(2021, 5, 6, 7, 8, 9)
+        submission = Submission(id=3, code='print(1)', user_id=7, course_id=2, assignment_id=5,
+                                score=100, correct=True, date_created=moment, date_modified=None)
+        encoded = submission.encode_json(use_owner=User(id=7, email='ada@example.com'))
+        self.assertEqual(list(encoded)[:3], ['_schema_version', 'code', 'extra_files'])
+        self.assertEqual(encoded['user_id__email'], 'ada@example.com')
+        self.assertEqual(encoded['date_created'], '2021-05-06T07:08:09Z')
+        self.assertIsNone(encoded['date_modified'])
+        self.assertEqual(encode_many(Submission, [submission], use_owner=False)[0]['user_id__email'], '')
+
+
+class StreamingTests(unittest.TestCase):
+    """
+    Confirm that streamed rows are batched by the configured chunk size
+    """
+    def setUp(self):
+        self.app = create_app('testing')
+
+    def test_chunked(self):
+        """ Rows are grouped into chunks of at most the configured size """
+        from models.generics.streaming import chunked, get_chunk_size
+        self.assertEqual([len(chunk) for chunk in chunked(range(25), 10)], [10, 10, 5])
+        with self.app.app_context():
+            self.app.config['STREAM_CHUNK_SIZE'] = 7
+            self.assertEqual(get_chunk_size(), 7)
+            self.assertEqual(list(chunked(iter([]))), [])
+
+
+class DatabaseRoutingTests(unittest.TestCase):
+    """
+    Confirm that reporting queries go to the replica, unless it is lagging
+    """
+    def setUp(self):
+        import sqlite3
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.uris = {}
+        for name in ('primary', 'replica'):
+            path = os.path.join(self.directory.name, name + '.db')
+            with sqlite3.connect(path) as connection:
+                connection.execute("CREATE TABLE marker (name TEXT)")
+                connection.execute("INSERT INTO marker VALUES (?)", (name,))
+            self.uris[name] = 'sqlite:///' + path
+        self.app = create_app('testing')
+        self.app.config.update(SQLALCHEMY_DATABASE_URI=self.uris['primary'],
+                               DATABASE_REPLICA_URI=self.uris['replica'],
+                               DATABASE_REPLICA_LAG_CHECK_INTERVAL=0)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read_marker(self):
+        from sqlalchemy import text
+        from models.generics.models import db
+        return db.session.execute(text("SELECT name FROM marker")).scalar()
+
+    def test_routing(self):
+        """ Only reads inside of reporting() use the replica """
+        from models.generics.models import db
+        from models.generics.routing import reporting
+        with self.app.app_context():
+            self.assertEqual(self.read_marker(), 'primary')
+            with reporting():
+                self.assertEqual(self.read_marker(), 'replica')
+            db.session.remove()
+            db.get_replica_monitor(self.app).lag_query = "SELECT 3600"
+            with reporting():
+                self.assertEqual(self.read_marker(), 'primary')
+            db.session.remove()
+
+    def test_pool_options(self):
+        """ Each engine gets its own pool settings and statement timeout, except on SQLite """
+        from sqlalchemy.engine import make_url
+        from models.generics.models import db
+        with self.app.app_context():
+            connector = db.make_connector(self.app, 'reporting')
+            _, options = connector.get_options(make_url('postgresql://localhost/blockpy'), False)
+            self.assertEqual(options['pool_size'], self.app.config['DATABASE_POOLS']['reporting']['pool_size'])
+            self.assertEqual(options['connect_args']['options'], '-c statement_timeout=300000')
+            _, options = connector.get_options(make_url(self.uris['primary']), False)
+            self.assertNotIn('pool_size', options)
+
+
+class SqliteTuningTests(unittest.TestCase):
+    """
+    Confirm that tuned SQLite connections use WAL and serialize their writes
+    """
+    def test_tuned_connection(self):
+        """ Pragmas are set on connect, and the write lock is held only until commit """
+        import tempfile
+        from sqlalchemy import column, table, text
+        from models.generics.models import db
+        from models.generics.sqlite_tuning import WRITE_LOCKS
+        with tempfile.TemporaryDirectory() as directory:
+            app = create_app('testing')
+            app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(directory, 'tuned.db'),
+                              SQLITE_TUNING=True)
+            with app.app_context():
+                self.assertEqual(db.session.execute(text("PRAGMA journal_mode")).scalar(), 'wal')
+                self.assertEqual(db.session.execute(text("PRAGMA busy_timeout")).scalar(), 5000)
+                db.session.execute(text("CREATE TABLE note (body TEXT)"))
+                db.session.execute(table('note', column('body')).insert(), {'body': 'x'})
+                lock = db.session.info['sqlite_write_lock']
+                self.assertIs(lock, WRITE_LOCKS[str(db.engine.url)])
+                db.session.commit()
+                self.assertNotIn('sqlite_write_lock', db.session.info)
+                db.session.remove()
+                db.engine.dispose()
+
+
+class EditorCacheTests(unittest.TestCase):
+    """
+    Confirm that editor payloads are cached per assignment version
+    """
+    def test_disk_cache(self):
+        """ The disk backend round-trips values and evicts the oldest entries """
+        import tempfile
+        from common.caching import make_cache
+        with tempfile.TemporaryDirectory() as directory:
+            cache = make_cache('disk', max_size=2, directory=directory)
+            cache.set((1, 2), {'name': 'Maze'})
+            self.assertEqual(cache.get((1, 2)), {'name': 'Maze'})
+            self.assertIsNone(cache.get((1, 3)))
+            cache.set((1, 3), {})
+            cache.set((1, 4), {})
+            cache.prune()
+            self.assertEqual(len(cache), 2)
+        self.assertRaises(ValueError, make_cache, 'redis')
+
+    def test_versioned_payload(self):
+        """ The assignment is only encoded again once its version changes """
+        from datetime import datetime
+        from unittest import mock
+        from models.assignment import Assignment
+        app = create_app('testing')
+        with app.app_context():
+            assignment = Assignment(id=5, name='Maze', version=1, date_modified=datetime(2021, 1, 1))
+            with mock.patch.object(Assignment, 'encode_json', return_value={'name': 'Maze'}) as encode_json:
+                self.assertEqual(assignment.for_editor_with(None)['assignment'], {'name': 'Maze'})
+                assignment.for_editor_with(None)
+                self.assertEqual(encode_json.call_count, 1)
+                assignment.version = 2
+                assignment.for_editor_with(None)
+                self.assertEqual(encode_json.call_count, 2)
+
+
+class AssignmentAccessTests(DatabaseTestCase):
+    """
+    Confirm that assignments are only loaded for the course's members, as allowed
+    """
+    def setUp(self):
+        """ A course with a restricted assignment, a student, and a grader """
+        super().setUp()
+        from models.assignment import Assignment
+        from models.course import Course
+        self.course, self.other_course = Course(name='CS1'), Course(name='CS2')
+        self.db.session.add_all([self.course, self.other_course])
+        self.db.session.commit()
+        self.assignment = Assignment(name='Secret', course_id=self.course.id, on_run='grade()',
+                                     ip_ranges='10.0.0.0/8', version=0,
+                                     settings=json.dumps({'passcode': 'swordfish', 'small_layout': True}))
+        self.db.session.add(self.assignment)
+        self.db.session.commit()
+        self.make_user('student@example.com', ['learner'], self.course.id)
+        self.make_user('grader@example.com', ['instructor'], self.course.id)
+
+    def load(self, email=None, query='', address='10.1.2.3'):
+        with self.logged_in(email):
+            return self.app.test_client().get('/v1/assignments/{}/editor{}'.format(self.assignment.id, query),
+                                              environ_base={'REMOTE_ADDR': address})
+
+    def test_student(self):
+        """ Students need the passcode and an allowed address, and never see the grading code """
+        from models.submission import Submission
+        self.assertEqual(self.load().status_code, 403)
+        self.assertEqual(self.load('student@example.com').status_code, 403)
+        self.assertEqual(self.load('student@example.com', '?passcode=swordfish', '192.168.0.1').status_code, 403)
+        self.assertEqual(self.load('student@example.com', '?passcode=swordfish&course_id={}'.format(
+            self.other_course.id)).status_code, 403)
+        self.assertEqual(Submission.query.count(), 0)
+        response = self.load('student@example.com', '?passcode=swordfish')
+        self.assertEqual(response.status_code, 200)
+        assignment = response.get_json()['assignment']
+        self.assertNotIn('on_run', assignment)
+        self.assertNotIn('ip_ranges', assignment)
+        self.assertEqual(json.loads(assignment['settings']), {'small_layout': True})
+        self.assertEqual(Submission.query.count(), 1)
+
+    def test_grader(self):
+        """ Graders get the whole assignment, from anywhere """
+        response = self.load('grader@example.com', address='192.168.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['assignment']['on_run'], 'grade()')
+
+    def test_other_course(self):
+        """ Naming another course only works if it uses the assignment, and never reveals the grading code """
+        from models.assignment_group import AssignmentGroup
+        from models.assignment_group_membership import AssignmentGroupMembership
+        self.make_user('other-grader@example.com', ['instructor'], self.other_course.id)
+        self.make_user('other-student@example.com', ['learner'], self.other_course.id)
+        other = '?passcode=swordfish&course_id={}'.format(self.other_course.id)
+        self.assertEqual(self.load('other-grader@example.com', other).status_code, 403)
+        self.assertEqual(self.load('other-student@example.com', other).status_code, 403)
+        group = AssignmentGroup(name='Borrowed', course_id=self.other_course.id)
+        self.db.session.add(group)
+        self.db.session.commit()
+        self.db.session.add(AssignmentGroupMembership(assignment_group_id=group.id, assignment_id=self.assignment.id))
+        self.db.session.commit()
+        response = self.load('other-grader@example.com', '?course_id={}'.format(self.other_course.id), '192.168.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('on_run', response.get_json()['assignment'])
+        self.assertEqual(self.load('other-student@example.com', other).status_code, 200)
+        with self.logged_in('other-grader@example.com'):
+            path = '/v1/assignments/{}/analytics?course_id={}'
+            self.assertEqual(self.app.test_client().get(path.format(self.assignment.id, self.course.id)).status_code,
+                             403)
+
+    def test_conditional_resources(self):
+        """ Callers who may not see a resource are refused, even when their ETag matches """
+        from models.assignment_group import AssignmentGroup
+        group = AssignmentGroup(name='Week 1', course_id=self.course.id)
+        self.db.session.add(group)
+        self.db.session.commit()
+        for path, allowed, refused in [('/v1/assignments/{}'.format(self.assignment.id), 'grader@example.com',
+                                        ['student@example.com', None]),
+                                       ('/v1/groups/{}'.format(group.id), 'student@example.com', [None])]:
+            with self.logged_in(allowed):
+                response = self.app.test_client().get(path)
+                self.assertEqual(response.status_code, 200)
+                headers = {'If-None-Match': response.headers['ETag']}
+                self.assertEqual(self.app.test_client().get(path, headers=headers).status_code, 304)
+            for email in refused:
+                with self.logged_in(email):
+                    response = self.app.test_client().get(path, headers=headers)
+                    self.assertEqual(response.status_code, 403)
+                    self.assertNotIn('ETag', response.headers)
+
+
+class AvailableAssignmentTests(DatabaseTestCase):
+    """
+    Confirm that the available assignments are listed once each, with their first group
+    """
+    def test_first_group_and_pages(self):
+        """ Assignments in several groups appear once, with the group they joined first, on every page """
+        from models.assignment import Assignment
+        from models.assignment_group import AssignmentGroup
+        from models.assignment_group_membership import AssignmentGroupMembership
+        from models.course import Course
+        course, other_course = Course(name='CS1'), Course(name='CS2')
+        self.db.session.add_all([course, other_course])
+        self.db.session.commit()
+        week1, week2 = (AssignmentGroup(name='Week 1', course_id=course.id),
+                        AssignmentGroup(name='Week 2', course_id=course.id))
+        maze, loose, essay, elsewhere = (Assignment(name=name, course_id=course_id) for name, course_id in
+                                         [('Maze', course.id), ('Loose', course.id), ('Essay', course.id),
+                                          ('Elsewhere', other_course.id)])
+        self.db.session.add_all([week1, week2, maze, loose, essay, elsewhere])
+        self.db.session.commit()
+        self.db.session.add_all([AssignmentGroupMembership(assignment_group_id=group_id, assignment_id=assignment_id)
+                                 for group_id, assignment_id in [(week2.id, maze.id), (week1.id, maze.id),
+                                                                 (week1.id, essay.id), (week2.id, essay.id),
+                                                                 # A membership in a group that was removed
+                                                                 (999, loose.id)]])
+        self.db.session.commit()
+
+        def listed(**options):
+            return [(assignment.name, group.name if group else None)
+                    for assignment, group in Assignment.get_available(course.id, **options)]
+
+        self.assertEqual(listed(), [('Maze', 'Week 2'), ('Loose', None), ('Essay', 'Week 1')])
+        self.assertEqual(listed(page_offset=0, page_limit=2), [('Maze', 'Week 2'), ('Loose', None)])
+        self.assertEqual(listed(page_offset=2, page_limit=2), [('Essay', 'Week 1')])
+        self.assertEqual(len(Assignment.get_available()), 4)
+
+
+class CourseRemovalTests(DatabaseTestCase):
+    """
+    Confirm that removing a course deletes exactly its own rows
+    """
+    def setUp(self):
+        """ A course to remove, sharing a tag, groups, and assignments with another course """
+        super().setUp()
+        from models.assignment import Assignment
+        from models.assignment_group import AssignmentGroup
+        from models.assignment_group_membership import AssignmentGroupMembership
+        from models.assignment_tag import AssignmentTag
+        from models.assignment_tag_membership import assignment_tag_membership
+        from models.course import Course
+        from models.sample_submission import SampleSubmission
+        from models.submission import Submission
+        self.course, self.other_course = Course(name='CS1'), Course(name='CS2')
+        self.db.session.add_all([self.course, self.other_course])
+        self.db.session.commit()
+        first, second, kept = (Assignment(name='First', course_id=self.course.id),
+                               Assignment(name='Second', course_id=self.course.id),
+                               Assignment(name='Kept', course_id=self.other_course.id))
+        group, kept_group = (AssignmentGroup(name='Week 1', course_id=self.course.id),
+                             AssignmentGroup(name='Week 1', course_id=self.other_course.id))
+        tag = AssignmentTag(name='Loops', course_id=self.other_course.id)
+        self.db.session.add_all([first, second, kept, group, kept_group, tag])
+        self.db.session.commit()
+        self.course_id, self.other_course_id, self.kept_assignment_id = self.course.id, self.other_course.id, kept.id
+        self.db.session.add_all([AssignmentGroupMembership(assignment_group_id=group_id, assignment_id=assignment_id)
+                                 for group_id, assignment_id in [(group.id, first.id), (group.id, second.id),
+                                                                 (kept_group.id, first.id), (group.id, kept.id),
+                                                                 (kept_group.id, kept.id)]])
+        self.db.session.add_all([SampleSubmission(assignment_id=first.id), SampleSubmission(assignment_id=kept.id)])
+        self.db.session.execute(assignment_tag_membership.insert(), [{'assignment_id': first.id, 'tag_id': tag.id},
+                                                                      {'assignment_id': kept.id, 'tag_id': tag.id}])
+        self.db.session.commit()
+        student = self.make_user('student@example.com', ['learner'], self.course.id)
+        student.add_role('learner', self.other_course.id)
+        self.db.session.add(Submission(assignment_id=first.id, course_id=self.course.id, user_id=student.id))
+        self.db.session.commit()
+
+    def count_rows(self) -> dict:
+        """ How many rows each table has """
+        import models
+        from models.assignment_tag_membership import assignment_tag_membership
+        return {label: self.db.session.query(table).count() for label, table in [
+            ('assignment_tag_memberships', assignment_tag_membership), ('sample_submissions', models.SampleSubmission),
+            ('assignment_group_memberships', models.AssignmentGroupMembership), ('assignments', models.Assignment),
+            ('assignment_groups', models.AssignmentGroup), ('roles', models.Role), ('courses', models.Course),
+            ('submissions', models.Submission)]}
+
+    def test_course_only(self):
+        """ By default, only the course itself is deleted """
+        from models.course import Course
+        before = self.count_rows()
+        self.assertEqual([step.label for step in Course.get_removal_steps(self.course_id)], ['courses'])
+        self.assertEqual(Course.remove(self.course_id), {'courses': 1})
+        self.assertEqual(self.count_rows(), dict(before, courses=1))
+        self.assertIsNone(Course.by_id(self.course_id))
+
+    def test_linked(self):
+        """ Everything linked to the course goes, and nothing linked only to the other course """
+        from models.assignment_group_membership import AssignmentGroupMembership
+        from models.course import Course
+        removed = {'assignment_tag_memberships': 1, 'sample_submissions': 1, 'assignment_group_memberships': 4,
+                   'assignments': 2, 'assignment_groups': 1, 'roles': 1, 'courses': 1}
+        self.assertEqual(Course.remove(self.course_id, remove_linked=True), removed)
+        self.assertEqual(self.count_rows(), {'assignment_tag_memberships': 1, 'sample_submissions': 1,
+                                             'assignment_group_memberships': 1, 'assignments': 1,
+                                             'assignment_groups': 1, 'roles': 1, 'courses': 1, 'submissions': 1})
+        membership = AssignmentGroupMembership.query.one()
+        self.assertEqual(membership.assignment_id, self.kept_assignment_id)
+        self.assertEqual(membership.assignment_group.course_id, self.other_course_id)
+        self.assertIsNotNone(Course.by_id(self.other_course_id))
+
+    def test_background(self):
+        """ A background removal reports the same counts once it finishes """
+        from models.course import Course
+        future = Course.remove(self.course_id, remove_linked=True, background=True)
+        self.assertEqual(future.result(timeout=30)['assignments'], 2)
+        self.db.session.expire_all()
+        self.assertEqual(self.count_rows()['assignments'], 1)
+
+
+class CourseNavigationTests(DatabaseTestCase):
+    """
+    Confirm that the cached navigation tree follows changes to courses and groups
+    """
+    def test_changes_invalidate(self):
+        """ Renames and removals show up immediately, even within the watermark's resolution """
+        from unittest import mock
+        from models.assignment_group import AssignmentGroup
+        from models.course import Course
+        course = Course(name='CS1')
+        self.db.session.add(course)
+        self.db.session.commit()
+        group = AssignmentGroup.new(None, course.id, 'Week 1')
+
+        def names():
+            return [(entry['name'], [g['name'] for g in entry['groups']]) for entry in Course.get_all_groups()]
+
+        # As if every change landed in the same second
+        with mock.patch.object(Course, 'get_navigation_watermark', return_value=(1, None, 1, None)), \
+                mock.patch.object(AssignmentGroup, 'select_url', return_value=''):
+            self.assertEqual(names(), [('CS1', ['Week 1'])])
+            with mock.patch.object(Course, 'build_navigation_tree') as build:
+                Course.get_all_groups()
+                build.assert_not_called()
+            group.name = 'Week One'
+            self.db.session.commit()
+            self.assertEqual(names(), [('CS1', ['Week One'])])
+            Course.rename(course.id, 'CS 101')
+            self.assertEqual(names(), [('CS 101', ['Week One'])])
+            AssignmentGroup.remove(group.id)
+            self.assertEqual(names(), [('CS 101', [])])
+            Course.remove(course.id)
+            self.assertEqual(names(), [])
+
+
+class GradeQueueTests(DatabaseTestCase):
+    """
+    Confirm that queued grades are collapsed, claimed once, and retried with backoff
+    """
+    def setUp(self):
+        """ A queue attached to this app, and the LTI routes (which are only registered with the first app) """
+        super().setUp()
+        import importlib
+        from controllers.pylti.grade_queue import GradeQueue
+        # `controllers.lti` is shadowed by the decorator of the same name
+        lti = importlib.import_module('controllers.lti')
+        self.queue = GradeQueue()
+        self.queue.app = self.app
+        for rule, view in [('/v1/lti/submissions/<int:submission_id>/grade', lti.lti_post_grade),
+                           ('/v1/lti/grade_queue', lti.lti_grade_queue)]:
+            if view.__name__ not in self.app.view_functions:
+                self.app.add_url_rule(rule, view.__name__, view,
+                                      methods=['POST'] if 'submission_id' in rule else ['GET'])
+
+    def enqueue(self, score, submission_id=None):
+        return self.queue.enqueue(submission_id, 'sourcedid', 'key', 'http://lms.example.com/grade', score)
+
+    def test_supersede(self):
+        """ A newer score replaces an unsent one, rather than being posted after it """
+        from models.grade_passback import GradePassback
+        first = self.enqueue(0.5)
+        second = self.enqueue(0.75)
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(GradePassback.query.count(), 1)
+        self.assertEqual((second.version, second.score), (1, 0.75))
+        self.assertEqual(self.queue.get_metrics(), {'enqueued': 2, 'superseded': 1})
+
+    def test_conflicting_insert(self):
+        """ If another worker queued the same target first, its row is replaced """
+        from unittest import mock
+        from models.grade_passback import GradePassback
+        first = self.enqueue(0.5, submission_id=7)
+        real_query = GradePassback.query
+        with mock.patch.object(GradePassback, 'query') as query:
+            # The first lookup misses the other worker's row, as if it had not committed yet
+            query.filter_by.return_value.first.side_effect = [None, real_query.filter_by(id=first.id).first()]
+            queued, superseded = GradePassback.enqueue(7, 'sourcedid', 'key', 'http://lms.example.com/grade', 1.0)
+        self.assertTrue(superseded)
+        self.assertEqual(queued.id, first.id)
+        self.assertEqual(GradePassback.query.count(), 1)
+        self.assertEqual(GradePassback.query.one().score, 1.0)
+
+    def test_claim(self):
+        """ Only one worker wins a claim, and a score that arrives mid-send is posted afterwards """
+        from models.grade_passback import GradePassback, GradePassbackStatuses
+        queued = self.enqueue(0.5)
+        self.assertEqual([due.id for due in GradePassback.get_due()], [queued.id])
+        self.assertTrue(queued.claim())
+        self.assertFalse(queued.claim())
+        self.assertEqual(GradePassback.get_due(), [])
+        # The worker's copy, as loaded in its own session
+        self.assertEqual(queued.version, 0)
+        self.db.session.expunge(queued)
+        self.enqueue(0.9)
+        self.assertFalse(queued.mark_sent())
+        self.assertEqual(GradePassback.query.one().status, GradePassbackStatuses.PENDING)
+
+    def test_retry_and_backoff(self):
+        """ Failed posts are retried later, with growing delays, until the attempts run out """
+        from datetime import datetime
+        from unittest import mock
+        from models.grade_passback import GradePassback, GradePassbackStatuses
+        self.app.config.update(PYLTI_GRADE_QUEUE_MAX_ATTEMPTS=2, PYLTI_GRADE_QUEUE_BACKOFF=2.0,
+                               PYLTI_GRADE_QUEUE_MAX_BACKOFF=10.0)
+        self.assertTrue(1.0 <= self.queue.get_backoff(0) <= 2.0)
+        self.assertIsNone(self.queue.get_backoff(1))
+        self.app.config['PYLTI_GRADE_QUEUE_MAX_ATTEMPTS'] = 8
+        self.assertTrue(5.0 <= self.queue.get_backoff(6) <= 10.0)
+        self.app.config['PYLTI_GRADE_QUEUE_MAX_ATTEMPTS'] = 2
+        self.enqueue(0.5)
+        with mock.patch.object(self.queue, 'post', side_effect=OSError("LMS is down")):
+            self.assertEqual(self.queue.process_due(), 1)
+            queued = GradePassback.query.one()
+            self.assertEqual((queued.status, queued.attempts), (GradePassbackStatuses.PENDING, 1))
+            self.assertIn("LMS is down", queued.last_error)
+            self.assertGreater(queued.next_attempt, datetime.utcnow())
+            self.assertEqual(self.queue.process_due(), 0)
+            queued.next_attempt = datetime.utcnow()
+            self.db.session.commit()
+            self.assertEqual(self.queue.process_due(), 1)
+        queued = GradePassback.query.one()
+        self.assertEqual((queued.status, queued.attempts), (GradePassbackStatuses.FAILED, 2))
+        self.assertEqual(self.queue.get_metrics()['retried'], 1)
+        self.assertEqual(self.queue.get_metrics()['failed'], 1)
+
+    def post_grade(self, submission_id, email='student@example.com'):
+        """ Post the submission's grade during a student's launch of some other assignment """
+        from unittest import mock
+        from controllers.pylti.common import LTI_SESSION_KEY
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session.update({LTI_SESSION_KEY: True, 'oauth_consumer_key': 'key', 'roles': 'Learner',
+                            'lis_result_sourcedid': 'launch-sourcedid',
+                            'lis_outcome_service_url': 'http://lms.example.com/grade'})
+        with self.logged_in(email), mock.patch('controllers.pylti.grade_queue.grade_queue.notify'):
+            return client.post('/v1/lti/submissions/{}/grade'.format(submission_id))
+
+    def make_submissions(self):
+        """ A student's launched submission, and one for an assignment that was never launched """
+        from models.assignment import Assignment
+        from models.course import Course
+        from models.submission import Submission
+        self.app.config['PYLTI_GRADE_QUEUE'] = True
+        course = Course(name='CS1')
+        self.db.session.add(course)
+        self.db.session.commit()
+        launched, other = (Assignment(name=name, course_id=course.id, hidden=False, reviewed=False)
+                           for name in ('Maze', 'Essay'))
+        self.db.session.add_all([launched, other])
+        self.db.session.commit()
+        student = self.make_user('student@example.com', ['learner'], course.id)
+        self.make_user('classmate@example.com', ['learner'], course.id)
+        self.make_user('grader@example.com', ['instructor'], course.id)
+        submissions = [Submission(assignment_id=launched.id, course_id=course.id, user_id=student.id,
+                                  correct=True, endpoint='student-sourcedid'),
+                       Submission(assignment_id=other.id, course_id=course.id, user_id=student.id,
+                                  correct=True, endpoint='')]
+        self.db.session.add_all(submissions)
+        self.db.session.commit()
+        return [submission.id for submission in submissions]
+
+    def test_post_grade(self):
+        """ The submission's score is queued under its id and its own sourcedid """
+        from models.grade_passback import GradePassback
+        launched, _ = self.make_submissions()
+        self.assertEqual(self.post_grade(launched).get_json(), {'success': True})
+        self.assertEqual(self.post_grade(launched, 'grader@example.com').status_code, 200)
+        queued = GradePassback.query.one()
+        self.assertEqual((queued.submission_id, queued.lis_result_sourcedid, queued.score),
+                         (launched, 'student-sourcedid', 1.0))
+
+    def test_post_grade_refused(self):
+        """ Other students' submissions, and those without their own sourcedid, are never posted """
+        from models.grade_passback import GradePassback
+        launched, unlaunched = self.make_submissions()
+        self.assertEqual(self.post_grade(unlaunched).status_code, 409)
+        self.assertEqual(self.post_grade(launched, 'classmate@example.com').status_code, 403)
+        self.assertEqual(GradePassback.query.count(), 0)
+
+    def test_report_restricted(self):
+        """ The queue's report is only served to the metrics addresses """
+        with self.logged_in('student@example.com'):
+            self.make_user('student@example.com')
+            client = self.app.test_client()
+            self.assertEqual(client.get('/v1/lti/grade_queue', environ_base={'REMOTE_ADDR': '10.1.2.3'}).status_code,
+                             404)
+            self.assertEqual(client.get('/v1/lti/grade_queue', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code,
+                             200)
+
+
+class GradebookTests(DatabaseTestCase):
+    """
+    Confirm that the bulk gradebook agrees with grading one submission at a time
+    """
+    def test_for_course(self):
+        """ Learners (and dropped students) are graded like `Submission.full_score`; staff are left out """
+        from models.assignment import Assignment
+        from models.course import Course
+        from models.gradebook import Gradebook
+        from models.review import Review
+        from models.submission import Submission
+        course = Course(name='CS1')
+        self.db.session.add(course)
+        self.db.session.commit()
+        plain = Assignment(name='Maze', course_id=course.id, reviewed=False)
+        reviewed = Assignment(name='Essay', course_id=course.id, reviewed=True)
+        self.db.session.add_all([plain, reviewed])
+        self.db.session.commit()
+        ada = self.make_user('ada@example.com', ['learner'], course.id)
+        bob = self.make_user('bob@example.com', ['Learner'], course.id)
+        dropped = self.make_user('dropped@example.com')
+        instructor = self.make_user('instructor@example.com', ['instructor'], course.id)
+        self.make_user('ta@example.com', ['urn:lti:role:ims/lis/teachingassistant'], course.id)
+        submissions = [Submission(assignment_id=assignment.id, course_id=course.id, user_id=user.id,
+                                  score=score, correct=correct)
+                       for assignment, user, score, correct in [(plain, ada, 40, False), (plain, bob, 0, True),
+                                                                (reviewed, ada, 50, False), (plain, dropped, 70, False),
+                                                                (plain, instructor, 100, True)]]
+        self.db.session.add_all(submissions)
+        self.db.session.commit()
+        original = Review(submission_id=submissions[2].id, score=20)
+        self.db.session.add(original)
+        self.db.session.commit()
+        self.db.session.add(Review(submission_id=submissions[2].id, forked_id=original.id))
+        self.db.session.commit()
+        gradebook = Gradebook.for_course(course.id)
+        self.assertEqual(sorted(gradebook.emails), ['ada@example.com', 'bob@example.com', 'dropped@example.com'])
+        for submission in submissions[:4]:
+            row = gradebook.student_ids.index(submission.user_id)
+            column = gradebook.assignment_ids.index(submission.assignment_id)
+            self.assertAlmostEqual(gradebook.scores[column][row], submission.full_score())
+        self.assertEqual(gradebook.encode_json()['scores'][gradebook.assignment_ids.index(reviewed.id)]
+                         [gradebook.student_ids.index(bob.id)], None)
+
+
+class ConditionalRequestTests(unittest.TestCase):
+    """
+    Confirm that versioned resources answer conditional requests
+    """
+    def setUp(self):
+        self.app = create_app('testing')
+
+    def test_validators(self):
+        """ Matching validators give a 304 for reads and pass writes; stale ones fail writes """
+        from datetime import datetime
+        from flask_rebar import errors
+        from controllers.conditional import (resource_etag, last_modified, is_not_modified,
+                                             check_preconditions)
+        from models.assignment import Assignment
+        assignment = Assignment(id=5, version=1, date_modified=datetime(2021, 1, 1, 12, 0, 0, 500))
+        etag, modified = resource_etag(assignment), last_modified(assignment)
+        self.assertEqual(modified, datetime(2021, 1, 1, 12))
+        with self.app.test_request_context(headers={'If-None-Match': '"{}"'.format(etag)}):
+            self.assertTrue(is_not_modified(etag, modified))
+        with self.app.test_request_context(headers={'If-Modified-Since': 'Fri, 01 Jan 2021 12:00:00 GMT'}):
+            self.assertTrue(is_not_modified(etag, modified))
+        assignment.version = 2
+        self.assertNotEqual(resource_etag(assignment), etag)
+        with self.app.test_request_context(method='PUT', headers={'If-Match': '"{}"'.format(etag)}):
+            self.assertFalse(is_not_modified(resource_etag(assignment), modified))
+            self.assertRaises(errors.PreconditionFailed, check_preconditions, resource_etag(assignment), modified)
+            check_preconditions(etag, modified)
+
+
+class LogSummaryTests(unittest.TestCase):
+    """
+    Confirm that events are summarized into per-assignment analytics
+    """
+    def test_add_event(self):
+        """ Runs, errors, and feedback are counted, and completion records the runs it took """
+        from collections import namedtuple
+        from datetime import datetime
+        from models.log_summary import LogSummary, SUMMARY_COLUMNS
+        Event = namedtuple('Event', SUMMARY_COLUMNS)
+        summary = LogSummary(events=0, runs=0, compile_errors=0, feedbacks=0)
+        for minute, event_type, category in [(5, 'Run.Program', 'ProgramRun'), (1, 'Compile.Error', ''),
+                                             (6, 'Intervention', 'Syntax Error'), (7, 'Run.Program', 'ProgramRun'),
+                                             (9, 'Intervention', 'Complete'), (12, 'Run.Program', 'ProgramRun'),
+                                             (15, 'Intervention', 'Complete')]:
+            summary.add_event(Event(minute, datetime(2021, 1, 1, 12, minute), 1, 2, 3, event_type, category))
+        self.assertEqual((summary.events, summary.runs, summary.compile_errors, summary.feedbacks), (7, 3, 1, 1))
+        self.assertEqual(summary.attempts_before_correct, 2)
+        self.assertEqual(summary.time_to_completion, 8 * 60)
+        self.assertEqual(summary.last_event, datetime(2021, 1, 1, 12, 15))
+
+
+class WorkSessionTests(unittest.TestCase):
+    """
+    Confirm that events are segmented into work sessions by idle gaps
+    """
+    def test_segment(self):
+        """ Each student's sessions end after the idle gap, and continue stored sessions """
+        from collections import namedtuple
+        from datetime import datetime, timedelta
+        from models.work_session import SESSION_COLUMNS, WorkSession, segment
+        Event = namedtuple('Event', SESSION_COLUMNS)
+        start = datetime(2021, 1, 1, 12)
+        events = [Event(log_id, start + timedelta(minutes=minute), 1, 2, subject_id)
+                  for log_id, (minute, subject_id) in enumerate([(0, 3), (1, 4), (10, 3), (30, 3), (31, 3),
+                                                                 (40, 4), (41, 4)], 1)]
+        sessions = sorted(segment(events, timedelta(minutes=15), sweep_every=2), key=lambda s: s.first_log_id)
+        self.assertEqual([(s.subject_id, s.first_log_id, s.last_log_id, s.events) for s in sessions],
+                         [(3, 1, 3, 2), (4, 2, 2, 1), (3, 4, 5, 2), (4, 6, 7, 2)])
+        self.assertEqual(sessions[0].duration, 600)
+        stored = WorkSession.starting_with(Event(9, start - timedelta(minutes=5), 1, 2, 3))
+        resumed = list(segment(events[:1], timedelta(minutes=15), [stored]))
+        self.assertEqual([(s.first_log_id, s.events) for s in resumed], [(9, 2)])
+
+
+class AnalyticsCatchUpTests(DatabaseTestCase):
+    """
+    Confirm that the log consumers settle events by the database's clock, and catch up a limited amount at a time
+    """
+    def setUp(self):
+        """ A student's runs from long ago, and one just stamped by the database """
+        super().setUp()
+        from datetime import datetime, timedelta
+        from models.log import Log
+        start = datetime(2021, 1, 1, 12)
+        self.db.session.execute(Log.__table__.insert(), [
+            {'course_id': 1, 'assignment_id': 2, 'subject_id': 3, 'event_type': 'Run.Program',
+             'date_created': start + timedelta(minutes=minute)} for minute in range(5)])
+        self.db.session.add(Log(course_id=1, assignment_id=2, subject_id=3, event_type='Run.Program'))
+        self.db.session.commit()
+
+    def test_summaries(self):
+        """ Only settled events are summarized, no more than the limit at once """
+        from models.log_summary import LogSummary, update_summaries
+        self.assertEqual(update_summaries(settle_seconds=3600, limit=2), 2)
+        self.assertEqual(LogSummary.query.one().runs, 2)
+        self.assertEqual(update_summaries(settle_seconds=3600, limit=10), 3)
+        self.assertEqual(update_summaries(settle_seconds=0), 1)
+        self.assertEqual(LogSummary.query.one().runs, 6)
+
+    def test_concurrent(self):
+        """ Consumers running at once never consume the same event twice """
+        from concurrent.futures import ThreadPoolExecutor
+        from datetime import datetime, timedelta
+        from sqlalchemy import func
+        from models.log import Log
+        from models.log_summary import LogSummary, update_summaries
+        from models.work_session import WorkSession, update_sessions
+        start = datetime(2021, 1, 2, 12)
+        self.db.session.execute(Log.__table__.insert(), [
+            {'course_id': 1, 'assignment_id': 2, 'subject_id': 3 + index % 7, 'event_type': 'Run.Program',
+             'date_created': start + timedelta(seconds=index)} for index in range(200)])
+        self.db.session.commit()
+
+        def catch_up(update, *args):
+            with self.app.app_context():
+                try:
+                    return update(*args, chunk_size=20, settle_seconds=0)
+                finally:
+                    self.db.session.remove()
+        for update, args, model in [(update_summaries, (), LogSummary), (update_sessions, (2,), WorkSession)]:
+            with ThreadPoolExecutor(3) as pool:
+                consumed = sum(pool.map(lambda _: catch_up(update, *args), range(3)))
+            self.assertEqual(consumed, 206)
+            self.assertEqual(self.db.session.query(func.sum(model.events)).scalar(), 206)
+
+    def test_read_only_dashboard(self):
+        """ The dashboard serves what is summarized, without consuming the log itself """
+        from models.assignment import Assignment
+        from models.course import Course
+        from models.log_summary import LogSummary, LogWatermark
+        course = Course(id=1, name='CS1')
+        self.db.session.add_all([course, Assignment(id=2, name='Maze', course_id=1)])
+        self.db.session.commit()
+        self.make_user('grader@example.com', ['instructor'], 1)
+        with self.logged_in('grader@example.com'):
+            response = self.app.test_client().get('/v1/assignments/2/analytics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['students'], [])
+        self.assertEqual((LogSummary.query.count(), LogWatermark.query.count()), (0, 0))
+
+    def test_sessions(self):
+        """ A session cut short by the limit is continued by the next update """
+        from models.work_session import WorkSession, update_sessions
+        self.assertEqual(update_sessions(2, settle_seconds=3600, limit=2), 2)
+        self.assertEqual(update_sessions(2, settle_seconds=3600), 3)
+        self.assertEqual([(session.events, session.duration) for session in WorkSession.query],
+                         [(5, 4 * 60)])
+        self.assertEqual(update_sessions(2, settle_seconds=0), 1)
+        self.assertEqual(WorkSession.query.count(), 2)
+
+
+class ProgSnapSessionTests(DatabaseTestCase):
+    """
+    Confirm that exported events are labelled with the same sessions as the stored ones
+    """
+    def test_tied_moments(self):
+        """ Events logged in the same moment are ordered by id, like the stored sessions' segmentation """
+        import csv
+        import io
+        import zipfile
+        from datetime import datetime, timedelta
+        from models.data_formats.progsnap2 import generate_maintable
+        from models.log import Log
+        from models.work_session import WorkSession, update_sessions
+        start = datetime(2021, 1, 1, 12)
+        self.db.session.execute(Log.__table__.insert(), [
+            {'course_id': 1, 'assignment_id': 2, 'subject_id': subject_id, 'event_type': 'Run.Program',
+             'date_created': start + timedelta(minutes=minute)}
+            for minute, subject_id in [(0, 3), (0, 3), (0, 4), (30, 3), (30, 3), (30, 4), (30, 4)]])
+        self.db.session.commit()
+        self.assertEqual([row.id for row in Log.stream_for_course(1, chunk_size=2)], list(range(1, 8)))
+        update_sessions(2, settle_seconds=0)
+        first_log_ids = {(session.subject_id, log_id): session.first_log_id for session in WorkSession.query
+                         for log_id in range(session.first_log_id, session.last_log_id + 1)}
+        with io.BytesIO() as archive:
+            with zipfile.ZipFile(archive, 'w') as zip_file:
+                generate_maintable(zip_file, 1, None, chunk_size=2)
+            with zipfile.ZipFile(archive) as zip_file:
+                rows = list(csv.DictReader(io.TextIOWrapper(zip_file.open('MainTable.csv'), encoding='utf-8')))
+        self.assertEqual(len(rows), 7)
+        for row in rows:
+            self.assertEqual(int(row['SessionID']), first_log_ids[(int(row['SubjectID']), int(row['EventID']))])
+
+
+class CodeCheckpointTests(unittest.TestCase):
+    """
+    Confirm that code states are rebuilt from edits and checkpointed intact
+    """
+    def test_code_state(self):
+        """ The last edit of each file wins, and checkpoints round-trip the state """
+        from collections import namedtuple
+        from datetime import datetime
+        from models.code_checkpoint import EDIT_COLUMNS, EMPTY, CodeCheckpoint
+        Edit = namedtuple('Edit', EDIT_COLUMNS)
+        state = EMPTY
+        for log_id, (file_path, message) in enumerate([('answer.py', 'a = 1'), ('data.txt', '1 2'),
+                                                       ('answer.py', 'a = 2')], 1):
+            state = state.edited(Edit(log_id, datetime(2021, 1, 1, 12, log_id), 1, 2, 3, file_path, message))
+        self.assertEqual(state.files, {'answer.py': 'a = 2', 'data.txt': '1 2'})
+        self.assertEqual((state.log_id, state.edits), (3, 3))
+        self.assertEqual(EMPTY.files, {})
+        checkpoint = CodeCheckpoint.of((1, 2, 3), state)
+        self.assertEqual(checkpoint.to_state(), state)
+
+
+class CodeReconstructionTests(DatabaseTestCase):
+    """
+    Confirm that a whole assignment is rebuilt from checkpoints, however many students it has
+    """
+    def test_many_students(self):
+        """ Each student's edits after their checkpoint are replayed onto it, in one bounded query """
+        from datetime import datetime, timedelta
+        from models.code_checkpoint import CodeCheckpoint, reconstruct, reconstruct_assignment
+        from models.log import Log
+        start = datetime(2021, 1, 1, 12)
+        students = range(1, 1101)
+        self.db.session.execute(Log.__table__.insert(), [
+            {'course_id': 1, 'assignment_id': 2, 'subject_id': subject_id, 'event_type': 'File.Edit',
+             'file_path': 'answer.py', 'message': 'v{}'.format(edit), 'date_created': start + timedelta(minutes=edit)}
+            for subject_id in list(students) + [2000] for edit in range(3)])
+        second_edits = dict(self.db.session.query(Log.subject_id, Log.id).filter(Log.message == 'v1'))
+        self.db.session.execute(CodeCheckpoint.__table__.insert(), [
+            {'course_id': 1, 'assignment_id': 2, 'subject_id': subject_id, 'log_id': second_edits[subject_id],
+             'moment': start + timedelta(minutes=1), 'edits': 2,
+             'files': json.dumps({'answer.py': 'v1', 'notes.txt': 'checkpointed'})}
+            for subject_id in students])
+        self.db.session.commit()
+        states = reconstruct_assignment(1, 2, start + timedelta(minutes=5))
+        self.assertEqual(len(states), 1101)
+        self.assertEqual(states[7].files, {'answer.py': 'v2', 'notes.txt': 'checkpointed'})
+        self.assertEqual(states[7].edits, 3)
+        self.assertEqual(states[2000].files, {'answer.py': 'v2'})
+        self.assertEqual(states[7], reconstruct(1, 2, 7, start + timedelta(minutes=5)))
+        earlier = reconstruct_assignment(1, 2, start + timedelta(minutes=1, seconds=30))
+        self.assertEqual((earlier[7].files['answer.py'], earlier[7].edits), ('v1', 2))
+        self.assertEqual((earlier[2000].files['answer.py'], earlier[2000].edits), ('v1', 2))
+
+
+class MinHashTests(unittest.TestCase):
+    """
+    Confirm that similar code is found by its MinHash signatures
+    """
+    def test_similarity(self):
+        """ Renamed copies collide in some band, unrelated code does not """
+        from common.minhash import band_buckets, candidate_pairs, clusters, code_signature, similarity
+        original = ("def total(numbers):\n    result = 0\n    for n in numbers:\n"
+                    "        result = result + n\n    return result\nprint(total([1, 2, 3]))\n")
+        renamed = ("def add_all(values):\n    acc = 0  # sum them\n    for v in values:\n"
+                   "        acc = acc + v\n    return acc\nprint(add_all([4, 5, 6]))\n")
+        unrelated = ("import math\nwhile True:\n    x = input('x? ')\n    if x == 'q':\n"
+                     "        break\n    print(math.sqrt(float(x)))\n")
+        signatures = {1: code_signature(original), 2: code_signature(renamed), 3: code_signature(unrelated)}
+        self.assertEqual(similarity(signatures[1], signatures[2]), 1.0)
+        self.assertLess(similarity(signatures[1], signatures[3]), 0.2)
+        self.assertEqual(candidate_pairs({key: band_buckets(values) for key, values in signatures.items()}),
+                         {(1, 2)})
+        self.assertEqual(clusters([(1, 2), (2, 5), (7, 8)]), [[1, 2, 5], [7, 8]])
+        self.assertEqual(len(code_signature("def broken(:\n  'unterminated")), 128)
+
+
+class CodeSimilarityTests(DatabaseTestCase):
+    """
+    Confirm that submissions' code is signed as it is saved, and similar submissions are paired and clustered
+    """
+    ORIGINAL = ("def total(numbers):\n    result = 0\n    for n in numbers:\n"
+                "        result = result + n\n    return result\nprint(total([1, 2, 3]))\n")
+    RENAMED = ("def add_all(values):\n    acc = 0  # sum them\n    for v in values:\n"
+               "        acc = acc + v\n    return acc\nprint(add_all([4, 5, 6]))\n")
+    COPIED = ("def summed(items):\n    s = 0\n    for i in items:\n"
+              "        s = s + i\n    return s\nprint(summed([7, 8]))\n")
+    UNRELATED = ("import math\nwhile True:\n    x = input('x? ')\n    if x == 'q':\n"
+                 "        break\n    print(math.sqrt(float(x)))\n")
+
+    def setUp(self):
+        """ An assignment with starter code, and a submission for each of five students """
+        super().setUp()
+        from models.assignment import Assignment
+        from models.course import Course
+        from models.submission import Submission
+        self.course = Course(name='CS1')
+        self.db.session.add(self.course)
+        self.db.session.commit()
+        self.assignment = Assignment(name='Sums', course_id=self.course.id, starting_code="# Sum the numbers\n")
+        self.db.session.add(self.assignment)
+        self.db.session.commit()
+        students = [self.make_user('student{}@example.com'.format(index), ['learner'], self.course.id)
+                    for index in range(5)]
+        self.submissions = [Submission(assignment_id=self.assignment.id, course_id=self.course.id,
+                                       user_id=student.id) for student in students]
+        self.db.session.add_all(self.submissions)
+        self.db.session.commit()
+        self.ids = [submission.id for submission in self.submissions]
+
+    def save(self, codes):
+        for submission, code in zip(self.submissions, codes):
+            submission.save_code('answer.py', code)
+
+    def test_pairs_and_clusters(self):
+        """ Copies are paired and clustered, while unrelated and untouched code is left out """
+        from models.code_similarity import CodeSignature
+        self.save([self.ORIGINAL, self.UNRELATED, self.RENAMED, "# Sum the numbers\n", self.COPIED])
+        self.assertEqual(CodeSignature.query.count(), 4)
+        pairs = CodeSignature.similar_pairs(self.course.id, self.assignment.id)
+        self.assertEqual({(first, second) for first, second, _ in pairs},
+                         {(self.ids[0], self.ids[2]), (self.ids[0], self.ids[4]), (self.ids[2], self.ids[4])})
+        self.assertTrue(all(score >= 0.7 for _, _, score in pairs))
+        self.assertEqual(CodeSignature.similar_clusters(self.course.id, self.assignment.id),
+                         [[self.ids[0], self.ids[2], self.ids[4]]])
+        self.assertEqual({other for _, other, _ in CodeSignature.similar_to(self.ids[2])}, {self.ids[0], self.ids[4]})
+        self.assertEqual(CodeSignature.similar_to(self.ids[1]), [])
+        self.assertEqual(CodeSignature.similar_pairs(self.course.id + 1, self.assignment.id), [])
+        # Rewriting a copy into something else takes it out of the pairs
+        self.submissions[4].save_code('answer.py', self.UNRELATED)
+        self.assertEqual([pair[:2] for pair in CodeSignature.similar_pairs(self.course.id, self.assignment.id)],
+                         [(self.ids[0], self.ids[2]), (self.ids[1], self.ids[4])])
+
+    def test_index_course(self):
+        """ Code saved before the index existed is signed, and signatures of emptied code are removed """
+        from models.code_similarity import CodeBand, CodeSignature, index_course
+        self.app.config['CODE_SIMILARITY_INDEX'] = False
+        self.save([self.ORIGINAL, self.UNRELATED, self.RENAMED])
+        self.assertEqual(CodeSignature.query.count(), 0)
+        self.app.config['CODE_SIMILARITY_INDEX'] = True
+        self.assertEqual(index_course(self.course.id, chunk_size=2), 5)
+        self.assertEqual([pair[:2] for pair in CodeSignature.similar_pairs(self.course.id, self.assignment.id)],
+                         [(self.ids[0], self.ids[2])])
+        self.submissions[2].code = ""
+        self.db.session.commit()
+        self.assertEqual(index_course(self.course.id, assignment_ids=[self.assignment.id]), 5)
+        self.assertEqual(CodeSignature.similar_pairs(self.course.id, self.assignment.id), [])
+        self.assertEqual(CodeBand.query.filter_by(submission_id=self.ids[2]).count(), 0)
+
+
+class SearchIndexTests(unittest.TestCase):
+    """
+    Confirm that searches are parsed, looked up by trigram, and matched
+    """
+    def test_query(self):
+        """ Terms can be quoted or excluded, and results must have every included trigram """
+        from models.search_index import Query, trigrams
+        self.assertEqual(trigrams("Open("), {"ope", "pen", "en("})
+        query = Query.parse('OPEN( -with "f.read()"')
+        self.assertEqual(query, Query(["open(", "f.read()"], ["with"]))
+        self.assertTrue(query.trigrams() >= trigrams("f.read()"))
+        code = "f = open('data.txt')\nprint(f.read())\n"
+        self.assertTrue(query.matches(code))
+        self.assertFalse(query.matches("with open('data.txt') as f:\n    print(f.read())\n"))
+        self.assertEqual(query.matched_lines(code), [(1, "f = open('data.txt')"), (2, "print(f.read())")])
+        self.assertRaises(ValueError, Query.parse, "if -print")
+
+
+class SearchIndexDatabaseTests(DatabaseTestCase):
+    """
+    Confirm that documents are kept up to date as their sources change, and found by their terms
+    """
+    def setUp(self):
+        """ A course with an assignment and a student's submission """
+        super().setUp()
+        from models.assignment import Assignment
+        from models.course import Course
+        from models.submission import Submission
+        self.course = Course(name='CS1')
+        self.db.session.add(self.course)
+        self.db.session.commit()
+        self.assignment = Assignment(name='Files', course_id=self.course.id)
+        self.db.session.add(self.assignment)
+        self.db.session.commit()
+        self.student = self.make_user('student@example.com', ['learner'], self.course.id)
+        self.submission = Submission(assignment_id=self.assignment.id, course_id=self.course.id,
+                                     user_id=self.student.id)
+        self.db.session.add(self.submission)
+        self.db.session.commit()
+
+    def search(self, text):
+        from models.search_index import Query, search
+        documents, _ = search(self.course.id, Query.parse(text))
+        return [document.source_id for document in documents]
+
+    def postings(self):
+        from models.search_index import SearchTrigram
+        grams = [posting.trigram for posting in SearchTrigram.query.all()]
+        self.assertEqual(len(grams), len(set(grams)))
+        return set(grams)
+
+    def test_incremental(self):
+        """ Only the trigrams the code gained or lost are posted or removed """
+        from sqlalchemy.exc import IntegrityError
+        from models.search_index import SearchTrigram, trigrams
+        self.submission.save_code('answer.py', "f = open('data.txt')\nprint(f.read())\n")
+        self.assertEqual(self.search('open( "f.read()"'), [self.submission.id])
+        self.assertEqual(self.search('open( -read'), [])
+        self.submission.save_code('answer.py', "with open('data.txt') as f:\n    print(f.readline())\n")
+        self.assertEqual(self.postings(), trigrams("with open('data.txt') as f:\n    print(f.readline())\n"))
+        self.assertEqual(self.search('"with open("'), [self.submission.id])
+        self.assertEqual(self.search('f.read()'), [])
+        self.submission.save_code('answer.py', "  ")
+        self.assertEqual(self.postings(), set())
+        self.assertEqual(self.search('open('), [])
+        # Each trigram is only ever posted once per document
+        self.submission.save_code('answer.py', "open(")
+        posting = SearchTrigram.query.first()
+        self.db.session.add(SearchTrigram(document_id=posting.document_id, course_id=posting.course_id,
+                                          trigram=posting.trigram))
+        self.assertRaises(IntegrityError, self.db.session.commit)
+
+    def test_index_course(self):
+        """ Sources written before the index existed are indexed, and those up to date are left alone """
+        from models.search_index import SearchDocument, index_course
+        self.app.config['SEARCH_INDEX'] = False
+        self.submission.save_code('answer.py', "print(input('Name? '))")
+        self.assertEqual(SearchDocument.query.count(), 0)
+        self.app.config['SEARCH_INDEX'] = True
+        self.assertEqual(index_course(self.course.id, chunk_size=1), 1)
+        self.assertEqual(self.search('input('), [self.submission.id])
+        postings = self.postings()
+        self.assertEqual(index_course(self.course.id), 1)
+        self.assertEqual(self.postings(), postings)
+        self.assertEqual(index_course(self.course.id, assignment_ids=[self.assignment.id + 1]), 0)